@@ -4,11 +4,30 @@ import os
 import sys
 import json
 import time
+import gzip
 import shutil
+import socket
+import struct
+import hmac
+import hashlib
+import getpass
+import plistlib
+import threading
+import contextlib
+import tempfile
+import concurrent.futures
 import argparse
 from datetime import datetime, timedelta
 import subprocess
 
+try:
+    import fcntl
+    import resource
+except ImportError:
+    # Windows. No shared ledger locking or rlimits
+    fcntl = None
+    resource = None
+
 """ =================================== QConfig Class  =======================
 =========================================================================== """
 class QConfig:
@@ -325,6 +344,59 @@ class QConfig:
         print("  Source: " + mmap['source'])
         print("  Dest:   " + mmap['dest']+"\n")
 
+    def mergeMapProfiles(self, map_paths):
+        """ ===============================================
+        Create or update MAP profiles for a list of .map
+        files found by a scan. Maps that already have a
+        profile are left alone. A profile whose source has
+        gone missing is pointed at a found map with the same
+        name. Profiles are named after the map; if the name
+        is taken the parent directory is added.
+
+        Parameters
+        ----------
+        map_paths : list
+            Full paths to .map files
+
+        Returns
+        -------
+        dict
+            Counts of created, updated and unchanged profiles
+        =============================================== """
+        counts = {"created": 0, "updated": 0, "unchanged": 0}
+        sources = set(mmap['source'] for mmap in self.config['maps'])
+
+        for map_path in sorted(map_paths):
+            if map_path in sources:
+                counts['unchanged'] += 1
+                continue
+
+            name = os.path.splitext(os.path.basename(map_path))[0]
+            if self.profileExists('maps', name):
+                mmap = self.getProfile('maps', name)
+                if not os.path.exists(mmap['source']):
+                    # Map moved. Follow it.
+                    mmap['source'] = map_path
+                    sources.add(map_path)
+                    counts['updated'] += 1
+                    continue
+                name = os.path.basename(os.path.dirname(map_path)) + "_" + name
+
+            if self.profileExists('maps', name):
+                print("Profile name already taken, skipping: " + map_path)
+                continue
+
+            self.config['maps'].append({
+                "name": name,
+                "default": len(self.config['maps']) == 0,
+                "source": map_path,
+                "dest": False
+            })
+            sources.add(map_path)
+            counts['created'] += 1
+
+        return counts
+
     def listEngines(self):
         """ ===============================================
         Print list of ENGINE profiles for the user
@@ -447,7 +519,7 @@ class QCompile:
         bool
             True if splitable, False if not. 
         =============================================== """
-        if re.match("^[A-z]+:[A-z]+$", arg):
+        if re.match("^[A-z]+:[\\w,.\\-]+$", arg):
             return True
         else:
             return False
@@ -470,18 +542,28 @@ class QCompile:
         print("  build:show <name>\tShow specified build profile")
         print("  build:new <name>\tCreate new build profile")
         print("  build:del <name>\tRemove specified build profile")
+        print("  build:<a,b,c>\t\tMatrix build with several profiles, sharing identical stages")
+        print("  force:yes\t\tBuild even if nothing changed since last build")
+        print("  stages:<vis,light>\tOnly run these stages on the last build's .bsp/.prt")
+        print("  region:<x1,y1,z1,x2,y2,z2>\tBuild only the brushes and entities inside the box")
+        print("  report:json\t\tWrite a json report of the build")
+        print("  report:ndjson\t\tStream build events to an ndjson log")
+        print("  trace:yes\t\tWrite a trace timeline of the build (Perfetto, chrome://tracing)")
         
         print(" map")
         print("  map:list\t\tList map profiles")
         print("  map:show <name>\tShow map profile")
         print("  map:new <name> \tCreate new map Profile")
         print("  map:del <name>\tRemove specified map profile")
+        print("  map:scan <dir>\tCreate map profiles for every .map under dir")
+        print("  map:portals [name]\tPortal counts, hotspots and estimated vis time from the .prt")
         
         print(" engine")
         print("  engine:list\t\tList engine profiles")
         print("  engine:show <name>\tShow engine profile")
         print("  engine:new <name> \tCreate new engine profile")
         print("  engine:del <name> \tRemove specified engine profile")
+        print("  engine:session [name]\tKeep engine running. Builds load their map into it")
         
         print(" mod")
         print("  mod:list\t\tList mod profiles")
@@ -489,6 +571,18 @@ class QCompile:
         print("  mod:new <name>\tCreate new mod profile")
         print("  mod:del <name>\tRemove specified profile")
 
+        print(" worker")
+        print("  worker:serve [port]\tRun vis/light jobs for other hosts")
+        print("  worker:list\t\tShow configured workers and their load")
+        print("  remote:<vis,light>\tRun stages on the least busy worker (remote:yes for both)")
+
+        print(" log")
+        print("  log:diff [name]\tShow warnings added/removed since the last build of map profile")
+
+        print(" bench")
+        print("  bench:<map>\t\tBenchmark the deployed map in the engine and compare with earlier runs")
+        print("  bench:<map> build:<name>\tBenchmark <map>_<name>.bsp of a matrix build")
+
         print(" play")
         print("  play <name>\tPlay map profile without compilation")
 
@@ -525,41 +619,123 @@ class QCompile:
 class QCompiler:
     cfg = {}
     def __init__(self):
+        config_started = time.time()
         self.cfg = QConfig('qruncher.json')
+        # Kept for the build trace
+        self.config_load_time = (config_started, time.time())
 
-    def runTool(self, args):
+    def runTool(self, args, tool=None, governor=None, stage=None, log=None, cwd=None):
         """ ===============================================
         Run a tool and time the duration of the execution.
+        Where the OS supports it the resources used by the
+        tool are collected too. While the tool runs its
+        memory is sampled for the memory governor.
 
         Parameters
         ----------
         args : list
-            List of executable & arguments for subprocess.run()
+            List of executable & arguments for subprocess.Popen()
+        tool : dict
+            Tool from getTool. Its nice, ionice and
+            memory_limit are applied to the process.
+        governor : QMemoryGovernor
+            Memory governor to report samples to
+        stage : str
+            Name of the stage for the governor
+        log : function
+            Called with every line of output. The output is
+            still printed.
+        cwd : str
+            Directory to run the tool in. Current if None.
 
         Returns
         -------
         dict
             Dictionary of hours, minutes and seconds
-            it took to complete the execution of the tool
+            it took to complete the execution of the tool,
+            plus return code, start time, seconds and
+            cpu/memory usage for reports.
         =============================================== """
+        prefix, limitProcess = self.getToolLimits(tool or {})
+
+        pipe = {}
+        if log:
+            pipe = {"stdout": subprocess.PIPE, "stderr": subprocess.STDOUT}
+
         sdt = datetime.now()
         try:
-            subprocess.run(args)
+            proc = subprocess.Popen(prefix + args, cwd=cwd, **pipe)
         except FileNotFoundError as fnfe:
             print(str(fnfe))
             # print(args)
             sys.exit(1)
+        if limitProcess:
+            limitProcess(proc.pid)
+
+        reader = None
+        if log:
+            def readOutput():
+                for raw in proc.stdout:
+                    line = raw.decode(errors='replace')
+                    sys.stdout.write(line)
+                    sys.stdout.flush()
+                    log(line.rstrip('\r\n'))
+            reader = threading.Thread(target=readOutput, name=stage or 'output')
+            reader.start()
+
+        # Poll instead of blocking so memory can be sampled. Short
+        # tools are caught by the first quick polls.
+        rusage = None
+        peak_rss = None
+        interval = 0.02
+        while True:
+            if hasattr(os, 'wait4'):
+                pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+                if pid != 0:
+                    proc.returncode = os.waitstatus_to_exitcode(status)
+                    break
+            elif proc.poll() is not None:
+                break
+
+            rss = QMemoryGovernor.sampleRss(proc.pid)
+            if rss is not None:
+                peak_rss = max(rss, peak_rss or 0)
+                if governor:
+                    governor.update(stage, rss)
+
+            time.sleep(interval)
+            interval = min(interval * 2, 0.5)
+
+        if reader:
+            reader.join()
+            proc.stdout.close()
 
         edt = datetime.now()
 
         duration = edt - sdt
 
         splt = str(duration).split(':')
-        
+
+        resources = {'cpu_user': None, 'cpu_sys': None, 'max_rss': peak_rss}
+        if rusage is not None:
+            # ru_maxrss is kilobytes on linux, bytes on MacOS
+            max_rss = rusage.ru_maxrss
+            if sys.platform != 'darwin':
+                max_rss = max_rss * 1024
+            resources = {
+                'cpu_user': round(rusage.ru_utime, 3),
+                'cpu_sys': round(rusage.ru_stime, 3),
+                'max_rss': max_rss
+            }
+
         return {
             'h': splt[0],
             'm': splt[1],
-            's': str(round(float(splt[2]),3))
+            's': str(round(float(splt[2]),3)),
+            'returncode': proc.returncode,
+            'started': sdt.timestamp(),
+            'seconds': round(duration.total_seconds(), 3),
+            'resources': resources
         }
 
     def getFileStats(self, file_path):
@@ -616,185 +792,73 @@ class QCompiler:
         # Get tool Arguments
         tool_args = tool['args']
 
-        return {"path": tool_path, "args": tool_args}
+        return {
+            "path": tool_path,
+            "args": tool_args,
+            "nice": tool.get('nice'),
+            "ionice": tool.get('ionice'),
+            "memory_limit": tool.get('memory_limit'),
+            "budget": tool.get('budget'),
+            "over_budget": tool.get('over_budget', 'warn')
+        }
         # return [tool_path, tool_args]
 
 
-    def runBuild(self, opts):
-        # print(opts)
+    def getBundleExecutable(self, app_path):
         """ ===============================================
-        Run the build process. This is it!
+        Find the executable inside a MacOS .app bundle
 
         Parameters
         ----------
-        opts : dict
-            All command line options
-        =============================================== """
-        # Get system paths
-        tool_path = self.cfg.config['config']['tool_path']
-        base_path = self.cfg.config['config']['base_path']
-
-        # Get Build Profile
-        try:
-            builder = self.cfg.getProfile('builders', opts['build'])
-        except KeyError:
-            print("Must specify valid build profile")
-            sys.exit(0)
-
-        # Get Map Profile
-        try:
-            mmap = self.cfg.getProfile('maps', opts['map'])
-        except KeyError:
-            mmap = self.cfg.getDefaultProfile('maps')
-
-        # Get engine Profile
-        try:
-            engine = self.cfg.getProfile('engines', opts['engine'])
-        except KeyError:
-            engine = self.cfg.getDefaultProfile('engines')
-
-        # Get Mod Profile
-        try:
-            mod = self.cfg.getProfile('mods', opts['mod'])
-        except KeyError:
-            mod = self.cfg.getDefaultProfile('mods')
-
-        """ Setup Paths =============================== """
-        # full path to .map file
-        map_full_path = mmap['source']
-        
-        # name of the map with ext (awesomemap.map)
-        map_filename = os.path.basename(map_full_path)
-        
-        # name of map without ext (awesomemap)
-        map_basename  = os.path.splitext(map_filename)[0]
-
-        # name of map with .bsp ext (awesomemap.bsp)
-        map_bspname = map_basename+".bsp"
-
-        # Directory where the map lives (/path/to/)
-        map_directory = os.path.dirname(map_full_path)+os.sep
-
-        # Full path to .bsp file (/path/to/awesomemap.bsp)
-        bsp_full_path = map_directory + map_basename + ".bsp"
-
-        # Full path to .prt file (/path/to/awesomemap.prt)
-        prt_full_path = map_directory + map_basename + ".prt"
-
-        # Full path to .lit file (/path/to/awesomemap.lit)
-        lit_full_path = map_directory + map_basename + ".lit"
-        """ End Setup Paths =========================== """
-        
-        """ Handle output destination. If dest is specified in MAP profile
-        use that. If not specified in MAP profile, use MOD profile as output
-        =============================================== """
-        if not mmap['dest']:
-            bsp_destination = base_path + os.sep + mod['subdir'] + os.sep + "maps" + os.sep + map_basename + ".bsp"
-        else:
-            bsp_destination = mmap['dest'] + os.sep + map_basename + ".bsp"    
-
-        # Change into map_directory for generation of log files in build dir.
-        os.chdir(map_directory)
-
-        """ Create QBSP Command """
-        qbsp = self.getTool(builder, 'qbsp')
-        # Build command list for subprocess.run()
-        # executable + args + path_to_.map_fie
-        qbsp_cmd = [qbsp['path']] + qbsp['args'] + [map_full_path]
-
-        """ Create VIS Command """
-        vis = self.getTool(builder, 'vis')
-        # Build command list for subprocess.run()
-        # executable + args + path_to_.bsp_file
-        vis_cmd = [vis['path']] + vis['args'] + [bsp_full_path]
-
-        """ Create LIGHT Command """
-        light = self.getTool(builder, 'light')
-        # Build command list for subprocess.run()
-        # executable + args + path_to_.bsp_file
-        light_cmd = [light['path']] + light['args'] + [bsp_full_path]
+        app_path : str
+            Path to the .app
 
-        """ Just about ready to run! ======================
-        Lets just check that all files are in place.
+        Returns
+        -------
+        str
+            Path to the executable. None if it can not be
+            found.
         =============================================== """
-        # map file
-        try:
-            os.path.exists(map_full_path)
-        except FileNotFoundError:
-            print("ERROR: .map file not found: "+map_full_path)
-
-        # qbsp exe
-        try:
-            os.path.exists(qbsp['path'])
-        except FileNotFoundError:
-            print("ERROR: qbsp not found: "+qbsp['path'])
-
-        # vis exe
-        try:
-            os.path.exists(vis['path'])
-        except FileNotFoundError:
-            print("ERROR: vis not found: "+vis['path'])
-
-        # light exe
-        try:
-            os.path.exists(light['path'])
-        except FileNotFoundError:
-            print("Error: light not found: "+light['path'])
-
-        # Run QBSP, VIS, LIGHT
-        qbsp_time = self.runTool(qbsp_cmd)
-
-        vis_time = self.runTool(vis_cmd)
-
-        light_time = self.runTool(light_cmd)
-
-        # Move bsp file to final destination
+        macos_path = os.path.join(app_path, 'Contents', 'MacOS')
         try:
-            os.remove(bsp_destination)
-        except OSError:
+            with open(os.path.join(app_path, 'Contents', 'Info.plist'), 'rb') as info:
+                executable = os.path.join(macos_path, plistlib.load(info)['CFBundleExecutable'])
+            if os.path.isfile(executable):
+                return executable
+        except (OSError, KeyError, plistlib.InvalidFileException):
             pass
 
         try:
-            shutil.copy(bsp_full_path, bsp_destination)
-        except FileNotFoundError:
-            print("shit")
-
-        # Done Compiling. Check stats on files generated
-        map_fs = self.getFileStats(map_full_path)
-        bsp_fs = self.getFileStats(bsp_full_path)
-        prt_fs = self.getFileStats(prt_full_path)
-        lit_fs = self.getFileStats(lit_full_path)
-
-        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        print("\nQCruncher File Report @\t"+current_time)
-        print("-----------------------------------------------")
-        print("File\tExists\t\tSize\tCreate Date/time")
-        print("-----------------------------------------------")
-        print(".map\t"+map_fs['exists']+"\t\t"+map_fs['size']+"\t"+map_fs['time'])
-        print(".bsp\t"+bsp_fs['exists']+"\t\t"+bsp_fs['size']+"\t"+bsp_fs['time'])
-        print(".prt\t"+prt_fs['exists']+"\t\t"+prt_fs['size']+"\t"+prt_fs['time'])
-        print(".lit\t"+lit_fs['exists']+"\t\t"+lit_fs['size']+"\t"+lit_fs['time'])
-
-        print("\nQCruncher Tools Report")
-        print("-----------------------------------------------")
-        print("Tool\tHrs\tMin\tSeconds\tArguments")
-        print("-----------------------------------------------")
-        print("QBSP:\t"+qbsp_time['h']+"\t"+qbsp_time['m']+"\t"+qbsp_time['s']+"\t"+" ".join(qbsp['args']))
-        print("VIS :\t"+vis_time['h']+"\t"+vis_time['m']+"\t"+vis_time['s']+"\t"+" ".join(vis['args']))
-        print("LIGHT:\t"+light_time['h']+"\t"+light_time['m']+"\t"+light_time['s']+"\t"+" ".join(light['args']))
-
-        print("\nFinal Destination of bsp file: ")
-        try:
-            os.path.exists(bsp_destination)
-            print(bsp_destination)
-        except FileNotFoundError:
-            print("ERROR: .bsp file did not make it to final destination: "+bsp_destination)
-
-        # Run QUAKE!!!
+            candidates = [os.path.join(macos_path, name) for name in sorted(os.listdir(macos_path))]
+        except OSError:
+            return None
+        candidates = [path for path in candidates if os.path.isfile(path) and os.access(path, os.X_OK)]
+        return candidates[0] if len(candidates) == 1 else None
 
-        # Check for --nogame
+    def getEngineCommand(self, engine, base_path, mod, direct=False):
+        """ ===============================================
+        Build the command to launch the engine with the mod,
+        without the map.
 
+        Parameters
+        ----------
+        engine : dict
+            ENGINE profile
+        base_path : str
+            Quake base path
+        mod : dict
+            MOD profile
+        direct : bool
+            Run the executable inside a .app bundle instead of
+            using "open". Needed when qruncher talks to the
+            engine over stdin or reads its stdout, which "open"
+            does not pass on.
 
+        Returns
+        -------
+        list
+            Executable & arguments for subprocess
+        =============================================== """
         # Check OS. If its 'darwin'(MacOS), some executables are in mac format,
         # which is inside a folder. Need to use the "open" command on mac os to
         # fire this off. Linux & windows are straight paths.
@@ -824,6 +888,12 @@ class QCompiler:
                     # Just does not exist. Bail.
                     print("Engine Executable does not exist. Exiting")
                     sys.exit(0)
+            if direct and engine_exe[0] == 'open':
+                executable = self.getBundleExecutable(engine_path)
+                if executable is None:
+                    print("Can not find the executable in " + engine_path + "/Contents/MacOS. Set the engine path to it")
+                    sys.exit(1)
+                engine_exe = [executable]
         else:
             # Onward to other OS's
             if not os.path.exists(engine['path']):
@@ -837,62 +907,4440 @@ class QCompiler:
         # Add mod
         engine_exe = engine_exe + ['-game', mod['subdir']]
 
-        # Add Map
-        engine_exe = engine_exe + ['+map', map_basename]
-        subprocess.run(engine_exe)
-        sys.exit(0)
+        return engine_exe
 
-""" =================================== EXCEPTIONS ============================
-=========================================================================== """
-class ProfileNotFoundException(Exception):
-    def __init__(self, pType, profile_name):
-        print("ERROR: Profile Not Found: Type="+pType+" Name="+profile_name)
-        print("")
+    def getSessionFile(self, base_path):
+        """ ===============================================
+        Path of the file describing the running engine
+        session for this quake install.
 
-class NoDefaultProfileException(Exception):
-    def __init__(self, pType):
-        print("ERROR: No default profile for: "+pType)
-        
+        Returns
+        -------
+        str
+            Path to session.json
+        =============================================== """
+        return os.path.join(base_path, ".qruncher", "session.json")
 
+    def logDiff(self, profile_name):
+        """ ===============================================
+        Print the warnings added and removed between the
+        last two builds of a map.
 
-""" =================================== MAIN ==================================
-=========================================================================== """
-def main():
-    config_file = 'qruncher.json'
-    app = QCompile(config_file)
+        Parameters
+        ----------
+        profile_name : str
+            Name of the MAP profile. Default profile if None.
+        =============================================== """
+        if profile_name:
+            mmap = self.cfg.getProfile('maps', profile_name)
+        else:
+            mmap = self.cfg.getDefaultProfile('maps')
 
-    if len(app.opts) <= 2: # Config Mode
-        try:
-            profile_name = app.opts['profile_name']
-            del app.opts['profile_name']
-        except KeyError:
-            pass
-        cmd = list(app.opts.keys())[0]
-        opt = list(app.opts.values())[0]
+        map_basename = os.path.splitext(os.path.basename(mmap['source']))[0]
+        log_path = os.path.join(os.path.dirname(mmap['source']), ".qruncher", "logs", map_basename)
+        logs = QLogArchive(log_path)
 
-        # Check to see if it is BUILD
-        # and the option IS a profile. This means that we are going 
-        # to use ALL defaults on everything except the build.
-        if cmd == 'build' and app.isProfile(opt):
-            app.compiler.runBuild(app.opts)
-            print("Proceed to building")
+        builds = logs.index[-2:]
+        if len(builds) < 2:
+            print("Need two builds of " + map_basename + " to diff. Found " + str(len(builds)))
+            return
 
-        # Handle builds
-        if cmd == 'build':
-            if opt == 'list':
-                app.config.listBuilders()
-                sys.exit(0)
-            if opt == 'show':
-                app.config.showBuilders(profile_name)
-                sys.exit(0)
-            if opt == 'new':
-                app.config.scaffoldNew('builders', profile_name)
-                app.config.saveFiles()
-                sys.exit(0)
-            if opt == 'del':
-                if query_yes_no("Confirm"):
-                    app.config.deleteProfile('builders', profile_name)
-                    app.config.saveFiles()
+        added, removed = logs.diff(builds[0], builds[1])
+        print("Warnings of " + map_basename + ": " + builds[0]['stamp'] + " (" + builds[0]['build']
+            + ") -> " + builds[1]['stamp'] + " (" + builds[1]['build'] + ")")
+        stages = logs.commonStages(builds[0], builds[1])
+        if stages != QLogArchive.all_stages:
+            print("Partial build, only comparing stages: " + ",".join(stages))
+        print("-----------------------------------------------")
+        for warning in removed:
+            print("- [" + warning['stage'] + "] " + warning['text'])
+        for warning in added:
+            print("+ [" + warning['stage'] + "] " + warning['text'])
+        print("-----------------------------------------------")
+        print(str(len(added)) + " added, " + str(len(removed)) + " removed")
+
+    def showPortals(self, profile_name):
+        """ ===============================================
+        Print the analysis of the .prt left by the last
+        build of a map and the estimated vis time for the
+        default build profile.
+
+        Parameters
+        ----------
+        profile_name : str
+            Name of the MAP profile. Default profile if None.
+        =============================================== """
+        if profile_name:
+            mmap = self.cfg.getProfile('maps', profile_name)
+        else:
+            mmap = self.cfg.getDefaultProfile('maps')
+
+        map_basename = os.path.splitext(os.path.basename(mmap['source']))[0]
+        map_directory = os.path.dirname(mmap['source']) + os.sep
+        portals = QPortalFile(map_directory + map_basename + ".prt").analyze()
+        if portals is None:
+            print("No .prt for " + map_basename + ". Build the map first")
+            return
+
+        vis = self.getTool(self.cfg.getDefaultProfile('builders'), 'vis')
+        estimator = QVisEstimate(self.getStatePath(map_directory) + map_basename + ".vis.json",
+            self.cfg.config['config'].get('vis_rate'))
+        QPortalFile.printAnalysis(portals, estimator.estimate(portals, vis['args']))
+
+    def checkVisBudget(self, stage, portals, estimator):
+        """ ===============================================
+        Estimate the vis time from the .prt and apply the
+        over_budget policy of the vis tool when the estimate
+        is over its budget.
+
+        Parameters
+        ----------
+        stage : dict
+            The vis stage. Args and cmd are changed when it
+            is downgraded to -fast.
+        portals : dict
+            Result of QPortalFile.analyze
+        estimator : QVisEstimate
+            Vis time history of the map
+
+        Returns
+        -------
+        str
+            None to run vis as is, 'fast' if it was downgraded,
+            'fail' if the build should stop.
+        =============================================== """
+        estimate = estimator.estimate(portals, stage['tool']['args'])
+        portals['estimate'] = estimate
+        QPortalFile.printAnalysis(portals, estimate)
+
+        budget = stage['tool'].get('budget')
+        if not budget or estimate is None or estimate <= parse_duration(budget):
+            return None
+
+        policy = stage['tool'].get('over_budget', 'warn')
+        print("WARNING: estimated vis time " + format_duration(estimate) + " is over the budget of " + str(budget))
+        if policy == 'fail':
+            print("Stopping build (over_budget: fail)")
+            return 'fail'
+        if policy == 'fast':
+            if '-fast' in stage['tool']['args']:
+                return None
+            print("Running vis with -fast (over_budget: fast)")
+            stage['tool'] = dict(stage['tool'], args=stage['tool']['args'] + ['-fast'])
+            stage['cmd'] = stage['cmd'][:-1] + ['-fast'] + stage['cmd'][-1:]
+            return 'fast'
+        return None
+
+    def listWorkers(self):
+        """ ===============================================
+        Print the configured build workers and their load
+        =============================================== """
+        print("Build Workers:")
+        print("-----------------------------------")
+        for address in self.cfg.config['config'].get('workers', []):
+            info = QWorkerClient(address).info()
+            if info is None:
+                print(address + "\tnot answering")
+            else:
+                print(address + "\tcores: " + str(info['cores']) + "\tload: "
+                    + str(round(info['load'], 2)) + "\tjobs: " + str(info['running']))
+
+    def runRemote(self, stage, build_name, args, map_directory, map_basename, log):
+        """ ===============================================
+        Run a stage on the least busy build worker. The
+        inputs are sent over, the output streamed back and
+        the results written into map_directory.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage (vis, light)
+        build_name : str
+            BUILD profile. The worker only takes the tool
+            executable from its own copy.
+        args : list
+            Args to run the tool with
+        map_directory : str
+            Directory where the map lives
+        map_basename : str
+            Name of the map without ext
+        log : function
+            Line handler for the stage output
+
+        Returns
+        -------
+        dict
+            Result like runTool. None if no worker could run
+            it, the stage should then run locally.
+        =============================================== """
+        workers = self.cfg.config['config'].get('workers', [])
+        secret = self.cfg.config['config'].get('worker_secret')
+        if stage not in QWorker.stage_files or not workers:
+            return None
+
+        client = QWorkerClient.choose(workers, secret)
+        if client is None:
+            print("No build worker available for " + stage + ". Running locally")
+            return None
+
+        inputs = [map_directory + map_basename + ext for ext in QWorker.stage_files[stage][0]]
+        print("Running " + stage + " on worker " + client.address)
+        try:
+            result = client.runStage(build_name, stage, args, inputs, map_directory, log)
+        except (OSError, ValueError, WorkerException) as e:
+            print("Worker " + client.address + " failed (" + str(e) + "). Running " + stage + " locally")
+            return None
+
+        result['worker'] = client.address
+        return result
+
+    def runBench(self, opts):
+        """ ===============================================
+        Benchmark the deployed .bsp of a map in the engine
+        and compare with earlier benchmarks of the map.
+
+        Parameters
+        ----------
+        opts : dict
+            All command line options. bench is the MAP
+            profile, engine and mod as in a build. build
+            picks the <map>_<profile>.bsp of a matrix build.
+        =============================================== """
+        base_path = self.cfg.config['config']['base_path']
+        mmap = self.cfg.getProfile('maps', opts['bench'])
+
+        try:
+            engine = self.cfg.getProfile('engines', opts['engine'])
+        except KeyError:
+            engine = self.cfg.getDefaultProfile('engines')
+
+        try:
+            mod = self.cfg.getProfile('mods', opts['mod'])
+        except KeyError:
+            mod = self.cfg.getDefaultProfile('mods')
+
+        map_basename = os.path.splitext(os.path.basename(mmap['source']))[0]
+        map_directory = os.path.dirname(mmap['source']) + os.sep
+
+        # build:<profile> benchmarks the matrix build of that profile
+        bench_name = map_basename
+        if opts.get('build'):
+            bench_name = map_basename + "_" + opts['build']
+
+        if not mmap['dest']:
+            bsp_destination = base_path + os.sep + mod['subdir'] + os.sep + "maps" + os.sep + bench_name + ".bsp"
+        else:
+            bsp_destination = mmap['dest'] + os.sep + bench_name + ".bsp"
+
+        if not os.path.exists(bsp_destination):
+            print("ERROR: " + bsp_destination + " not found. Build the map first")
+            sys.exit(1)
+
+        # Look up the build that deployed this exact bsp
+        state_path = self.getStatePath(map_directory)
+        bsp_hash = QManifest.hashFile(bsp_destination)
+        deployed = QBench.deployedBuild(state_path + map_basename + ".deploys.json", bsp_hash)
+        if deployed is None:
+            print("WARNING: " + bsp_destination + " was not deployed by qruncher. Build settings unknown")
+            deployed = {"build": None, "settings": None}
+
+        bench = QBench(state_path + "bench" + os.sep + map_basename + ".jsonl", engine)
+        # The results are read from the engine's stdout, which "open" does not pass on
+        engine_exe = self.getEngineCommand(engine, base_path, mod, direct=True)
+        result = bench.run(engine_exe, bench_name, int(engine.get('bench_runs', 1)))
+        if result is None:
+            print("ERROR: no benchmark result in engine output. Check bench args of engine " + engine['name'])
+            sys.exit(1)
+
+        result.update({
+            "time": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "engine": engine['name'],
+            "build": deployed['build'],
+            "settings": deployed['settings'],
+            "bsp_hash": bsp_hash,
+            "map_hash": QManifest.hashFile(mmap['source']) if os.path.exists(mmap['source']) else None
+        })
+        bench.record(result)
+        bench.printHistory()
+
+    def runSession(self, opts):
+        """ ===============================================
+        Launch the engine once and keep it running. Builds
+        that use the same engine load their map into it
+        instead of launching the engine again. Runs until
+        the game is quit.
+
+        Parameters
+        ----------
+        opts : dict
+            All command line options. profile_name is the
+            engine profile, mod the mod profile.
+        =============================================== """
+        base_path = self.cfg.config['config']['base_path']
+
+        if opts.get('profile_name'):
+            engine = self.cfg.getProfile('engines', opts['profile_name'])
+        else:
+            engine = self.cfg.getDefaultProfile('engines')
+
+        try:
+            mod = self.cfg.getProfile('mods', opts['mod'])
+        except KeyError:
+            mod = self.cfg.getDefaultProfile('mods')
+
+        # The session feeds commands to the engine's stdin
+        engine_exe = self.getEngineCommand(engine, base_path, mod, direct=True)
+        session = QEngineSession(self.getSessionFile(base_path))
+        session.serve(engine_exe, engine, mod['subdir'])
+
+    def getToolLimits(self, tool):
+        """ ===============================================
+        Prepare the process limits of a tool. Only works on
+        POSIX systems, ignored elsewhere.
+
+        Parameters
+        ----------
+        tool : dict
+            Tool from getTool
+
+        Returns
+        -------
+        tuple
+            Command prefix (ionice, nice, prlimit) and a function
+            that applies the rest to the started pid, or None.
+            Tools run from thread pools, so nothing is done
+            in the child between fork and exec.
+        =============================================== """
+        prefix = []
+        if os.name != 'posix':
+            return prefix, None
+
+        if tool.get('ionice') is not None and shutil.which('ionice'):
+            # Best effort class, level 0 (high) to 7 (low)
+            prefix += ['ionice', '-c', '2', '-n', str(tool['ionice'])]
+
+        renice = None
+        if tool.get('nice') is not None:
+            if shutil.which('nice'):
+                prefix += ['nice', '-n', str(int(tool['nice']))]
+            else:
+                renice = int(tool['nice'])
+
+        limit = None
+        if tool.get('memory_limit'):
+            if shutil.which('prlimit'):
+                prefix += ['prlimit', '--as=' + str(parse_size(tool['memory_limit'])), '--']
+            elif resource is not None and hasattr(resource, 'prlimit'):
+                limit = parse_size(tool['memory_limit'])
+            else:
+                print("memory_limit is not supported on this system. Ignoring it")
+
+        if renice is None and limit is None:
+            return prefix, None
+
+        def limitProcess(pid):
+            try:
+                if renice is not None:
+                    os.setpriority(os.PRIO_PROCESS, pid, os.getpriority(os.PRIO_PROCESS, 0) + renice)
+                if limit is not None:
+                    resource.prlimit(pid, resource.RLIMIT_AS, (limit, limit))
+            except OSError as ose:
+                print("Could not limit " + str(pid) + ": " + str(ose))
+
+        return prefix, limitProcess
+
+    def getStageKeys(self, stages, build_inputs, manifest):
+        """ ===============================================
+        Key every stage by what its output depends on: the
+        content of every build input, and the executable and
+        args of the stage and all stages before it.
+
+        Parameters
+        ----------
+        stages : list
+            Stages of the build in order
+        build_inputs : list
+            Paths to every input of the build
+        manifest : QManifest
+            Manifest of the build. Its entries save hashing
+            inputs that did not change.
+
+        Returns
+        -------
+        dict
+            Stage name to key
+        =============================================== """
+        key = QManifest.hashSettings([
+            [path, manifest.inputHash(path)] for path in build_inputs])
+        keys = {}
+        for stage in stages:
+            key = QManifest.hashSettings([stage['name'], stage['tool']['path'], stage['tool']['args'], key])
+            keys[stage['name']] = key
+        return keys
+
+    def getStatePath(self, map_directory):
+        """ ===============================================
+        Get the directory Qruncher keeps its build state in
+        for maps in map_directory. Created if missing.
+
+        Parameters
+        ----------
+        map_directory : str
+            Directory where the map lives
+
+        Returns
+        -------
+        str
+            Path to the state directory with trailing separator
+        =============================================== """
+        state_path = map_directory + ".qruncher" + os.sep
+        os.makedirs(state_path, exist_ok=True)
+        return state_path
+
+    def getDependencies(self, map_full_path, qbsp_args, base_path, mod, manifest=None):
+        """ ===============================================
+        Find the external files a map build depends on.
+        WADs are looked up the same way qbsp does: next to
+        the map, in -wadpath dirs and in the game dirs. The
+        .map is only read when it changed since the list was
+        cached in the manifest.
+
+        Parameters
+        ----------
+        map_full_path : str
+            Full path to the .map file
+        qbsp_args : list
+            qbsp arguments from the build profile
+        base_path : str
+            Quake base path
+        mod : dict
+            MOD profile
+        manifest : QManifest
+            Manifest of the build to cache the list in
+
+        Returns
+        -------
+        list
+            Full paths to every dependency
+        =============================================== """
+        search_paths = [os.path.dirname(map_full_path)]
+        for idx, arg in enumerate(qbsp_args):
+            if arg == '-wadpath' and idx + 1 < len(qbsp_args):
+                search_paths.append(qbsp_args[idx + 1])
+            elif arg.startswith('-wadpath '):
+                search_paths.append(arg.split(' ', 1)[1].strip())
+        search_paths += [
+            base_path + os.sep + mod['subdir'],
+            base_path + os.sep + 'id1',
+            base_path
+        ]
+
+        if manifest is not None:
+            dependencies = manifest.cachedDependencies(map_full_path, search_paths)
+            if dependencies is not None:
+                return dependencies
+
+        dependencies = QMapFile(map_full_path).getDependencies(search_paths)
+        if manifest is not None:
+            manifest.cacheDependencies(map_full_path, search_paths, dependencies)
+        return dependencies
+
+    def writeRegionMap(self, map_full_path, region):
+        """ ===============================================
+        Write the region .map for a region compile. It is
+        written next to the source .map so WADs still
+        resolve, as <name>_rgn.map.
+
+        Parameters
+        ----------
+        map_full_path : str
+            Full path to the source .map file
+        region : str
+            Region box as x1,y1,z1,x2,y2,z2
+
+        Returns
+        -------
+        str
+            Full path to the region .map file
+        =============================================== """
+        try:
+            coords = [float(c) for c in region.split(',')]
+        except ValueError:
+            coords = []
+        if len(coords) != 6:
+            print("ERROR: region must be x1,y1,z1,x2,y2,z2: "+region)
+            sys.exit(1)
+
+        mins = [min(coords[n], coords[n + 3]) for n in range(3)]
+        maxs = [max(coords[n], coords[n + 3]) for n in range(3)]
+
+        region_path = os.path.splitext(map_full_path)[0] + "_rgn.map"
+        if not QMapFile(map_full_path).writeRegion(region_path, mins, maxs):
+            print("ERROR: no room for the player in region " + region
+                + ". Add an info_player_start inside the box or make the box bigger")
+            sys.exit(1)
+        print("Region compile: " + region + " -> " + region_path)
+        return region_path
+
+    def buildMatrix(self, builders, map_full_path, map_basename, matrix_path):
+        """ ===============================================
+        Merge the pipelines of several build profiles into
+        one graph of stages. A stage is keyed by its
+        executable, args and the key of the stage it builds
+        on, so stages that would produce the same output
+        are only in the graph once.
+
+        Parameters
+        ----------
+        builders : list
+            BUILD profiles of the matrix
+        map_full_path : str
+            Full path to the .map file
+        map_basename : str
+            Name of the map without ext
+        matrix_path : str
+            Directory the stage work directories go in
+
+        Returns
+        -------
+        tuple
+            (nodes, finals). nodes is every stage in order
+            they can run, finals the light node of each profile.
+        =============================================== """
+        map_hash = QManifest.fileHash(map_full_path)
+        nodes = {}
+        finals = {}
+        for builder in builders:
+            parent = None
+            for stage in ['qbsp', 'vis', 'light']:
+                tool = self.getTool(builder, stage)
+                settings = [stage, tool['path'], tool['args'], parent['key'] if parent else map_hash]
+                if stage == 'vis' and tool['budget']:
+                    # A vis budget may change the args at run time. Only
+                    # profiles with the same budget can share the run.
+                    settings += [tool['budget'], tool['over_budget']]
+                key = QManifest.hashSettings(settings)
+                if key not in nodes:
+                    work_dir = matrix_path + stage + "-" + key[:12] + os.sep
+                    bsp_path = work_dir + map_basename + ".bsp"
+                    if stage == 'qbsp':
+                        # qbsp writes to the given destination, not next to the map
+                        cmd = [tool['path']] + tool['args'] + [map_full_path, bsp_path]
+                    else:
+                        cmd = [tool['path']] + tool['args'] + [bsp_path]
+                    nodes[key] = {
+                        "key": key, "stage": stage, "tool": tool, "cmd": cmd,
+                        "work_dir": work_dir, "parent": parent, "profiles": []
+                    }
+                nodes[key]['profiles'].append(builder['name'])
+                parent = nodes[key]
+            finals[builder['name']] = parent
+
+        # Dicts keep insertion order, so parents always come first
+        return list(nodes.values()), finals
+
+    def runMatrix(self, opts):
+        """ ===============================================
+        Build a map with several build profiles at once
+        (build:debug,test,release). Identical stages are
+        run once and their outputs copied to every profile
+        that builds on them. Stages run in parallel up to
+        matrix_jobs. Each profile's result is deployed as
+        <map>_<profile>.bsp. The engine is not launched.
+        Profiles with nothing changed since their last
+        matrix build are left out unless force:yes is given.
+
+        Parameters
+        ----------
+        opts : dict
+            All command line options
+        =============================================== """
+        # Partial pipelines need the intermediates of a single build
+        if 'stages' in opts:
+            print("ERROR: stages: can not be used with matrix builds. Build the profiles one at a time")
+            sys.exit(1)
+
+        base_path = self.cfg.config['config']['base_path']
+        builders = [self.cfg.getProfile('builders', name) for name in opts['build'].split(',') if name]
+
+        try:
+            mmap = self.cfg.getProfile('maps', opts['map'])
+        except KeyError:
+            mmap = self.cfg.getDefaultProfile('maps')
+
+        try:
+            mod = self.cfg.getProfile('mods', opts['mod'])
+        except KeyError:
+            mod = self.cfg.getDefaultProfile('mods')
+
+        map_full_path = mmap['source']
+        if 'region' in opts:
+            map_full_path = self.writeRegionMap(map_full_path, opts['region'])
+        map_basename = os.path.splitext(os.path.basename(map_full_path))[0]
+        map_directory = os.path.dirname(map_full_path) + os.sep
+        os.chdir(map_directory)
+
+        if not mmap['dest']:
+            dest_directory = base_path + os.sep + mod['subdir'] + os.sep + "maps" + os.sep
+        else:
+            dest_directory = mmap['dest'] + os.sep
+
+        state_path = self.getStatePath(map_directory)
+
+        """ Dependency manifest ===========================
+        Every profile keeps its own manifest, so profiles
+        with nothing changed are left out of the matrix.
+        =============================================== """
+        manifests = {}
+        build_inputs = {}
+        build_settings = {}
+        stale = []
+        for builder in builders:
+            tools = [self.getTool(builder, stage) for stage in ['qbsp', 'vis', 'light']]
+            manifests[builder['name']] = QManifest(state_path + map_basename + "_" + builder['name'] + ".manifest.json")
+            build_inputs[builder['name']] = [map_full_path] + [tool['path'] for tool in tools] \
+                + self.getDependencies(map_full_path, tools[0]['args'], base_path, mod, manifests[builder['name']])
+            build_settings[builder['name']] = QManifest.hashSettings([[tool['path'], tool['args']] for tool in tools])
+            reason = manifests[builder['name']].isStale(build_inputs[builder['name']],
+                [dest_directory + map_basename + "_" + builder['name'] + ".bsp"], build_settings[builder['name']])
+            if 'force' in opts:
+                reason = "forced"
+            if reason:
+                print("Building " + map_basename + " with " + builder['name'] + " (" + reason + ")")
+                stale.append(builder)
+            else:
+                print("Nothing changed since last build of " + map_basename + " with " + builder['name'] + ". Skipping")
+        if not stale:
+            return
+        builders = stale
+
+        # What the tools are about to read. Outputs are stat'ed after.
+        input_entries = {builder['name']: manifests[builder['name']].snapshot(build_inputs[builder['name']])
+            for builder in builders}
+
+        nodes, finals = self.buildMatrix(builders, map_full_path, map_basename,
+            state_path + "matrix" + os.sep)
+
+        trace = QTrace(
+            opts.get('trace') == 'yes',
+            self.cfg.config['config'].get('report_path') or state_path + "reports",
+            map_basename,
+            {"map": map_basename, "build": opts['build']}
+        )
+        governor = QMemoryGovernor(
+            self.cfg.config['config'].get('memory_budget'),
+            self.cfg.config['config'].get('memory_default', '512M'),
+            state_path + map_basename + ".memory.json"
+        )
+        # Matrix builds run stages once per group of profiles, so their
+        # warnings do not line up with single builds. They keep their own index.
+        logs = QLogArchive(state_path + "logs" + os.sep + map_basename + "-matrix",
+            self.cfg.config['config'].get('log_keep', 50))
+        logs.prefix_lines = True
+        logs.start(",".join(builder['name'] for builder in builders))
+
+        report = QReport(
+            opts.get('report'),
+            self.cfg.config['config'].get('report_path') or state_path + "reports",
+            self.cfg.config['config'].get('prometheus_textfile'),
+            map_basename,
+            {"build": {"name": ",".join(builder['name'] for builder in builders), "profiles": builders},
+                "map": mmap, "mod": mod}
+        )
+
+        # Vis time is estimated from the .prt before each vis runs
+        vis_estimate = QVisEstimate(state_path + map_basename + ".vis.json",
+            self.cfg.config['config'].get('vis_rate'))
+        vis_lock = threading.Lock()
+
+        # remote:vis,light (or remote:yes) offloads stages to workers
+        remote_stages = opts.get('remote', '').split(',')
+        if 'yes' in remote_stages:
+            remote_stages = ['vis', 'light']
+
+        total = sum(len(builder['tools']) for builder in builders)
+        print("Matrix build of " + map_basename + ": " + str(len(nodes)) + " stages for "
+            + str(len(builders)) + " profiles (" + str(total - len(nodes)) + " shared)")
+
+        futures = {}
+
+        def runNode(node):
+            if node['parent'] is not None:
+                parent = futures[node['parent']['key']].result()
+                if parent['returncode'] != 0:
+                    return {'h': '-', 'm': '-', 's': 'failed', 'returncode': parent['returncode']}
+
+            shutil.rmtree(node['work_dir'], ignore_errors=True)
+            os.makedirs(node['work_dir'])
+            if node['parent'] is not None:
+                # Each branch gets its own copy of the upstream outputs
+                for ext in ['.bsp', '.prt']:
+                    src = node['parent']['work_dir'] + map_basename + ext
+                    if os.path.exists(src):
+                        shutil.copyfile(src, node['work_dir'] + map_basename + ext)
+
+            name = node['stage'] + "@" + ",".join(node['profiles'])
+            portals = None
+            if node['stage'] == 'vis':
+                with trace.span("portal analysis", "setup", stage=name):
+                    portals = QPortalFile(node['work_dir'] + map_basename + ".prt").analyze()
+                if portals:
+                    with vis_lock:
+                        print("Vis of " + ",".join(node['profiles']) + ":")
+                        action = self.checkVisBudget(node, portals, vis_estimate)
+                    portals['action'] = action
+                    report.document.setdefault('portals', {})[name] = portals
+                    if action == 'fail':
+                        # Stops the light of these profiles too
+                        return {'h': '-', 'm': '-', 's': 'over budget', 'returncode': 1}
+
+            report.stageStart(name, node['cmd'])
+            log = logs.stage(node['stage'], node['cmd'], name)
+
+            result = None
+            if node['stage'] in remote_stages:
+                # The profiles of a node share their args, any of them will do
+                result = self.runRemote(node['stage'], node['profiles'][0], node['tool']['args'],
+                    node['work_dir'], map_basename, log)
+
+            if result is None:
+                memory_settings = [node['tool']['path'], node['tool']['args']]
+                with trace.span("wait for memory", "setup", stage=name):
+                    governor.admit(node['stage'], memory_settings)
+                try:
+                    result = self.runTool(node['cmd'], node['tool'], governor, node['stage'],
+                        log, cwd=node['work_dir'])
+                finally:
+                    governor.release(node['stage'])
+                governor.learn(node['stage'], result, memory_settings)
+                if portals:
+                    with vis_lock:
+                        vis_estimate.learn(portals, node['tool']['args'], result)
+            report.stageStop(name, result)
+            # Offloaded stages go on a track of their worker
+            trace.add(node['stage'], "tool", result['started'], result['started'] + result['seconds'],
+                track="worker " + result['worker'] if 'worker' in result else None,
+                command=" ".join(node['cmd']), profiles=",".join(node['profiles']),
+                returncode=result['returncode'], worker=result.get('worker', 'local'))
+            return result
+
+        jobs = int(self.cfg.config['config'].get('matrix_jobs', 2))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="matrix") as pool:
+            # Submitted parents first, so a waiting child never blocks its parent
+            for node in nodes:
+                futures[node['key']] = pool.submit(runNode, node)
+            results = {key: future.result() for key, future in futures.items()}
+
+        logs.finish()
+
+        # Deploy every profile under its own name
+        deploy_started = time.time()
+        deployed = {}
+        packable = {}
+        for builder in builders:
+            final = finals[builder['name']]
+            if results[final['key']]['returncode'] != 0:
+                continue
+            # The nodes that built it, with the args they actually ran
+            chain = [final]
+            while chain[0]['parent'] is not None:
+                chain.insert(0, chain[0]['parent'])
+            for ext in ['.bsp', '.lit']:
+                src = final['work_dir'] + map_basename + ext
+                dest = dest_directory + map_basename + "_" + builder['name'] + ext
+                if os.path.exists(src):
+                    shutil.copyfile(src, dest)
+                elif os.path.exists(dest):
+                    # Left from an earlier build that made one
+                    os.remove(dest)
+                deployed["maps/" + map_basename + "_" + builder['name'] + ext] = dest
+                packable.setdefault(builder['name'], {})["maps/" + map_basename + ext] = dest
+            QBench.recordDeploy(state_path + map_basename + ".deploys.json",
+                dest_directory + map_basename + "_" + builder['name'] + ".bsp", builder['name'],
+                {node['stage']: node['tool']['args'] for node in chain})
+            # A vis downgraded to -fast does not match the profile, so the
+            # next build runs again
+            manifests[builder['name']].record(input_entries[builder['name']],
+                [dest_directory + map_basename + "_" + builder['name'] + ".bsp"],
+                QManifest.hashSettings([[node['tool']['path'], node['tool']['args']] for node in chain]))
+        trace.add("deploy", "deploy", deploy_started, time.time(), destination=dest_directory)
+
+        # Only the profile named by pak_build goes into the mod's pak, as
+        # <map>.bsp. Region compiles are scratch builds and stay out of it.
+        pak_build = mod.get('pak_build')
+        if mod.get('pak') and pak_build in packable:
+            if 'region' in opts:
+                print("Region compile, not packaging into " + mod['pak'])
+            else:
+                with trace.span("package", "deploy", pak=mod['pak']):
+                    pak = QPak(base_path + os.sep + mod['subdir'] + os.sep + mod['pak'], mod.get('pak_waste', '64M'))
+                    pak.update(packable[pak_build])
+        elif mod.get('pak') and pak_build:
+            print("No new " + pak_build + " build, not packaging into " + mod['pak'])
+        elif mod.get('pak'):
+            print("Not packaging into " + mod['pak'] + ". Set pak_build in the MOD profile to the profile that goes in")
+
+        print("\nQCruncher Matrix Report")
+        print("-----------------------------------------------")
+        print("Tool\tHrs\tMin\tSeconds\tProfiles\tArguments")
+        print("-----------------------------------------------")
+        for node in nodes:
+            result = results[node['key']]
+            print(node['stage'].upper()+":\t"+result['h']+"\t"+result['m']+"\t"+result['s']+"\t"
+                + ",".join(node['profiles'])+"\t"+" ".join(node['tool']['args']))
+
+        print("\nWarnings: " + logs.summary())
+        print("\nFinal Destination of bsp files: ")
+        for builder in builders:
+            if results[finals[builder['name']]['key']]['returncode'] == 0:
+                print(dest_directory + map_basename + "_" + builder['name'] + ".bsp")
+            else:
+                print("FAILED: " + builder['name'])
+
+        artifacts = {".map": map_full_path}
+        artifacts.update({name: path for name, path in deployed.items()})
+        report.finish(artifacts, dest_directory)
+        trace.write()
+
+    def runBuild(self, opts):
+        # print(opts)
+        """ ===============================================
+        Run the build process. This is it!
+
+        Parameters
+        ----------
+        opts : dict
+            All command line options
+        =============================================== """
+        # build:debug,test,release is a matrix build
+        if ',' in opts.get('build', ''):
+            self.runMatrix(opts)
+            sys.exit(0)
+
+        build_started = time.time()
+
+        # Get system paths
+        tool_path = self.cfg.config['config']['tool_path']
+        base_path = self.cfg.config['config']['base_path']
+
+        # Get Build Profile
+        try:
+            builder = self.cfg.getProfile('builders', opts['build'])
+        except KeyError:
+            print("Must specify valid build profile")
+            sys.exit(0)
+
+        # Get Map Profile
+        try:
+            mmap = self.cfg.getProfile('maps', opts['map'])
+        except KeyError:
+            mmap = self.cfg.getDefaultProfile('maps')
+
+        # Get engine Profile
+        try:
+            engine = self.cfg.getProfile('engines', opts['engine'])
+        except KeyError:
+            engine = self.cfg.getDefaultProfile('engines')
+
+        # Get Mod Profile
+        try:
+            mod = self.cfg.getProfile('mods', opts['mod'])
+        except KeyError:
+            mod = self.cfg.getDefaultProfile('mods')
+
+        """ Setup Paths =============================== """
+        # full path to .map file
+        map_full_path = mmap['source']
+
+        # Region compile. Build a sealed copy of just the region instead.
+        # Everything below works on the copy (awesomemap_rgn.map)
+        if 'region' in opts:
+            map_full_path = self.writeRegionMap(map_full_path, opts['region'])
+        
+        # name of the map with ext (awesomemap.map)
+        map_filename = os.path.basename(map_full_path)
+        
+        # name of map without ext (awesomemap)
+        map_basename  = os.path.splitext(map_filename)[0]
+
+        # name of map with .bsp ext (awesomemap.bsp)
+        map_bspname = map_basename+".bsp"
+
+        # Directory where the map lives (/path/to/)
+        map_directory = os.path.dirname(map_full_path)+os.sep
+
+        # Full path to .bsp file (/path/to/awesomemap.bsp)
+        bsp_full_path = map_directory + map_basename + ".bsp"
+
+        # Full path to .prt file (/path/to/awesomemap.prt)
+        prt_full_path = map_directory + map_basename + ".prt"
+
+        # Full path to .lit file (/path/to/awesomemap.lit)
+        lit_full_path = map_directory + map_basename + ".lit"
+        """ End Setup Paths =========================== """
+        
+        """ Handle output destination. If dest is specified in MAP profile
+        use that. If not specified in MAP profile, use MOD profile as output
+        =============================================== """
+        if not mmap['dest']:
+            bsp_destination = base_path + os.sep + mod['subdir'] + os.sep + "maps" + os.sep + map_basename + ".bsp"
+        else:
+            bsp_destination = mmap['dest'] + os.sep + map_basename + ".bsp"    
+
+        # Change into map_directory for generation of log files in build dir.
+        os.chdir(map_directory)
+
+        """ Create QBSP Command """
+        qbsp = self.getTool(builder, 'qbsp')
+        # Build command list for subprocess.run()
+        # executable + args + path_to_.map_fie
+        qbsp_cmd = [qbsp['path']] + qbsp['args'] + [map_full_path]
+
+        """ Create VIS Command """
+        vis = self.getTool(builder, 'vis')
+        # Build command list for subprocess.run()
+        # executable + args + path_to_.bsp_file
+        vis_cmd = [vis['path']] + vis['args'] + [bsp_full_path]
+
+        """ Create LIGHT Command """
+        light = self.getTool(builder, 'light')
+        # Build command list for subprocess.run()
+        # executable + args + path_to_.bsp_file
+        light_cmd = [light['path']] + light['args'] + [bsp_full_path]
+
+        """ Just about ready to run! ======================
+        Lets just check that all files are in place.
+        =============================================== """
+        # map file
+        try:
+            os.path.exists(map_full_path)
+        except FileNotFoundError:
+            print("ERROR: .map file not found: "+map_full_path)
+
+        # qbsp exe
+        try:
+            os.path.exists(qbsp['path'])
+        except FileNotFoundError:
+            print("ERROR: qbsp not found: "+qbsp['path'])
+
+        # vis exe
+        try:
+            os.path.exists(vis['path'])
+        except FileNotFoundError:
+            print("ERROR: vis not found: "+vis['path'])
+
+        # light exe
+        try:
+            os.path.exists(light['path'])
+        except FileNotFoundError:
+            print("Error: light not found: "+light['path'])
+
+        """ Build trace ===================================
+        trace:yes writes a trace-event timeline of the build
+        for Perfetto or chrome://tracing.
+        =============================================== """
+        trace = QTrace(
+            opts.get('trace') == 'yes',
+            self.cfg.config['config'].get('report_path') or self.getStatePath(map_directory) + "reports",
+            map_basename,
+            {"map": map_basename, "build": builder['name']}
+        )
+        trace.add("config load", "setup", *self.config_load_time)
+        trace.add("resolve paths", "setup", build_started, time.time())
+
+        """ Dependency manifest ===========================
+        Skip the compile when nothing the build depends on
+        changed since the last successful build. force:yes
+        builds anyway.
+        =============================================== """
+        manifest = QManifest(self.getStatePath(map_directory) + map_basename + ".manifest.json")
+        build_outputs = [bsp_full_path]
+        build_settings = QManifest.hashSettings([qbsp_cmd, vis_cmd, light_cmd])
+
+        with trace.span("dependency check", "setup"):
+            build_inputs = [map_full_path, qbsp['path'], vis['path'], light['path']]
+            build_inputs += self.getDependencies(map_full_path, qbsp['args'], base_path, mod, manifest)
+            stale = manifest.isStale(build_inputs, build_outputs, build_settings)
+        if 'force' in opts:
+            stale = "forced"
+
+        """ Build report ==================================
+        Collects everything about this build. report:json
+        and report:ndjson write it out for build farms.
+        =============================================== """
+        report = QReport(
+            opts.get('report'),
+            self.cfg.config['config'].get('report_path') or self.getStatePath(map_directory) + "reports",
+            self.cfg.config['config'].get('prometheus_textfile'),
+            map_basename,
+            {"build": builder, "map": mmap, "engine": engine, "mod": mod}
+        )
+
+        stages = [
+            {"name": "qbsp", "label": "QBSP:", "tool": qbsp, "cmd": qbsp_cmd},
+            {"name": "vis", "label": "VIS :", "tool": vis, "cmd": vis_cmd},
+            {"name": "light", "label": "LIGHT:", "tool": light, "cmd": light_cmd}
+        ]
+        stage_names = [stage['name'] for stage in stages]
+
+        """ Partial pipeline ==============================
+        stages:vis,light only runs those stages on the .bsp
+        and .prt left by the last build. They are checked
+        against the current .map, WADs, tools and upstream
+        args first. Stale intermediates are refused unless
+        force:yes is given.
+        =============================================== """
+        selected = stage_names
+        consistent = True
+        build_ok = True
+        stage_keys = {}
+        if stale or 'stages' in opts:
+            stage_keys = self.getStageKeys(stages, build_inputs, manifest)
+
+        if 'stages' in opts:
+            selected = opts['stages'].split(',')
+            first = stage_names.index(selected[0]) if selected[0] in stage_names else -1
+            if first < 0 or selected != stage_names[first:first + len(selected)]:
+                print("ERROR: stages must be in order without gaps, like stages:vis,light")
+                sys.exit(1)
+
+            needed = [bsp_full_path] if first > 0 else []
+            if 'vis' in selected and first > 0:
+                needed.append(prt_full_path)
+            problems = manifest.checkIntermediates(stage_names[:first], stage_keys, needed)
+            if problems:
+                consistent = False
+                for problem in problems:
+                    print("Stale intermediate: " + problem)
+                if 'force' not in opts:
+                    print("Refusing to run stages:" + opts['stages'] + ". Run the full build or add force:yes")
+                    sys.exit(1)
+                print("WARNING: running stages on stale intermediates (force:yes)")
+            stale = "stages " + ",".join(selected)
+
+        if stale:
+            print("Building " + map_basename + " (" + stale + ")")
+
+            # What the tools are about to read. Outputs are stat'ed after.
+            input_entries = manifest.snapshot(build_inputs)
+
+            governor = QMemoryGovernor(
+                self.cfg.config['config'].get('memory_budget'),
+                self.cfg.config['config'].get('memory_default', '512M'),
+                self.getStatePath(map_directory) + map_basename + ".memory.json"
+            )
+
+            logs = QLogArchive(
+                self.getStatePath(map_directory) + "logs" + os.sep + map_basename,
+                self.cfg.config['config'].get('log_keep', 50)
+            )
+            logs.start(builder['name'], selected)
+
+            # Vis time is estimated from the .prt before vis runs
+            vis_estimate = QVisEstimate(
+                self.getStatePath(map_directory) + map_basename + ".vis.json",
+                self.cfg.config['config'].get('vis_rate')
+            )
+            portals = None
+
+            # remote:vis,light (or remote:yes) offloads stages to workers
+            remote_stages = opts.get('remote', '').split(',')
+            if 'yes' in remote_stages:
+                remote_stages = ['vis', 'light']
+
+            # Run QBSP, VIS, LIGHT
+            for stage in stages:
+                if stage['name'] not in selected:
+                    stage['time'] = {'h': '-', 'm': '-', 's': 'skipped', 'returncode': 0}
+                    report.stageSkipped(stage['name'], stage['cmd'])
+                    continue
+
+                if stage['name'] == 'vis':
+                    with trace.span("portal analysis", "setup"):
+                        portals = QPortalFile(prt_full_path).analyze()
+                    if portals:
+                        action = self.checkVisBudget(stage, portals, vis_estimate)
+                        portals['action'] = action
+                        report.document['portals'] = portals
+                        if action == 'fail':
+                            logs.finish()
+                            trace.write()
+                            sys.exit(1)
+                        if action == 'fast':
+                            # The .bsp is not what the profile asks for. Record what
+                            # actually ran so the next build does not skip.
+                            stage_keys = self.getStageKeys(stages, build_inputs, manifest)
+                            build_settings = QManifest.hashSettings([stage['cmd'] for stage in stages])
+
+                report.stageStart(stage['name'], stage['cmd'])
+                log = logs.stage(stage['name'], stage['cmd'])
+
+                stage['time'] = None
+                if stage['name'] in remote_stages:
+                    stage['time'] = self.runRemote(stage['name'], builder['name'], stage['tool']['args'],
+                        map_directory, map_basename, log)
+
+                if stage['time'] is None:
+                    memory_settings = [stage['tool']['path'], stage['tool']['args']]
+                    with trace.span("wait for memory", "setup", stage=stage['name']):
+                        governor.admit(stage['name'], memory_settings)
+                    try:
+                        stage['time'] = self.runTool(stage['cmd'], stage['tool'], governor, stage['name'], log)
+                    finally:
+                        governor.release(stage['name'])
+                    governor.learn(stage['name'], stage['time'], memory_settings)
+                    if stage['name'] == 'vis' and portals:
+                        vis_estimate.learn(portals, stage['tool']['args'], stage['time'])
+                report.stageStop(stage['name'], stage['time'])
+
+                # Remember what produced the intermediates for stages:
+                if stage['time']['returncode'] == 0:
+                    manifest.recordStage(stage['name'], stage_keys[stage['name']], stage_names, bsp_full_path)
+                else:
+                    manifest.clearStages(stage['name'], stage_names)
+
+                trace.add(stage['name'], "tool", stage['time']['started'],
+                    stage['time']['started'] + stage['time']['seconds'],
+                    track="worker " + stage['time']['worker'] if 'worker' in stage['time'] else None,
+                    command=" ".join(stage['cmd']), returncode=stage['time']['returncode'],
+                    worker=stage['time'].get('worker', 'local'))
+
+            logs.finish()
+            print("\nWarnings: " + logs.summary())
+
+            returncodes = [stage['time']['returncode'] for stage in stages]
+            build_ok = returncodes == [0, 0, 0] and consistent and os.path.exists(bsp_full_path)
+            if build_ok:
+                manifest.record(input_entries, build_outputs, build_settings)
+        else:
+            print("Nothing changed since last build of " + map_basename + ". Skipping compile")
+            report.skipped = True
+            for stage in stages:
+                stage['time'] = {'h': '-', 'm': '-', 's': 'skipped', 'returncode': 0}
+                report.stageSkipped(stage['name'], stage['cmd'])
+
+        # Move bsp file to final destination
+        deploy_started = time.time()
+        try:
+            os.remove(bsp_destination)
+        except OSError:
+            pass
+
+        try:
+            shutil.copy(bsp_full_path, bsp_destination)
+        except FileNotFoundError:
+            print("shit")
+        else:
+            # Remembered for bench:, which may run after the profile changed
+            QBench.recordDeploy(self.getStatePath(map_directory) + map_basename + ".deploys.json",
+                bsp_destination, builder['name'], {stage['name']: stage['tool']['args'] for stage in stages})
+        trace.add("deploy", "deploy", deploy_started, time.time(), destination=bsp_destination)
+
+        # Package into the mod's pak if the MOD profile has one. Region
+        # compiles are scratch builds and stay out of it, and so are
+        # failed builds and builds on stale intermediates.
+        if mod.get('pak') and 'region' in opts:
+            print("Region compile, not packaging into " + mod['pak'])
+        elif mod.get('pak') and not build_ok:
+            print("Build failed or used stale intermediates, not packaging into " + mod['pak'])
+        elif mod.get('pak') and mod.get('pak_build', builder['name']) != builder['name']:
+            print("Only " + mod['pak_build'] + " builds are packaged into " + mod['pak'])
+        elif mod.get('pak'):
+            with trace.span("package", "deploy", pak=mod['pak']):
+                pak = QPak(base_path + os.sep + mod['subdir'] + os.sep + mod['pak'], mod.get('pak_waste', '64M'))
+                pak.update({
+                    "maps/" + map_basename + ".bsp": bsp_full_path,
+                    "maps/" + map_basename + ".lit": lit_full_path
+                })
+
+        # Done Compiling. Check stats on files generated
+        map_fs = self.getFileStats(map_full_path)
+        bsp_fs = self.getFileStats(bsp_full_path)
+        prt_fs = self.getFileStats(prt_full_path)
+        lit_fs = self.getFileStats(lit_full_path)
+
+        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        print("\nQCruncher File Report @\t"+current_time)
+        print("-----------------------------------------------")
+        print("File\tExists\t\tSize\tCreate Date/time")
+        print("-----------------------------------------------")
+        print(".map\t"+map_fs['exists']+"\t\t"+map_fs['size']+"\t"+map_fs['time'])
+        print(".bsp\t"+bsp_fs['exists']+"\t\t"+bsp_fs['size']+"\t"+bsp_fs['time'])
+        print(".prt\t"+prt_fs['exists']+"\t\t"+prt_fs['size']+"\t"+prt_fs['time'])
+        print(".lit\t"+lit_fs['exists']+"\t\t"+lit_fs['size']+"\t"+lit_fs['time'])
+
+        print("\nQCruncher Tools Report")
+        print("-----------------------------------------------")
+        print("Tool\tHrs\tMin\tSeconds\tArguments")
+        print("-----------------------------------------------")
+        for stage in stages:
+            print(stage['label']+"\t"+stage['time']['h']+"\t"+stage['time']['m']+"\t"+stage['time']['s']+"\t"+" ".join(stage['tool']['args']))
+
+        report.finish(
+            {".map": map_full_path, ".bsp": bsp_full_path, ".prt": prt_full_path, ".lit": lit_full_path},
+            bsp_destination
+        )
+        trace.write()
+
+        print("\nFinal Destination of bsp file: ")
+        try:
+            os.path.exists(bsp_destination)
+            print(bsp_destination)
+        except FileNotFoundError:
+            print("ERROR: .bsp file did not make it to final destination: "+bsp_destination)
+
+        # Run QUAKE!!!
+
+        # Check for --nogame
+
+
+        # Hot reload. If an engine session is running for this engine,
+        # load the new map into it instead of launching the engine again.
+        session = QEngineSession(self.getSessionFile(base_path))
+        if session.isRunning(engine['name']):
+            with trace.span("engine reload", "engine", engine=engine['name']):
+                reloaded = session.loadMap(map_basename, mod['subdir'])
+            if reloaded:
+                print("Loaded " + map_basename + " into running " + engine['name'] + " session")
+                trace.write()
+                sys.exit(0)
+            print("Engine session is not answering. Launching engine")
+
+        engine_exe = self.getEngineCommand(engine, base_path, mod)
+
+        # Add Map
+        engine_exe = engine_exe + ['+map', map_basename]
+        with trace.span("engine", "engine", engine=engine['name']):
+            subprocess.run(engine_exe)
+        trace.write()
+        sys.exit(0)
+
+""" =================================== MAP FILE ==============================
+=========================================================================== """
+class QMapFile:
+    """
+    Minimal reader for Quake .map source files
+    ...
+    Attributes
+    ----------
+    map_path : str
+        Full path to the .map file
+    entities : list
+        List of entities in file order. Each entity is a dict with a 'keys'
+        list of (key, value) tuples.
+
+    Methods
+    -------
+    read()
+        Parse the .map file into entities
+    getValue(entity, key)
+        Get the value of a key on an entity
+    getDependencies(search_paths)
+        List the external files (WADs, external maps) the map uses
+    """
+    def __init__(self, map_path):
+        """ QMapFile Init ====================== """
+        self.map_path = map_path
+        self.entities = []
+        self.read()
+
+    def read(self):
+        """ ===============================================
+        Parse the .map file into self.entities. Brushes are
+        kept as the raw lines of their planes.
+        =============================================== """
+        self.entities = []
+        depth = 0
+        entity = None
+        brush = None
+        try:
+            map_file = open(self.map_path, errors='replace')
+        except FileNotFoundError:
+            print("ERROR: .map file not found: "+self.map_path)
+            return
+
+        with map_file:
+            for line in map_file:
+                line = line.strip()
+                if not line or line.startswith('//'):
+                    continue
+                if line == '{':
+                    depth += 1
+                    if depth == 1:
+                        entity = {'keys': [], 'brushes': []}
+                    elif depth == 2:
+                        brush = []
+                elif line == '}':
+                    depth -= 1
+                    if depth == 0:
+                        self.entities.append(entity)
+                    elif depth == 1:
+                        entity['brushes'].append(brush)
+                elif depth == 1:
+                    pair = re.match(r'^"([^"]*)"\s+"([^"]*)"', line)
+                    if pair:
+                        entity['keys'].append((pair.group(1), pair.group(2)))
+                elif depth == 2:
+                    brush.append(line)
+
+    def getValue(self, entity, key):
+        """ ===============================================
+        Get the value of a key on an entity
+
+        Parameters
+        ----------
+        entity : dict
+            Entity from self.entities
+        key : str
+            Name of the key
+
+        Returns
+        -------
+        str
+            Value of the key. None if the key is not set.
+        =============================================== """
+        for k, v in entity['keys']:
+            if k == key:
+                return v
+        return None
+
+    def resolvePath(self, name, search_paths):
+        """ ===============================================
+        Find a file referenced by the map. Tries the name
+        as given, then relative to each search path, then
+        just the file name in each search path.
+
+        Parameters
+        ----------
+        name : str
+            File name as written in the .map file
+        search_paths : list
+            Directories to look in, in order
+
+        Returns
+        -------
+        str
+            Full path to the file. If it can not be found the
+            path relative to the first search path is returned
+            so it can still be tracked.
+        =============================================== """
+        name = name.replace('\\', os.sep).replace('/', os.sep)
+        if os.path.isabs(name) and os.path.exists(name):
+            return name
+
+        relative = name.lstrip(os.sep)
+        for search_path in search_paths:
+            for candidate in [relative, os.path.basename(relative)]:
+                full_path = os.path.join(search_path, candidate)
+                if os.path.exists(full_path):
+                    return os.path.abspath(full_path)
+
+        return os.path.abspath(os.path.join(search_paths[0], relative))
+
+    def getDependencies(self, search_paths, seen=None):
+        """ ===============================================
+        List the files this map depends on besides itself.
+        WADs from the worldspawn 'wad' key and maps pulled
+        in with '_external_map'. External maps are read
+        as well so their WADs are included.
+
+        Parameters
+        ----------
+        search_paths : list
+            Directories to look for the files in
+        seen : set
+            Paths already visited. Used for recursion.
+
+        Returns
+        -------
+        list
+            Full paths to every dependency
+        =============================================== """
+        if seen is None:
+            seen = set([os.path.abspath(self.map_path)])
+
+        deps = []
+        for entity in self.entities:
+            if self.getValue(entity, 'classname') == 'worldspawn':
+                wads = self.getValue(entity, 'wad') or ''
+                for wad in wads.split(';'):
+                    if wad.strip():
+                        deps.append(self.resolvePath(wad.strip(), search_paths))
+
+            external = self.getValue(entity, '_external_map')
+            if external:
+                external_path = self.resolvePath(external, search_paths)
+                deps.append(external_path)
+                if external_path not in seen:
+                    seen.add(external_path)
+                    deps += QMapFile(external_path).getDependencies(search_paths, seen)
+
+        # Keep order but drop duplicates
+        return list(dict.fromkeys(deps))
+
+    @staticmethod
+    def brushBounds(brush):
+        """ ===============================================
+        Calculate the bounding box of a brush. Every three
+        planes are intersected and the points inside all
+        other planes are the brush vertices.
+
+        Parameters
+        ----------
+        brush : list
+            Plane lines of the brush
+
+        Returns
+        -------
+        tuple
+            (mins, maxs) lists of x,y,z. None if the brush
+            has no volume.
+        =============================================== """
+        planes = []
+        for line in brush:
+            points = re.findall(r'\(([^()]*)\)', line)[:3]
+            if len(points) < 3:
+                continue
+            p0, p1, p2 = [[float(c) for c in p.split()] for p in points]
+            # Quake plane from three points. Normal faces out of the brush
+            t1 = [p0[i] - p1[i] for i in range(3)]
+            t2 = [p2[i] - p1[i] for i in range(3)]
+            normal = [
+                t1[1] * t2[2] - t1[2] * t2[1],
+                t1[2] * t2[0] - t1[0] * t2[2],
+                t1[0] * t2[1] - t1[1] * t2[0]
+            ]
+            length = sum(n * n for n in normal) ** 0.5
+            if length == 0:
+                continue
+            normal = [n / length for n in normal]
+            planes.append((normal, sum(normal[i] * p1[i] for i in range(3))))
+
+        verts = []
+        for i in range(len(planes)):
+            for j in range(i + 1, len(planes)):
+                for k in range(j + 1, len(planes)):
+                    (a, da), (b, db), (c, dc) = planes[i], planes[j], planes[k]
+                    # Cramer's rule on the three plane equations
+                    bc = [b[1] * c[2] - b[2] * c[1], b[2] * c[0] - b[0] * c[2], b[0] * c[1] - b[1] * c[0]]
+                    det = sum(a[n] * bc[n] for n in range(3))
+                    if abs(det) < 1e-9:
+                        continue
+                    ca = [c[1] * a[2] - c[2] * a[1], c[2] * a[0] - c[0] * a[2], c[0] * a[1] - c[1] * a[0]]
+                    ab = [a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0]]
+                    point = [(da * bc[n] + db * ca[n] + dc * ab[n]) / det for n in range(3)]
+                    if all(sum(n[m] * point[m] for m in range(3)) <= d + 0.01 for n, d in planes):
+                        verts.append(point)
+
+        if not verts:
+            return None
+        return (
+            [min(v[n] for v in verts) for n in range(3)],
+            [max(v[n] for v in verts) for n in range(3)]
+        )
+
+    @staticmethod
+    def boxBrush(mins, maxs, texture, valve220=False):
+        """ ===============================================
+        Create an axis aligned box brush
+
+        Parameters
+        ----------
+        mins : list
+            Lowest x,y,z corner
+        maxs : list
+            Highest x,y,z corner
+        texture : str
+            Texture name for every face
+        valve220 : bool
+            Write texture axes for Valve 220 format maps
+
+        Returns
+        -------
+        list
+            Plane lines of the brush
+        =============================================== """
+        x0, y0, z0 = [int(c) for c in mins]
+        x1, y1, z1 = [int(c) for c in maxs]
+        faces = [
+            ((x0, y0, z0), (x0, y0 + 1, z0), (x0, y0, z0 + 1), "[ 0 1 0 0 ] [ 0 0 -1 0 ]"),
+            ((x1, y1, z1), (x1, y1, z1 + 1), (x1, y1 + 1, z1), "[ 0 1 0 0 ] [ 0 0 -1 0 ]"),
+            ((x0, y0, z0), (x0, y0, z0 + 1), (x0 + 1, y0, z0), "[ 1 0 0 0 ] [ 0 0 -1 0 ]"),
+            ((x1, y1, z1), (x1 + 1, y1, z1), (x1, y1, z1 + 1), "[ 1 0 0 0 ] [ 0 0 -1 0 ]"),
+            ((x0, y0, z0), (x0 + 1, y0, z0), (x0, y0 + 1, z0), "[ 1 0 0 0 ] [ 0 -1 0 0 ]"),
+            ((x1, y1, z1), (x1, y1 + 1, z1), (x1 + 1, y1, z1), "[ 1 0 0 0 ] [ 0 -1 0 0 ]")
+        ]
+        brush = []
+        for p0, p1, p2, axes in faces:
+            points = " ".join("( %d %d %d )" % p for p in (p0, p1, p2))
+            if valve220:
+                brush.append(points + " " + texture + " " + axes + " 0 1 1")
+            else:
+                brush.append(points + " " + texture + " 0 0 0 1 1")
+        return brush
+
+    # Textures that do not make a solid wall. A hull of them leaks or
+    # turns the region into sky or clip.
+    special_textures = ('*', 'sky', 'clip', 'skip', 'trigger', 'hint', 'origin', 'nodraw')
+    # Player bounding box around its origin
+    player_mins = (-16, -16, -24)
+    player_maxs = (16, 16, 32)
+
+    @staticmethod
+    def faceTexture(line):
+        """ ===============================================
+        Texture name of a brush plane line
+        =============================================== """
+        fields = re.sub(r'^.*\)\s*', '', line).split()
+        return fields[0] if fields else None
+
+    def findStart(self, mins, maxs, solids):
+        """ ===============================================
+        Find a spot in the region where the player fits
+        without touching a brush. The middle of the box is
+        tried first, then spots further away from it.
+
+        Parameters
+        ----------
+        mins : list
+            Lowest x,y,z corner of the region
+        maxs : list
+            Highest x,y,z corner of the region
+        solids : list
+            (mins, maxs) bounds of the solid brushes
+
+        Returns
+        -------
+        list
+            x,y,z of the spot. None if there is no room.
+        =============================================== """
+        lo = [mins[n] - self.player_mins[n] for n in range(3)]
+        hi = [maxs[n] - self.player_maxs[n] for n in range(3)]
+        if any(lo[n] > hi[n] for n in range(3)):
+            return None
+
+        center = [(mins[n] + maxs[n]) / 2 for n in range(3)]
+        axes = []
+        for n in range(3):
+            steps = max(1, min(16, int((hi[n] - lo[n]) // 16)))
+            axes.append([lo[n] + (hi[n] - lo[n]) * i / steps for i in range(steps + 1)])
+        candidates = [[min(max(center[n], lo[n]), hi[n]) for n in range(3)]]
+        candidates += sorted(([x, y, z] for x in axes[0] for y in axes[1] for z in axes[2]),
+            key=lambda point: sum((point[n] - center[n]) ** 2 for n in range(3)))
+
+        for point in candidates:
+            box_min = [point[n] + self.player_mins[n] for n in range(3)]
+            box_max = [point[n] + self.player_maxs[n] for n in range(3)]
+            if not any(all(bounds[0][n] < box_max[n] and bounds[1][n] > box_min[n] for n in range(3))
+                    for bounds in solids):
+                return [int(c) for c in point]
+        return None
+
+    def writeRegion(self, region_path, mins, maxs):
+        """ ===============================================
+        Write a copy of the map with only the brushes and
+        entities inside the region box. The region is sealed
+        with a hull of 16 unit thick brushes so it compiles
+        without leaking. An info_player_start is added where
+        the player fits, as close to the middle of the region
+        as possible, if there is none inside.
+
+        Parameters
+        ----------
+        region_path : str
+            Path to write the region .map to
+        mins : list
+            Lowest x,y,z corner of the region
+        maxs : list
+            Highest x,y,z corner of the region
+
+        Returns
+        -------
+        bool
+            False if there is no room for the player start,
+            nothing is written then.
+        =============================================== """
+        def touches(bounds):
+            return bounds is not None and all(
+                bounds[0][n] <= maxs[n] and bounds[1][n] >= mins[n] for n in range(3))
+
+        def inside(origin):
+            return all(mins[n] <= origin[n] <= maxs[n] for n in range(3))
+
+        region = []
+        texture = None
+        has_start = False
+        solids = []
+        for entity in self.entities:
+            brushes = []
+            for brush in entity['brushes']:
+                bounds = self.brushBounds(brush)
+                if touches(bounds):
+                    brushes.append((brush, bounds))
+            classname = self.getValue(entity, 'classname')
+            origin = self.getValue(entity, 'origin')
+
+            if classname == 'worldspawn':
+                region.append({'keys': entity['keys'], 'brushes': [brush for brush, _ in brushes]})
+            elif entity['brushes']:
+                # Brush entities are kept whole if any brush is in the region
+                if not brushes:
+                    continue
+                region.append(entity)
+            elif origin and inside([float(c) for c in origin.split()]):
+                region.append(entity)
+                has_start = has_start or classname == 'info_player_start'
+            else:
+                continue
+
+            for brush, bounds in brushes:
+                textures = [self.faceTexture(line) for line in brush]
+                if any(name and name.lower().startswith(self.special_textures) for name in textures):
+                    # Triggers, clip and the like do not block the player
+                    continue
+                solids.append(bounds)
+                if texture is None and textures and textures[0]:
+                    texture = textures[0]
+
+        if not region or self.getValue(region[0], 'classname') != 'worldspawn':
+            region.insert(0, {'keys': [('classname', 'worldspawn')], 'brushes': []})
+
+        if not has_start:
+            start = self.findStart(mins, maxs, solids)
+            if start is None:
+                return False
+            region.append({'keys': [('classname', 'info_player_start'), ('origin', " ".join(str(c) for c in start))],
+                'brushes': []})
+
+        # Seal the region with a hull just outside the box
+        valve220 = self.getValue(region[0], 'mapversion') == '220'
+        lo = [c - 16 for c in mins]
+        hi = [c + 16 for c in maxs]
+        for axis in range(3):
+            for side in (0, 1):
+                slab_min = list(lo)
+                slab_max = list(hi)
+                if side == 0:
+                    slab_max[axis] = mins[axis]
+                else:
+                    slab_min[axis] = maxs[axis]
+                region[0]['brushes'].append(
+                    self.boxBrush(slab_min, slab_max, texture or 'wall', valve220))
+
+        with open(region_path, 'w') as region_file:
+            for e_idx, entity in enumerate(region):
+                region_file.write("// entity " + str(e_idx) + "\n{\n")
+                for key, value in entity['keys']:
+                    region_file.write('"' + key + '" "' + value + '"\n')
+                for b_idx, brush in enumerate(entity['brushes']):
+                    region_file.write("// brush " + str(b_idx) + "\n{\n")
+                    region_file.write("\n".join(brush) + "\n}\n")
+                region_file.write("}\n")
+        return True
+
+
+""" =================================== MANIFEST ==============================
+=========================================================================== """
+class QManifest:
+    """
+    Dependency manifest of a map build. Records path, size, mtime and
+    hash of every input and output so the next build can tell if anything
+    changed.
+    ...
+    Attributes
+    ----------
+    manifest_path : str
+        Path to the json file the manifest is stored in
+    manifest : dict
+        Settings hash, inputs and outputs of the last successful build
+
+    Methods
+    -------
+    fileHash(file_path)
+        Hash of a file, reusing hashes already taken this run
+    inputHash(file_path)
+        Hash of an input, reusing its entry of the last build
+    cachedDependencies(map_path, search_paths)
+        Dependencies of the map from the last build if it did not change
+    isStale(inputs, outputs, settings)
+        Check if a build with these inputs needs to run
+    snapshot(paths)
+        Take manifest entries of files before a build reads them
+    record(inputs, outputs, settings)
+        Record the state of a successful build
+    """
+    # Path to (size, mtime, hash) of files hashed or checked this run.
+    # Shared by all manifests, so matrix profiles hash a WAD once.
+    hashes = {}
+
+    def __init__(self, manifest_path):
+        """ QManifest Init ===================== """
+        self.manifest_path = manifest_path
+        self.manifest = {"settings": None, "inputs": {}, "outputs": {}}
+        self.touched = False
+        self.read()
+
+    def read(self):
+        """ ===============================================
+        Read the manifest from disk. A missing or broken
+        manifest just means everything is stale.
+        =============================================== """
+        try:
+            with open(self.manifest_path) as manifest_json:
+                self.manifest = json.load(manifest_json)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def save(self):
+        """ ===============================================
+        Save the manifest to disk
+        =============================================== """
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        with open(self.manifest_path, 'w') as manifest_json:
+            json.dump(self.manifest, manifest_json, indent=2, separators=(',', ': '))
+
+    @staticmethod
+    def hashFile(file_path):
+        """ ===============================================
+        Hash a file in chunks so big WADs and BSPs are not
+        loaded into memory.
+
+        Parameters
+        ----------
+        file_path : str
+            Path to the file
+
+        Returns
+        -------
+        str
+            sha1 hex digest of the file
+        =============================================== """
+        sha = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    @classmethod
+    def fileHash(cls, file_path):
+        """ ===============================================
+        Hash a file unless it was already hashed (or found
+        unchanged against its manifest entry) this run and
+        its size and mtime are still the same.
+
+        Returns
+        -------
+        str
+            sha1 hex digest of the file
+        =============================================== """
+        fs = os.stat(file_path)
+        cached = cls.hashes.get(file_path)
+        if cached and cached[0] == fs.st_size and cached[1] == fs.st_mtime_ns:
+            return cached[2]
+        digest = cls.hashFile(file_path)
+        cls.hashes[file_path] = (fs.st_size, fs.st_mtime_ns, digest)
+        return digest
+
+    @staticmethod
+    def hashSettings(settings):
+        """ ===============================================
+        Hash anything json serializable. Used for the tool
+        commands so changing args triggers a rebuild.
+
+        Returns
+        -------
+        str
+            sha1 hex digest of the settings
+        =============================================== """
+        return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+    def entryFor(self, file_path):
+        """ ===============================================
+        Create a manifest entry for a file
+
+        Returns
+        -------
+        dict
+            size, mtime and hash of the file. Only 'exists'
+            False if the file is missing.
+        =============================================== """
+        try:
+            fs = os.stat(file_path)
+        except OSError:
+            return {"exists": False}
+
+        return {
+            "exists": True,
+            "size": fs.st_size,
+            "mtime": fs.st_mtime_ns,
+            "hash": self.fileHash(file_path)
+        }
+
+    def entryChanged(self, file_path, entry):
+        """ ===============================================
+        Check a file against its manifest entry. Stats the
+        file first and only hashes it when size or mtime
+        look different. If the hash still matches the entry
+        is refreshed with the new stat.
+
+        Returns
+        -------
+        bool
+            True if the file changed
+        =============================================== """
+        try:
+            fs = os.stat(file_path)
+        except OSError:
+            return entry.get('exists', False)
+
+        if not entry.get('exists', False):
+            return True
+
+        if fs.st_size == entry['size'] and fs.st_mtime_ns == entry['mtime']:
+            # Later stage keys and snapshots use this instead of hashing
+            self.hashes[file_path] = (fs.st_size, fs.st_mtime_ns, entry['hash'])
+            return False
+
+        if fs.st_size != entry['size']:
+            return True
+
+        if self.fileHash(file_path) != entry['hash']:
+            return True
+
+        # Touched but not changed. Remember the new mtime
+        entry['mtime'] = fs.st_mtime_ns
+        self.touched = True
+        return False
+
+    def isStale(self, inputs, outputs, settings):
+        """ ===============================================
+        Check if a build needs to run
+
+        Parameters
+        ----------
+        inputs : list
+            Paths to every input of the build
+        outputs : list
+            Paths to every output of the build
+        settings : str
+            Hash of the build settings (see hashSettings)
+
+        Returns
+        -------
+        str
+            Reason the build is stale. False if nothing changed
+        =============================================== """
+        if self.manifest.get('settings') != settings:
+            return "build settings changed"
+
+        for group, paths in [('inputs', inputs), ('outputs', outputs)]:
+            recorded = self.manifest.get(group, {})
+            if set(recorded.keys()) != set(paths):
+                return group + " list changed"
+            for path in paths:
+                if self.entryChanged(path, recorded[path]):
+                    return "changed: " + path
+
+        if self.touched:
+            self.save()
+        return False
+
+    def inputHash(self, file_path):
+        """ ===============================================
+        Hash of an input. Taken from its entry of the last
+        build when size and mtime still match, so a stale
+        build only hashes the files that changed.
+
+        Returns
+        -------
+        str
+            sha1 hex digest of the file. None if it is missing.
+        =============================================== """
+        if not os.path.isfile(file_path):
+            return None
+        entry = self.manifest.get('inputs', {}).get(file_path)
+        if entry:
+            # Remembers the hash when the stat matches
+            self.entryChanged(file_path, entry)
+        return self.fileHash(file_path)
+
+    def cachedDependencies(self, map_path, search_paths):
+        """ ===============================================
+        Dependencies of the map found by the last build. Only
+        used when the map and the maps it pulls in did not
+        change, the search paths are the same and every
+        dependency still exists.
+
+        Parameters
+        ----------
+        map_path : str
+            Full path to the .map file
+        search_paths : list
+            Directories the dependencies were looked up in
+
+        Returns
+        -------
+        list
+            Full paths to every dependency. None if the map
+            has to be read again.
+        =============================================== """
+        cached = self.manifest.get('dependencies')
+        if not cached or cached['search_paths'] != search_paths or map_path not in cached['maps']:
+            return None
+        for path, entry in cached['maps'].items():
+            if self.entryChanged(path, entry):
+                return None
+        if not all(os.path.exists(path) for path in cached['list']):
+            return None
+        return cached['list']
+
+    def cacheDependencies(self, map_path, search_paths, dependencies):
+        """ ===============================================
+        Remember the dependencies of a map. Saved with the
+        next record, recordStage or up to date isStale.
+        =============================================== """
+        maps = [map_path] + [path for path in dependencies if path.lower().endswith('.map')]
+        self.manifest['dependencies'] = {
+            "search_paths": search_paths,
+            "maps": {path: self.entryFor(path) for path in maps},
+            "list": dependencies
+        }
+        self.touched = True
+
+    def snapshot(self, paths):
+        """ ===============================================
+        Take the entries of the inputs before the tools run.
+        A file saved while the build runs then differs from
+        what is recorded and the next build picks it up.
+
+        Parameters
+        ----------
+        paths : list
+            Paths to every input of the build
+
+        Returns
+        -------
+        dict
+            Path to manifest entry
+        =============================================== """
+        return {path: self.entryFor(path) for path in paths}
+
+    def record(self, inputs, outputs, settings):
+        """ ===============================================
+        Record the state of a successful build and save it
+
+        Parameters
+        ----------
+        inputs : dict
+            Entries of every input taken before the build
+            (see snapshot)
+        outputs : list
+            Paths to every output of the build
+        settings : str
+            Hash of the build settings (see hashSettings)
+        =============================================== """
+        self.manifest = {
+            "settings": settings,
+            "inputs": inputs,
+            "outputs": {path: self.entryFor(path) for path in outputs},
+            "stages": self.manifest.get('stages', {}),
+            "intermediate": self.manifest.get('intermediate'),
+            "dependencies": self.manifest.get('dependencies')
+        }
+        self.save()
+
+    def recordStage(self, stage, key, order, bsp_path):
+        """ ===============================================
+        Record that a stage ran successfully and the state
+        of the .bsp it left. Stages after it are forgotten
+        since they were built on the old output.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage
+        key : str
+            Key of the stage (see QCompiler.getStageKeys)
+        order : list
+            Names of all stages in order
+        bsp_path : str
+            Path to the .bsp
+        =============================================== """
+        self.clearStages(stage, order, save=False)
+        self.manifest.setdefault('stages', {})[stage] = key
+        self.manifest['intermediate'] = self.entryFor(bsp_path)
+        self.save()
+
+    def clearStages(self, stage, order, save=True):
+        """ ===============================================
+        Forget a stage and every stage after it
+        =============================================== """
+        stages = self.manifest.setdefault('stages', {})
+        for name in order[order.index(stage):]:
+            stages.pop(name, None)
+        if save:
+            self.save()
+
+    def checkIntermediates(self, upstream, keys, paths):
+        """ ===============================================
+        Check the intermediates left by the last build can
+        be used to run later stages on.
+
+        Parameters
+        ----------
+        upstream : list
+            Names of the stages that will not be run
+        keys : dict
+            Current key of every stage
+        paths : list
+            Intermediate files that must exist. The first is
+            the .bsp.
+
+        Returns
+        -------
+        list
+            Problems found. Empty if everything is current.
+        =============================================== """
+        problems = []
+        for stage in upstream:
+            if self.manifest.get('stages', {}).get(stage) != keys[stage]:
+                problems.append(stage + " output does not match the current map, inputs or " + stage + " args")
+
+        for path in paths:
+            if not os.path.exists(path):
+                problems.append("missing " + path)
+
+        intermediate = self.manifest.get('intermediate')
+        if paths and os.path.exists(paths[0]) and (intermediate is None or self.entryChanged(paths[0], intermediate)):
+            problems.append(paths[0] + " was changed since qruncher last wrote it")
+
+        return problems
+
+
+""" =================================== REPORT ================================
+=========================================================================== """
+class QReport:
+    """
+    Machine readable report of a single build
+    ...
+    Attributes
+    ----------
+    mode : str
+        'json' writes one document per build, 'ndjson' streams stage
+        events and the final document to an event log. None only
+        collects (for the prometheus textfile).
+    report_path : str
+        Directory reports are written to
+    prometheus_textfile : str
+        Path to a node_exporter textfile. None to disable.
+    document : dict
+        The report document
+
+    Methods
+    -------
+    stageStart(name, cmd)
+        Record the start of a tool stage
+    stageStop(name, result)
+        Record the result of a tool stage from QCompiler.runTool
+    stageSkipped(name, cmd)
+        Record a stage that did not need to run
+    finish(artifacts, destination)
+        Complete the report and write it out
+    """
+    def __init__(self, mode, report_path, prometheus_textfile, map_basename, profiles):
+        """ QReport Init ======================= """
+        if mode not in (None, 'json', 'ndjson'):
+            print("Unknown report mode: " + mode + ". Use json or ndjson")
+            mode = None
+        self.mode = mode
+        self.report_path = report_path
+        self.prometheus_textfile = prometheus_textfile
+        self.skipped = False
+        self.commands = {}
+        self.started = time.time()
+        self.document = {
+            "map": map_basename,
+            "host": socket.gethostname(),
+            "started": datetime.fromtimestamp(self.started).isoformat(),
+            "profiles": profiles,
+            "stages": []
+        }
+        if self.mode:
+            os.makedirs(self.report_path, exist_ok=True)
+
+    def event(self, event, **fields):
+        """ ===============================================
+        Append an event to the NDJSON event log. Only
+        used in ndjson mode.
+
+        Parameters
+        ----------
+        event : str
+            Name of the event
+        fields : dict
+            Extra data for the event
+        =============================================== """
+        if self.mode != 'ndjson':
+            return
+        line = {"event": event, "time": round(time.time(), 3), "map": self.document['map']}
+        line.update(fields)
+        events_path = os.path.join(self.report_path, self.document['map'] + ".ndjson")
+        with open(events_path, 'a') as events:
+            events.write(json.dumps(line) + "\n")
+
+    def stageStart(self, name, cmd):
+        """ ===============================================
+        Record the start of a tool stage
+        =============================================== """
+        self.commands[name] = cmd
+        self.event("stage_start", stage=name, command=cmd)
+
+    def stageStop(self, name, result):
+        """ ===============================================
+        Record the result of a tool stage
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage
+        result : dict
+            Result of QCompiler.runTool
+        =============================================== """
+        stage = {
+            "name": name,
+            "command": self.commands.get(name),
+            "status": "ok" if result['returncode'] == 0 else "failed",
+            "returncode": result['returncode'],
+            "started": datetime.fromtimestamp(result['started']).isoformat(),
+            "seconds": result['seconds']
+        }
+        stage.update(result['resources'])
+        stage['worker'] = result.get('worker', 'local')
+        self.document['stages'].append(stage)
+        self.event("stage_stop", stage=name, status=stage['status'], seconds=stage['seconds'])
+
+    def stageSkipped(self, name, cmd):
+        """ ===============================================
+        Record a stage that did not need to run
+        =============================================== """
+        self.document['stages'].append({"name": name, "status": "skipped", "command": cmd})
+        self.event("stage_skipped", stage=name)
+
+    @staticmethod
+    def artifactStats(file_path):
+        """ ===============================================
+        Stats of a build artifact in raw numbers
+
+        Returns
+        -------
+        dict
+            path, exists, size in bytes and mtime
+        =============================================== """
+        try:
+            fs = os.stat(file_path)
+        except OSError:
+            return {"path": file_path, "exists": False}
+        return {
+            "path": file_path,
+            "exists": True,
+            "size": fs.st_size,
+            "mtime": datetime.fromtimestamp(fs.st_mtime).isoformat()
+        }
+
+    def finish(self, artifacts, destination):
+        """ ===============================================
+        Complete the report and write it out
+
+        Parameters
+        ----------
+        artifacts : dict
+            Artifact name to path (.map, .bsp ...)
+        destination : str
+            Path the .bsp was deployed to
+        =============================================== """
+        self.document['finished'] = datetime.now().isoformat()
+        self.document['seconds'] = round(time.time() - self.started, 3)
+        self.document['skipped'] = self.skipped
+        self.document['success'] = all(
+            stage['status'] != 'failed' for stage in self.document['stages'])
+        self.document['artifacts'] = {
+            name: self.artifactStats(path) for name, path in artifacts.items()}
+        self.document['deploy'] = self.artifactStats(destination)
+
+        if self.mode == 'json':
+            # Build profile and microseconds, so builds of the same map on a
+            # farm or in quick succession do not overwrite each other
+            stamp = datetime.fromtimestamp(self.started).strftime('%Y%m%d-%H%M%S-%f')
+            report_file = os.path.join(self.report_path, self.document['map'] + "-"
+                + self.document['profiles']['build']['name'] + "-" + stamp + ".json")
+            with open(report_file, 'w') as report_json:
+                json.dump(self.document, report_json, indent=2, separators=(',', ': '))
+            print("\nBuild report: " + report_file)
+        elif self.mode == 'ndjson':
+            self.event("build", report=self.document)
+
+        # A skipped build would replace the metrics of the last real one
+        if self.prometheus_textfile and not self.skipped:
+            self.writePrometheus()
+
+    def writePrometheus(self):
+        """ ===============================================
+        Write build metrics to a node_exporter textfile.
+        Samples of other maps and build profiles already in
+        the file are kept. The file is replaced atomically
+        so node_exporter never reads half a file.
+        =============================================== """
+        labels = 'map="' + self.document['map'] + '",build="' + self.document['profiles']['build']['name'] + '"'
+        metrics = {
+            "qruncher_build_duration_seconds": "Duration of the last build",
+            "qruncher_build_success": "1 if the last build succeeded",
+            "qruncher_build_timestamp_seconds": "Time the last build finished",
+            "qruncher_stage_duration_seconds": "Duration of the last run of a tool stage",
+            "qruncher_stage_cpu_seconds": "CPU time (user+sys) of the last run of a tool stage",
+            "qruncher_stage_max_rss_bytes": "Peak memory of the last run of a tool stage"
+        }
+
+        samples = []
+        try:
+            with open(self.prometheus_textfile) as textfile:
+                for line in textfile:
+                    if line.startswith('#') or not line.strip():
+                        continue
+                    if '{' + labels + '}' in line or '{' + labels + ',' in line:
+                        continue
+                    samples.append(line.rstrip('\n'))
+        except FileNotFoundError:
+            pass
+
+        samples.append("qruncher_build_duration_seconds{" + labels + "} " + str(self.document['seconds']))
+        samples.append("qruncher_build_success{" + labels + "} " + str(int(self.document['success'])))
+        samples.append("qruncher_build_timestamp_seconds{" + labels + "} " + str(round(time.time(), 3)))
+        for stage in self.document['stages']:
+            if stage['status'] == 'skipped':
+                continue
+            stage_labels = labels + ',stage="' + stage['name'] + '"'
+            samples.append("qruncher_stage_duration_seconds{" + stage_labels + "} " + str(stage['seconds']))
+            if stage.get('cpu_user') is not None:
+                cpu = round(stage['cpu_user'] + stage['cpu_sys'], 3)
+                samples.append("qruncher_stage_cpu_seconds{" + stage_labels + "} " + str(cpu))
+                samples.append("qruncher_stage_max_rss_bytes{" + stage_labels + "} " + str(stage['max_rss']))
+
+        lines = []
+        for metric, help_text in metrics.items():
+            lines.append("# HELP " + metric + " " + help_text)
+            lines.append("# TYPE " + metric + " gauge")
+            lines += sorted(sample for sample in samples if sample.startswith(metric + "{"))
+
+        tmp_path = self.prometheus_textfile + ".tmp"
+        with open(tmp_path, 'w') as textfile:
+            textfile.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.prometheus_textfile)
+
+
+""" =================================== TRACE =================================
+=========================================================================== """
+class QTrace:
+    """
+    Trace-event timeline of a build. Written as the Chrome trace event
+    json format so it opens in Perfetto or chrome://tracing.
+    ...
+    Attributes
+    ----------
+    enabled : bool
+        Only write the trace file when True. Spans are always collected.
+    trace_file : str
+        Path of the trace json file
+    tags : dict
+        Args added to every span (map, build profile)
+    events : list
+        Collected trace events
+
+    Methods
+    -------
+    add(name, cat, start, end, **args)
+        Add a finished span
+    span(name, cat, **args)
+        Context manager timing a span
+    write()
+        Write the trace file
+    """
+    def __init__(self, enabled, trace_path, map_basename, tags):
+        """ QTrace Init ======================== """
+        self.enabled = enabled
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        self.trace_file = os.path.join(trace_path, map_basename + "-" + tags['build'] + "-" + stamp + ".trace.json")
+        self.tags = tags
+        self.events = []
+        self.tracks = {}
+        self.written = False
+        self.lock = threading.Lock()
+
+    def track(self, name=None):
+        """ ===============================================
+        Get the track id of the calling thread. Every worker
+        thread gets its own track, named after the thread.
+
+        Parameters
+        ----------
+        name : str
+            Use the track of this name instead, for work
+            done on another host.
+
+        Returns
+        -------
+        int
+            Track (tid) for the trace events
+        =============================================== """
+        ident = name or threading.get_ident()
+        if ident not in self.tracks:
+            self.tracks[ident] = len(self.tracks) + 1
+            self.events.append({
+                "name": "thread_name", "ph": "M", "pid": os.getpid(),
+                "tid": self.tracks[ident],
+                "args": {"name": name or threading.current_thread().name}
+            })
+        return self.tracks[ident]
+
+    def add(self, name, cat, start, end, track=None, **args):
+        """ ===============================================
+        Add a finished span
+
+        Parameters
+        ----------
+        name : str
+            Name of the span
+        cat : str
+            Category (setup, tool, deploy, engine)
+        start : float
+            Start time in seconds since the epoch
+        end : float
+            End time in seconds since the epoch
+        track : str
+            Name of the track to put the span on. The track
+            of the calling thread if None.
+        args : dict
+            Extra args to show on the span
+        =============================================== """
+        span_args = dict(self.tags)
+        span_args.update(args)
+        with self.lock:
+            self.events.append({
+                "name": name, "cat": cat, "ph": "X",
+                "ts": round(start * 1000000), "dur": round((end - start) * 1000000),
+                "pid": os.getpid(), "tid": self.track(track), "args": span_args
+            })
+
+    @contextlib.contextmanager
+    def span(self, name, cat, **args):
+        """ ===============================================
+        Context manager timing the code inside it as a span
+        =============================================== """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, cat, start, time.time(), **args)
+
+    def write(self):
+        """ ===============================================
+        Write the trace file if tracing is enabled. Can be
+        called again to rewrite it with more spans.
+        =============================================== """
+        if not self.enabled:
+            return
+        os.makedirs(os.path.dirname(self.trace_file), exist_ok=True)
+        with self.lock:
+            with open(self.trace_file, 'w') as trace_json:
+                json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, trace_json)
+        if not self.written:
+            print("Build trace: " + self.trace_file)
+        self.written = True
+
+
+""" =================================== SCANNER ===============================
+=========================================================================== """
+class QScanner:
+    """
+    Finds .map files in directory trees for map:scan
+    ...
+    Attributes
+    ----------
+    root : str
+        Directory to scan
+    cache_file : str
+        Where the directory state of the last scan is kept
+    cache : dict
+        Directory path to mtime, maps and subdirectories of the last scan
+    scanned : int
+        Number of directories looked at in the last scan
+    reused : int
+        Number of those that were unchanged and came from the cache
+
+    Methods
+    -------
+    scan()
+        Scan the tree and return every .map file found
+    """
+    # Directories never worth looking in
+    skip_dirs = ['autosave', 'node_modules', '__pycache__']
+
+    def __init__(self, root):
+        """ QScanner Init ====================== """
+        self.root = os.path.abspath(root)
+        self.cache_file = os.path.join(self.root, ".qruncher", "scan.json")
+        self.cache = {}
+        self.scanned = 0
+        self.reused = 0
+        try:
+            with open(self.cache_file) as cache_json:
+                self.cache = json.load(cache_json)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def scanDir(self, path):
+        """ ===============================================
+        Look at a single directory. If its mtime is the same
+        as the last scan the cached listing is used, since
+        adding or removing entries changes the mtime.
+
+        Parameters
+        ----------
+        path : str
+            Directory to look at
+
+        Returns
+        -------
+        dict
+            mtime, maps and dirs of the directory. None if it
+            could not be read.
+        =============================================== """
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+        cached = self.cache.get(path)
+        if cached and cached['mtime'] == mtime:
+            cached['reused'] = True
+            return cached
+
+        entry = {"mtime": mtime, "maps": [], "dirs": []}
+        try:
+            with os.scandir(path) as it:
+                for dir_entry in it:
+                    if dir_entry.name.startswith('.'):
+                        continue
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        if dir_entry.name.lower() not in self.skip_dirs:
+                            entry['dirs'].append(dir_entry.path)
+                    elif dir_entry.name.lower().endswith('.map') and not dir_entry.name.endswith('_rgn.map'):
+                        # _rgn.map files are region compiles
+                        entry['maps'].append(dir_entry.path)
+        except OSError as ose:
+            print("Could not scan " + path + ": " + str(ose))
+            return None
+
+        return entry
+
+    def scan(self):
+        """ ===============================================
+        Scan the tree one level at a time. All directories
+        of a level are stat'ed and listed concurrently.
+        Unchanged directories are not listed again but their
+        subdirectories are still checked.
+
+        Returns
+        -------
+        list
+            Full paths to every .map file found
+        =============================================== """
+        if not os.path.isdir(self.root):
+            print("Not a directory: " + self.root)
+            sys.exit(1)
+
+        maps = []
+        cache = {}
+        frontier = [self.root]
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            while frontier:
+                next_frontier = []
+                for path, entry in zip(frontier, pool.map(self.scanDir, frontier)):
+                    if entry is None:
+                        continue
+                    self.scanned += 1
+                    if entry.pop('reused', False):
+                        self.reused += 1
+                    cache[path] = entry
+                    maps += entry['maps']
+                    next_frontier += entry['dirs']
+                frontier = next_frontier
+
+        # Directories that are gone drop out of the cache here
+        self.cache = cache
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        with open(self.cache_file, 'w') as cache_json:
+            json.dump(self.cache, cache_json)
+
+        return maps
+
+
+""" =================================== ENGINE SESSION ========================
+=========================================================================== """
+class QEngineSession:
+    """
+    A running engine that builds load their maps into. The session
+    process owns the engine and sends console commands to it through
+    its stdin. Builds talk to the session over a localhost socket.
+    ...
+    Attributes
+    ----------
+    session_file : str
+        Path to the json file describing the running session
+    session : dict
+        pid, port, token, engine name and game dir of the session
+
+    Methods
+    -------
+    isRunning(engine_name)
+        Check if a session is running for an engine
+    loadMap(map_basename, game)
+        Ask the running session to load a map
+    serve(engine_exe, engine, game)
+        Run the engine session until the game is quit
+    """
+    def __init__(self, session_file):
+        """ QEngineSession Init ================ """
+        self.session_file = session_file
+        self.session = None
+        try:
+            with open(self.session_file) as session_json:
+                self.session = json.load(session_json)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def isRunning(self, engine_name=None):
+        """ ===============================================
+        Check if a session was started, for a specific
+        engine profile if engine_name is given.
+
+        Returns
+        -------
+        bool
+            True if there is a session
+        =============================================== """
+        if self.session is None:
+            return False
+        return engine_name is None or self.session['engine'] == engine_name
+
+    def loadMap(self, map_basename, game):
+        """ ===============================================
+        Ask the running session to load a map. Does not wait
+        for the map to finish loading.
+
+        Parameters
+        ----------
+        map_basename : str
+            Name of the map without ext
+        game : str
+            Mod subdir the map was deployed to
+
+        Returns
+        -------
+        bool
+            True if the session took the command
+        =============================================== """
+        return self.request({"map": map_basename, "game": game})
+
+    def ping(self):
+        """ ===============================================
+        Check the session is alive without loading anything
+
+        Returns
+        -------
+        bool
+            True if the session answered
+        =============================================== """
+        return self.request({"ping": True})
+
+    def request(self, request):
+        """ ===============================================
+        Send a request to the running session. A session
+        that does not answer is considered dead and its
+        session file is removed.
+
+        Parameters
+        ----------
+        request : dict
+            Request for QEngineSession.handle
+
+        Returns
+        -------
+        bool
+            True if the session took the request
+        =============================================== """
+        request['token'] = self.session['token']
+        try:
+            with socket.create_connection(('127.0.0.1', self.session['port']), timeout=5) as conn:
+                conn.sendall((json.dumps(request) + "\n").encode())
+                reply = json.loads(conn.makefile('rb').readline() or b'{}')
+        except (OSError, ValueError):
+            reply = {}
+
+        if not reply.get('ok'):
+            try:
+                os.remove(self.session_file)
+            except OSError:
+                pass
+            return False
+        return True
+
+    def handle(self, conn, proc, reload_command):
+        """ ===============================================
+        Handle a single request from a build. Switches game
+        dir first if the map was deployed to another mod.
+
+        Parameters
+        ----------
+        conn : socket
+            Connection from the build
+        proc : Popen
+            The engine process
+        reload_command : str
+            Console command that loads a map (map, changelevel)
+        =============================================== """
+        conn.settimeout(5)
+        try:
+            request = json.loads(conn.makefile('rb').readline() or b'{}')
+        except (OSError, ValueError):
+            return
+
+        ok = False
+        if request.get('token') == self.session['token'] and request.get('ping'):
+            ok = True
+        elif request.get('token') == self.session['token']:
+            commands = []
+            if request['game'] != self.session['game']:
+                commands.append("game " + request['game'])
+                self.session['game'] = request['game']
+            commands.append(reload_command + " " + request['map'])
+            try:
+                for command in commands:
+                    proc.stdin.write((command + "\n").encode())
+                proc.stdin.flush()
+                print("Session: " + "; ".join(commands))
+                ok = True
+            except OSError:
+                pass
+
+        try:
+            conn.sendall((json.dumps({"ok": ok}) + "\n").encode())
+        except OSError:
+            pass
+
+    def serve(self, engine_exe, engine, game):
+        """ ===============================================
+        Launch the engine and serve build requests until the
+        game is quit. The engine must read console commands
+        from stdin.
+
+        Parameters
+        ----------
+        engine_exe : list
+            Command to launch the engine
+        engine : dict
+            ENGINE profile. 'reload' can set the console
+            command used to load maps, default 'map'.
+        game : str
+            Mod subdir the engine starts with
+        =============================================== """
+        if self.isRunning() and self.ping():
+            print("An engine session is already running for " + self.session['engine'])
+            sys.exit(1)
+
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(5)
+        server.settimeout(0.5)
+
+        try:
+            proc = subprocess.Popen(engine_exe, stdin=subprocess.PIPE)
+        except FileNotFoundError as fnfe:
+            print(str(fnfe))
+            sys.exit(1)
+
+        self.session = {
+            "pid": os.getpid(),
+            "port": server.getsockname()[1],
+            "token": hashlib.sha1(os.urandom(16)).hexdigest(),
+            "engine": engine['name'],
+            "game": game
+        }
+        os.makedirs(os.path.dirname(self.session_file), exist_ok=True)
+        with open(self.session_file, 'w') as session_json:
+            json.dump(self.session, session_json)
+
+        print("Engine session running: " + " ".join(engine_exe))
+        print("Builds with engine " + engine['name'] + " will load into it. Quit the game to end the session.")
+        try:
+            while proc.poll() is None:
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    continue
+                with conn:
+                    self.handle(conn, proc, engine.get('reload', 'map'))
+        except KeyboardInterrupt:
+            proc.terminate()
+        finally:
+            server.close()
+            try:
+                os.remove(self.session_file)
+            except OSError:
+                pass
+        print("Engine session ended")
+
+
+""" =================================== MEMORY ================================
+=========================================================================== """
+class QMemoryGovernor:
+    """
+    Admission control for tool processes by memory. Every qruncher on
+    the host shares a ledger of the memory its running stages are
+    expected to use. A stage only starts when its predicted peak fits
+    in the budget next to the others. Predictions are learned from the
+    peak memory of previous runs of the same map, stage and tool args.
+    ...
+    Attributes
+    ----------
+    budget : int
+        Memory budget in bytes for all running stages. None disables
+        admission control, peaks are still learned.
+    default : int
+        Predicted peak in bytes for stages never seen before
+    history_file : str
+        json file with the learned peaks of this map
+    ledger_file : str
+        Shared ledger of running stages on this host. Writable by
+        every user so builds of all users are counted.
+
+    Methods
+    -------
+    predict(stage, settings)
+        Predicted peak memory of a stage
+    admit(stage, settings)
+        Wait until the stage fits in the budget and reserve it
+    update(stage, rss)
+        Report the current memory of a running stage
+    release(stage)
+        Remove the stage from the ledger
+    learn(stage, result, settings)
+        Remember the peak memory of a finished stage
+    """
+    # Headroom on learned peaks
+    margin = 1.1
+    # Guards the ledger between threads. fcntl guards it between processes.
+    lock = threading.Lock()
+
+    def __init__(self, budget, default, history_file):
+        """ QMemoryGovernor Init =============== """
+        self.budget = parse_size(budget) if budget else None
+        self.default = parse_size(default)
+        self.history_file = history_file
+        self.ledger_file = os.path.join(tempfile.gettempdir(), "qruncher-memory.json")
+        self.reported = {}
+        self.history = {}
+        try:
+            with open(self.history_file) as history_json:
+                self.history = json.load(history_json)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    @staticmethod
+    def sampleRss(pid):
+        """ ===============================================
+        Read the resident memory of a process from /proc
+
+        Returns
+        -------
+        int
+            Resident memory in bytes. None where /proc is not
+            available or the process is gone.
+        =============================================== """
+        try:
+            with open("/proc/" + str(pid) + "/status") as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+
+    def key(self, stage):
+        """ ===============================================
+        Ledger key of a stage run by this thread
+        =============================================== """
+        return str(os.getpid()) + "-" + str(threading.get_ident()) + "-" + stage
+
+    def historyKey(self, stage, settings):
+        """ ===============================================
+        History key of a stage. The same stage with other
+        args (-extra4 against a quick debug light) can need
+        a lot more memory, so they are kept apart.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage
+        settings : list
+            Tool path and args of the stage. None for the
+            stage name alone.
+        =============================================== """
+        if settings is None:
+            return stage
+        return stage + "-" + QManifest.hashSettings(settings)[:12]
+
+    def predict(self, stage, settings=None):
+        """ ===============================================
+        Predicted peak memory of a stage in bytes. Args never
+        seen before are expected to need as much as the
+        biggest peak of the stage with any args.
+        =============================================== """
+        key = self.historyKey(stage, settings)
+        if key in self.history:
+            return int(self.history[key] * self.margin)
+        peaks = [peak for name, peak in self.history.items() if name == stage or name.startswith(stage + "-")]
+        if peaks:
+            return int(max(peaks) * self.margin)
+        return self.default
+
+    def openLedger(self):
+        """ ===============================================
+        Open the shared ledger for reading and writing. The
+        first qruncher on the host creates it writable for
+        everyone. An existing ledger is opened without
+        O_CREAT, which Linux refuses for files of other
+        users in /tmp (fs.protected_regular).
+
+        Returns
+        -------
+        file
+            The ledger, opened r+
+        =============================================== """
+        try:
+            fd = os.open(self.ledger_file, os.O_RDWR)
+        except FileNotFoundError:
+            try:
+                fd = os.open(self.ledger_file, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o666)
+                if hasattr(os, 'fchmod'):
+                    # Not limited by the umask
+                    os.fchmod(fd, 0o666)
+            except FileExistsError:
+                fd = os.open(self.ledger_file, os.O_RDWR)
+        return os.fdopen(fd, 'r+')
+
+    @contextlib.contextmanager
+    def ledger(self):
+        """ ===============================================
+        Open the shared ledger locked for reading and
+        writing. Entries of dead processes are dropped.
+        =============================================== """
+        with self.lock:
+            try:
+                ledger_json = self.openLedger()
+            except PermissionError:
+                # Made by another user without write access for others
+                print("Can not write " + self.ledger_file + ". Using a ledger of your own builds only")
+                self.ledger_file = os.path.join(tempfile.gettempdir(),
+                    "qruncher-memory-" + getpass.getuser() + ".json")
+                ledger_json = self.openLedger()
+            with ledger_json:
+                if fcntl is not None:
+                    fcntl.flock(ledger_json, fcntl.LOCK_EX)
+                ledger_json.seek(0)
+                try:
+                    entries = json.loads(ledger_json.read() or '{}')
+                except ValueError:
+                    entries = {}
+
+                for key in list(entries.keys()):
+                    if not self.pidAlive(entries[key]['pid']):
+                        del entries[key]
+
+                yield entries
+
+                ledger_json.seek(0)
+                ledger_json.truncate()
+                ledger_json.write(json.dumps(entries))
+
+    @staticmethod
+    def pidAlive(pid):
+        """ ===============================================
+        Check if a process is still running. Always True
+        where this can not be checked.
+        =============================================== """
+        if os.name != 'posix':
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def admit(self, stage, settings=None):
+        """ ===============================================
+        Wait until the predicted peak of the stage fits in
+        the budget next to the stages already running, then
+        reserve it. A stage is always admitted when nothing
+        else is running, even if it is over budget.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage
+        settings : list
+            Tool path and args of the stage
+        =============================================== """
+        if self.budget is None:
+            return
+        predicted = self.predict(stage, settings)
+        waiting = False
+        while True:
+            with self.ledger() as entries:
+                if not entries or \
+                        sum(max(e['predicted'], e['rss']) for e in entries.values()) + predicted <= self.budget:
+                    entries[self.key(stage)] = {"pid": os.getpid(), "predicted": predicted, "rss": 0}
+                    return
+            if not waiting:
+                print("Waiting for memory to run " + stage + " (needs about "
+                    + str(round(predicted / 1048576)) + "M)")
+                waiting = True
+            time.sleep(1)
+
+    def update(self, stage, rss):
+        """ ===============================================
+        Report the current memory of a running stage. Only
+        written to the ledger when it grew past the last
+        reported value by 10%.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage
+        rss : int
+            Resident memory in bytes
+        =============================================== """
+        if self.budget is None:
+            return
+        reported = self.reported.get(self.key(stage), 0)
+        if rss <= reported * 1.1:
+            return
+        self.reported[self.key(stage)] = rss
+        with self.ledger() as entries:
+            if self.key(stage) in entries:
+                entries[self.key(stage)]['rss'] = rss
+
+    def release(self, stage):
+        """ ===============================================
+        Remove a finished stage from the ledger
+        =============================================== """
+        if self.budget is None:
+            return
+        self.reported.pop(self.key(stage), None)
+        with self.ledger() as entries:
+            entries.pop(self.key(stage), None)
+
+    def learn(self, stage, result, settings=None):
+        """ ===============================================
+        Remember the peak memory of a finished stage for the
+        next prediction
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage
+        result : dict
+            Result of QCompiler.runTool
+        settings : list
+            Tool path and args of the stage
+        =============================================== """
+        peak = result['resources'].get('max_rss')
+        if not peak or result['returncode'] != 0:
+            return
+        with self.lock:
+            self.history[self.historyKey(stage, settings)] = peak
+            # Peaks of the stage name alone are from before args were kept apart
+            self.history.pop(stage, None)
+            with open(self.history_file, 'w') as history_json:
+                json.dump(self.history, history_json, indent=2, separators=(',', ': '))
+
+
+""" =================================== LOG ARCHIVE ===========================
+=========================================================================== """
+class QLogArchive:
+    """
+    Compressed archive of the tool output of every build of a map,
+    with an index of the warnings found in it.
+    ...
+    Attributes
+    ----------
+    log_path : str
+        Directory the archives of this map are kept in
+    keep : int
+        Number of builds to keep
+    index : list
+        Builds in the archive, oldest first. Each has the stamp, build
+        profile, stages run, archive and warnings file names and
+        warning counts.
+    warnings : list
+        Warnings of the build being captured
+
+    Methods
+    -------
+    start(build_name, stages)
+        Start capturing a build
+    stage(name, cmd)
+        Start a stage. Returns the line handler for runTool
+    finish()
+        Close the archive and save the warning index
+    diff(old, new)
+        Warnings added and removed between two builds
+    """
+    # Stages of a full build. Builds indexed before stages were
+    # recorded ran all of them.
+    all_stages = ['qbsp', 'vis', 'light']
+    # First match wins. Checked against the lower case warning text.
+    categories = [
+        ('leak', ['leak']),
+        ('solid', ['in solid', 'stuck']),
+        ('texture', ['texture', 'wad']),
+        ('face', ['face', 'degenerate', 'plane']),
+        ('brush', ['brush']),
+        ('light', ['light', 'overlap']),
+        ('portal', ['portal']),
+        ('target', ['target'])
+    ]
+
+    def __init__(self, log_path, keep=50):
+        """ QLogArchive Init =================== """
+        self.log_path = log_path
+        self.keep = keep
+        self.index = []
+        self.archive = None
+        self.warnings = []
+        # Stages running at the same time (matrix builds) need their
+        # lines tagged with the stage
+        self.prefix_lines = False
+        self.lock = threading.Lock()
+        try:
+            with open(os.path.join(self.log_path, "index.json")) as index_json:
+                self.index = json.load(index_json)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def start(self, build_name, stages=None):
+        """ ===============================================
+        Start capturing a build
+
+        Parameters
+        ----------
+        build_name : str
+            Name of the BUILD profile
+        stages : list
+            Stages the build runs. All if None.
+        =============================================== """
+        os.makedirs(self.log_path, exist_ok=True)
+        # Microseconds so quick rebuilds do not share a stamp. The
+        # counter covers builds that still do.
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        taken = set(build['stamp'] for build in self.index)
+        count = 1
+        while stamp in taken or os.path.exists(os.path.join(self.log_path, stamp + ".log.gz")):
+            stamp = stamp.split('.')[0] + "." + str(count)
+            count += 1
+        self.build = {
+            "stamp": stamp,
+            "build": build_name,
+            "stages": stages or self.all_stages,
+            "archive": stamp + ".log.gz",
+            "warnings": stamp + ".warnings.json"
+        }
+        self.warnings = []
+        self.archive = gzip.open(os.path.join(self.log_path, self.build['archive']), 'wt')
+
+    def stage(self, name, cmd, tag=None):
+        """ ===============================================
+        Start capturing a stage
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage
+        cmd : list
+            Command of the stage
+        tag : str
+            Shown instead of the name in the archive, like
+            vis@debug,test in matrix builds
+
+        Returns
+        -------
+        function
+            Line handler to pass to QCompiler.runTool
+        =============================================== """
+        tag = tag or name
+        with self.lock:
+            self.archive.write("==== " + tag + ": " + " ".join(cmd) + "\n")
+        return lambda line: self.line(name, line, tag)
+
+    def line(self, stage, line, tag=None):
+        """ ===============================================
+        Archive a line of output and index it if it is a
+        warning or error.
+        =============================================== """
+        warning = self.parseWarning(stage, line)
+        with self.lock:
+            if self.prefix_lines:
+                line = "[" + (tag or stage) + "] " + line
+            self.archive.write(line + "\n")
+            if warning:
+                self.warnings.append(warning)
+
+    def parseWarning(self, stage, line):
+        """ ===============================================
+        Parse a line of tool output into a warning
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage
+        line : str
+            Line of output
+
+        Returns
+        -------
+        dict
+            stage, category, entity, classname, coords and
+            text. None if the line is not a warning.
+        =============================================== """
+        lower = line.lower()
+        if 'warning' not in lower and 'error' not in lower:
+            return None
+
+        category = 'other'
+        for name, words in self.categories:
+            if any(word in lower for word in words):
+                category = name
+                break
+
+        entity = re.search(r'entity\s+#?(\d+)(?:\s*\((\w+)\))?', line, re.IGNORECASE)
+        coords = re.search(r'\(\s*(-?[\d.]+)\s+(-?[\d.]+)\s+(-?[\d.]+)\s*\)', line)
+        return {
+            "stage": stage,
+            "category": category,
+            "entity": int(entity.group(1)) if entity else None,
+            "classname": entity.group(2) if entity else None,
+            "coords": [float(c) for c in coords.groups()] if coords else None,
+            "text": line.strip()
+        }
+
+    def finish(self):
+        """ ===============================================
+        Close the archive, save the warning index and drop
+        builds over the keep limit.
+        =============================================== """
+        self.archive.close()
+        with open(os.path.join(self.log_path, self.build['warnings']), 'w') as warnings_json:
+            json.dump(self.warnings, warnings_json)
+
+        self.build['counts'] = {}
+        for warning in self.warnings:
+            self.build['counts'][warning['category']] = self.build['counts'].get(warning['category'], 0) + 1
+        self.index.append(self.build)
+
+        while len(self.index) > self.keep:
+            old = self.index.pop(0)
+            for name in [old['archive'], old['warnings']]:
+                try:
+                    os.remove(os.path.join(self.log_path, name))
+                except OSError:
+                    pass
+
+        with open(os.path.join(self.log_path, "index.json"), 'w') as index_json:
+            json.dump(self.index, index_json, indent=2, separators=(',', ': '))
+
+    def summary(self):
+        """ ===============================================
+        Warning counts of the captured build by category
+
+        Returns
+        -------
+        str
+            Summary for the user
+        =============================================== """
+        if not self.warnings:
+            return "none"
+        counts = self.build['counts']
+        return str(len(self.warnings)) + " (" + ", ".join(
+            category + ": " + str(count) for category, count in sorted(counts.items())) + ")"
+
+    def readWarnings(self, build):
+        """ ===============================================
+        Read the warning index of a build from the archive
+        =============================================== """
+        try:
+            with open(os.path.join(self.log_path, build['warnings'])) as warnings_json:
+                return json.load(warnings_json)
+        except (FileNotFoundError, ValueError):
+            return []
+
+    def commonStages(self, old, new):
+        """ ===============================================
+        Stages both builds ran. A partial build (stages:)
+        can only be compared on the stages it ran.
+        =============================================== """
+        new_stages = new.get('stages', self.all_stages)
+        return [stage for stage in old.get('stages', self.all_stages) if stage in new_stages]
+
+    def diff(self, old, new):
+        """ ===============================================
+        Warnings added and removed between two builds.
+        Warnings are the same if stage and text match, so a
+        warning that moved shows as removed and added. Only
+        stages both builds ran are compared.
+
+        Parameters
+        ----------
+        old : dict
+            Build from self.index
+        new : dict
+            Build from self.index
+
+        Returns
+        -------
+        tuple
+            (added, removed) lists of warnings
+        =============================================== """
+        def key(warning):
+            return (warning['stage'], warning['text'])
+
+        stages = self.commonStages(old, new)
+        old_warnings = [warning for warning in self.readWarnings(old) if warning['stage'] in stages]
+        new_warnings = [warning for warning in self.readWarnings(new) if warning['stage'] in stages]
+
+        # Count duplicates so repeated warnings diff correctly
+        remaining = {}
+        for warning in old_warnings:
+            remaining[key(warning)] = remaining.get(key(warning), 0) + 1
+
+        added = []
+        for warning in new_warnings:
+            if remaining.get(key(warning), 0) > 0:
+                remaining[key(warning)] -= 1
+            else:
+                added.append(warning)
+
+        removed = []
+        for warning in old_warnings:
+            if remaining.get(key(warning), 0) > 0:
+                remaining[key(warning)] -= 1
+                removed.append(warning)
+
+        return added, removed
+
+
+""" =================================== PAK ===================================
+=========================================================================== """
+class QPak:
+    """
+    Incrementally updated Quake .pak file. Only changed entries are
+    written. New data goes into free space or the end of the file and
+    a new directory is written before the header is switched over to
+    it, so the pak is never left half updated. Free space is compacted
+    away once it passes a threshold.
+    ...
+    Attributes
+    ----------
+    pak_path : str
+        Path to the .pak file
+    max_waste : int
+        Bytes of free space allowed before the pak is compacted
+    entries : dict
+        Entry name to [offset, length]
+
+    Methods
+    -------
+    update(files)
+        Write changed files into the pak
+    compact()
+        Rewrite the pak without free space
+    wasted()
+        Bytes of free space in the pak
+    """
+    header_format = '<4sii'
+    entry_format = '<56sii'
+    chunk_size = 1024 * 1024
+
+    def __init__(self, pak_path, max_waste='64M'):
+        """ QPak Init ========================== """
+        self.pak_path = pak_path
+        self.max_waste = parse_size(max_waste)
+        self.entries = {}
+        self.dirofs = struct.calcsize(self.header_format)
+        self.dirlen = 0
+        self.read()
+
+    def read(self):
+        """ ===============================================
+        Read the directory of the pak. A missing pak is
+        created empty.
+        =============================================== """
+        if not os.path.exists(self.pak_path):
+            os.makedirs(os.path.dirname(self.pak_path), exist_ok=True)
+            with open(self.pak_path, 'wb') as pak:
+                pak.write(struct.pack(self.header_format, b'PACK', self.dirofs, 0))
+            print("Created pak: " + self.pak_path)
+
+        with open(self.pak_path, 'rb') as pak:
+            ident, self.dirofs, self.dirlen = struct.unpack(
+                self.header_format, pak.read(struct.calcsize(self.header_format)))
+            if ident != b'PACK':
+                raise PakException(self.pak_path, "not a pak file")
+            pak.seek(self.dirofs)
+            directory = pak.read(self.dirlen)
+
+        entry_size = struct.calcsize(self.entry_format)
+        self.entries = {}
+        for idx in range(0, len(directory) - entry_size + 1, entry_size):
+            name, pos, length = struct.unpack(self.entry_format, directory[idx:idx + entry_size])
+            self.entries[name.split(b'\0')[0].decode()] = [pos, length]
+
+    def copyRange(self, src, dst, length):
+        """ ===============================================
+        Stream length bytes from src to dst in chunks
+        =============================================== """
+        while length > 0:
+            chunk = src.read(min(self.chunk_size, length))
+            if not chunk:
+                raise PakException(self.pak_path, "unexpected end of file")
+            dst.write(chunk)
+            length -= len(chunk)
+
+    def hashEntry(self, pak, name):
+        """ ===============================================
+        Hash an entry of the pak without loading it
+
+        Returns
+        -------
+        str
+            sha1 hex digest of the entry
+        =============================================== """
+        pos, length = self.entries[name]
+        pak.seek(pos)
+        sha = hashlib.sha1()
+        while length > 0:
+            chunk = pak.read(min(self.chunk_size, length))
+            if not chunk:
+                break
+            sha.update(chunk)
+            length -= len(chunk)
+        return sha.hexdigest()
+
+    def holes(self, file_size):
+        """ ===============================================
+        Free space in the pak. Everything not used by the
+        header, the current directory or an entry.
+
+        Returns
+        -------
+        list
+            [start, end] of every hole
+        =============================================== """
+        used = sorted([[0, struct.calcsize(self.header_format)], [self.dirofs, self.dirofs + self.dirlen]]
+            + [[pos, pos + length] for pos, length in self.entries.values()])
+        holes = []
+        position = 0
+        for start, end in used:
+            if start > position:
+                holes.append([position, start])
+            position = max(position, end)
+        if file_size > position:
+            holes.append([position, file_size])
+        return holes
+
+    def allocate(self, size, holes, end):
+        """ ===============================================
+        Find room for size bytes. First hole that fits,
+        otherwise the end of the file. The hole is shrunk.
+
+        Returns
+        -------
+        tuple
+            (offset, new end of file)
+        =============================================== """
+        for hole in holes:
+            if hole[1] - hole[0] >= size:
+                hole[0] += size
+                return hole[0] - size, end
+        return end, end + size
+
+    def wasted(self):
+        """ ===============================================
+        Bytes of free space in the pak
+        =============================================== """
+        return sum(end - start for start, end in self.holes(os.path.getsize(self.pak_path)))
+
+    def packDirectory(self, entries):
+        """ ===============================================
+        Pack a directory of entries into bytes
+        =============================================== """
+        return b''.join(
+            struct.pack(self.entry_format, name.encode(), pos, length)
+            for name, (pos, length) in entries.items())
+
+    def update(self, files):
+        """ ===============================================
+        Write changed files into the pak. Files identical to
+        their entry are skipped, entries of files that are
+        gone are removed. The header is written last, after
+        everything else is on disk, which makes the update
+        atomic.
+
+        Parameters
+        ----------
+        files : dict
+            Entry name (maps/awesomemap.bsp) to file path
+
+        Returns
+        -------
+        list
+            Names of the entries written or removed
+        =============================================== """
+        with open(self.pak_path, 'r+b') as pak:
+            changed = {}
+            removed = []
+            for name, file_path in files.items():
+                if len(name) > 55:
+                    print("Name too long for pak, skipping: " + name)
+                    continue
+                if not os.path.exists(file_path):
+                    # The build no longer makes it (a .lit)
+                    if name in self.entries:
+                        removed.append(name)
+                    continue
+                size = os.path.getsize(file_path)
+                if name in self.entries and self.entries[name][1] == size \
+                        and self.hashEntry(pak, name) == QManifest.hashFile(file_path):
+                    continue
+                changed[name] = file_path
+
+            if not changed and not removed:
+                print("Pak " + os.path.basename(self.pak_path) + " is up to date")
+                return []
+
+            end = pak.seek(0, os.SEEK_END)
+            holes = self.holes(end)
+            entries = dict(self.entries)
+            for name in removed:
+                del entries[name]
+            for name, file_path in changed.items():
+                size = os.path.getsize(file_path)
+                offset, end = self.allocate(size, holes, end)
+                pak.seek(offset)
+                with open(file_path, 'rb') as src:
+                    self.copyRange(src, pak, size)
+                entries[name] = [offset, size]
+
+            directory = self.packDirectory(entries)
+            dirofs, end = self.allocate(len(directory), holes, end)
+            pak.seek(dirofs)
+            pak.write(directory)
+            pak.flush()
+            os.fsync(pak.fileno())
+
+            # Switch over to the new directory
+            pak.seek(0)
+            pak.write(struct.pack(self.header_format, b'PACK', dirofs, len(directory)))
+            pak.flush()
+            os.fsync(pak.fileno())
+
+        self.entries = entries
+        self.dirofs = dirofs
+        self.dirlen = len(directory)
+        if changed:
+            print("Pak " + os.path.basename(self.pak_path) + ": updated " + ", ".join(changed.keys()))
+        if removed:
+            print("Pak " + os.path.basename(self.pak_path) + ": removed " + ", ".join(removed))
+
+        if self.wasted() > self.max_waste:
+            self.compact()
+        return list(changed.keys()) + removed
+
+    def compact(self):
+        """ ===============================================
+        Rewrite the pak without free space. Written to a
+        temporary file that replaces the pak when done.
+        =============================================== """
+        print("Compacting pak " + os.path.basename(self.pak_path)
+            + " (" + str(round(self.wasted() / 1048576)) + "M free)")
+        tmp_path = self.pak_path + ".tmp"
+        entries = {}
+        with open(self.pak_path, 'rb') as pak, open(tmp_path, 'wb') as tmp:
+            tmp.write(b'\0' * struct.calcsize(self.header_format))
+            for name, (pos, length) in self.entries.items():
+                entries[name] = [tmp.tell(), length]
+                pak.seek(pos)
+                self.copyRange(pak, tmp, length)
+            dirofs = tmp.tell()
+            directory = self.packDirectory(entries)
+            tmp.write(directory)
+            tmp.seek(0)
+            tmp.write(struct.pack(self.header_format, b'PACK', dirofs, len(directory)))
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.replace(tmp_path, self.pak_path)
+
+        self.entries = entries
+        self.dirofs = dirofs
+        self.dirlen = len(directory)
+
+
+""" =================================== WORKERS ===============================
+=========================================================================== """
+class QWorker:
+    """
+    Build worker. Runs vis and light jobs for other hosts using the
+    build profiles and tool paths of its own config.
+
+    Messages are json prefixed with their length. Files follow the
+    message that lists them as raw bytes.
+    ...
+    Attributes
+    ----------
+    compiler : QCompiler
+        Compiler with this host's config
+    port : int
+        Port to listen on
+    cores : int
+        Cores offered to jobs ('worker_cores', default all)
+    running : int
+        Number of jobs running
+
+    Methods
+    -------
+    serve()
+        Accept jobs until interrupted
+    """
+    # Stage to (input exts, output exts)
+    stage_files = {
+        "vis": ([".bsp", ".prt"], [".bsp"]),
+        "light": ([".bsp"], [".bsp", ".lit", ".lux"])
+    }
+
+    def __init__(self, compiler, port):
+        """ QWorker Init ======================= """
+        self.compiler = compiler
+        self.port = port
+        self.secret = compiler.cfg.config['config'].get('worker_secret')
+        # Cores offered to jobs. Less than all on a machine used for other work.
+        self.cores = int(compiler.cfg.config['config'].get('worker_cores') or os.cpu_count() or 1)
+        self.running = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def send(sock, message):
+        """ ===============================================
+        Send a json message
+        =============================================== """
+        data = json.dumps(message).encode()
+        sock.sendall(struct.pack('>I', len(data)) + data)
+
+    @staticmethod
+    def recvExact(sock, size):
+        """ ===============================================
+        Receive exactly size bytes
+        =============================================== """
+        data = b''
+        while len(data) < size:
+            chunk = sock.recv(min(size - len(data), 1024 * 1024))
+            if not chunk:
+                raise ConnectionError("connection closed")
+            data += chunk
+        return data
+
+    @staticmethod
+    def recv(sock):
+        """ ===============================================
+        Receive a json message
+        =============================================== """
+        size = struct.unpack('>I', QWorker.recvExact(sock, 4))[0]
+        return json.loads(QWorker.recvExact(sock, size))
+
+    @staticmethod
+    def sendFiles(sock, paths):
+        """ ===============================================
+        Send the contents of files, one after the other
+        =============================================== """
+        for path in paths:
+            with open(path, 'rb') as f:
+                sock.sendfile(f)
+
+    @staticmethod
+    def recvFiles(sock, files, directory):
+        """ ===============================================
+        Receive files listed in a message into directory.
+        Written to a temp name first so a broken transfer
+        does not leave half a file.
+
+        Parameters
+        ----------
+        files : list
+            name and size of every file
+        directory : str
+            Directory to write them to
+        =============================================== """
+        for f in files:
+            if not QWorker.plainName(f['name']):
+                raise ValueError("bad file name " + repr(f['name']))
+            path = os.path.join(directory, f['name'])
+            with open(path + ".part", 'wb') as out:
+                remaining = f['size']
+                while remaining > 0:
+                    chunk = sock.recv(min(remaining, 1024 * 1024))
+                    if not chunk:
+                        raise ConnectionError("connection closed")
+                    out.write(chunk)
+                    remaining -= len(chunk)
+            os.replace(path + ".part", path)
+
+    @staticmethod
+    def plainName(name):
+        """ ===============================================
+        Check a name from a message is a plain file name
+        that can not point outside the work directory
+        =============================================== """
+        return isinstance(name, str) and name not in ('', '.', '..') and \
+            os.path.basename(name) == name and '/' not in name and '\\' not in name
+
+    @staticmethod
+    def plainArgs(args):
+        """ ===============================================
+        Check tool args from a message are plain options and
+        values. Paths could make a tool read or write files
+        outside the work directory.
+        =============================================== """
+        return isinstance(args, list) and all(
+            isinstance(arg, str) and '/' not in arg and '\\' not in arg and '..' not in arg for arg in args)
+
+    @staticmethod
+    def fileList(paths):
+        """ ===============================================
+        List files for a message
+        =============================================== """
+        return [{"name": os.path.basename(path), "size": os.path.getsize(path)} for path in paths]
+
+    def info(self):
+        """ ===============================================
+        Cores and load of this host for choosing workers
+        =============================================== """
+        load = os.getloadavg()[0] if hasattr(os, 'getloadavg') else 0.0
+        return {"type": "info", "cores": self.cores, "load": load, "running": self.running}
+
+    def handle(self, conn):
+        """ ===============================================
+        Handle a single connection: an info request or a job
+        =============================================== """
+        message = self.recv(conn)
+        if message.get('type') == 'info':
+            self.send(conn, self.info())
+            return
+        if message.get('type') != 'job':
+            return
+
+        if self.secret and not hmac.compare_digest(str(message.get('secret') or '').encode(), self.secret.encode()):
+            self.send(conn, {"type": "error", "error": "bad secret"})
+            return
+
+        if not self.plainName(message.get('basename')):
+            self.send(conn, {"type": "error", "error": "bad map name " + repr(message.get('basename'))})
+            return
+
+        work_dir = tempfile.mkdtemp(prefix="qruncher-")
+        try:
+            self.recvFiles(conn, message['files'], work_dir)
+
+            stage = message['stage']
+            args = message.get('args')
+            if stage not in self.stage_files:
+                self.send(conn, {"type": "error", "error": "can not run " + repr(stage)})
+                return
+            if not self.plainArgs(args):
+                self.send(conn, {"type": "error", "error": "bad args " + repr(args)})
+                return
+
+            # Args come from the coordinator so the output matches what it
+            # records. Only the executable is this host's.
+            if self.compiler.cfg.profileExists('builders', message['build']):
+                tool = self.compiler.getTool(self.compiler.cfg.getProfile('builders', message['build']), stage)
+            else:
+                tool = {"path": self.compiler.cfg.config['config']['tool_path'] + os.sep + stage}
+            if not os.path.exists(tool['path']):
+                self.send(conn, {"type": "error", "error": stage + " not found: " + tool['path']})
+                return
+
+            bsp_path = os.path.join(work_dir, message['basename'] + ".bsp")
+            print("Job: " + stage + " " + message['basename'] + " (" + message['build'] + ")")
+            with self.lock:
+                self.running += 1
+            try:
+                result = self.compiler.runTool([tool['path']] + args + [bsp_path], tool,
+                    log=lambda line: self.send(conn, {"type": "log", "line": line}), cwd=work_dir)
+            finally:
+                with self.lock:
+                    self.running -= 1
+
+            outputs = [os.path.join(work_dir, message['basename'] + ext) for ext in self.stage_files[stage][1]]
+            outputs = [path for path in outputs if os.path.exists(path)]
+            self.send(conn, {"type": "done", "result": result, "args": args, "files": self.fileList(outputs)})
+            self.sendFiles(conn, outputs)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def serve(self):
+        """ ===============================================
+        Accept jobs until interrupted. Every connection is
+        handled in its own thread.
+        =============================================== """
+        # Without a secret anyone could send jobs, so only this host may
+        host = '0.0.0.0' if self.secret else '127.0.0.1'
+        if not self.secret:
+            print("No worker_secret set. Only accepting jobs from this host")
+
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, self.port))
+        server.listen(16)
+        print("Build worker listening on " + host + ":" + str(self.port) + " (" + str(self.cores) + " cores)")
+
+        def run(conn):
+            with conn:
+                try:
+                    self.handle(conn)
+                except (OSError, ValueError, KeyError) as e:
+                    print("Job failed: " + str(e))
+
+        try:
+            while True:
+                conn, _ = server.accept()
+                threading.Thread(target=run, args=(conn,), daemon=True).start()
+        except KeyboardInterrupt:
+            print("Build worker stopped")
+        finally:
+            server.close()
+
+
+class QWorkerClient:
+    """
+    Coordinator side of a build worker
+    ...
+    Attributes
+    ----------
+    address : str
+        host:port of the worker
+    secret : str
+        Shared secret of the workers. None if not used.
+
+    Methods
+    -------
+    info()
+        Ask the worker for its cores and load
+    runStage(build_name, stage, args, inputs, output_dir, log)
+        Run a stage on the worker
+    choose(workers, secret)
+        Pick the least busy worker
+    """
+    def __init__(self, address, secret=None):
+        """ QWorkerClient Init ================= """
+        self.address = address
+        self.secret = secret
+        host, port = address.rsplit(':', 1)
+        self.host = host
+        self.port = int(port)
+
+    def connect(self):
+        """ ===============================================
+        Connect to the worker. Only connecting times out,
+        jobs can take hours.
+        =============================================== """
+        sock = socket.create_connection((self.host, self.port), timeout=3)
+        sock.settimeout(None)
+        return sock
+
+    def info(self):
+        """ ===============================================
+        Ask the worker for its cores and load
+
+        Returns
+        -------
+        dict
+            cores, load and running jobs. None if the worker
+            did not answer.
+        =============================================== """
+        try:
+            with self.connect() as sock:
+                sock.settimeout(3)
+                QWorker.send(sock, {"type": "info"})
+                return QWorker.recv(sock)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def choose(workers, secret=None):
+        """ ===============================================
+        Pick the worker with the most idle cores. Workers
+        are asked at the same time.
+
+        Parameters
+        ----------
+        workers : list
+            host:port of every worker
+        secret : str
+            Shared secret of the workers
+
+        Returns
+        -------
+        QWorkerClient
+            The chosen worker. None if none is idle.
+        =============================================== """
+        clients = [QWorkerClient(address, secret) for address in workers]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(clients)) as pool:
+            infos = list(pool.map(lambda client: client.info(), clients))
+
+        best = None
+        best_idle = 0
+        for client, info in zip(clients, infos):
+            if info is None:
+                continue
+            idle = info['cores'] - max(info['load'], info['running'])
+            if idle > best_idle:
+                best, best_idle = client, idle
+        return best
+
+    def runStage(self, build_name, stage, args, inputs, output_dir, log):
+        """ ===============================================
+        Run a stage on the worker
+
+        Parameters
+        ----------
+        build_name : str
+            BUILD profile the worker takes the executable from
+        stage : str
+            Name of the stage
+        args : list
+            Args to run the tool with
+        inputs : list
+            Paths of the input files
+        output_dir : str
+            Where the output files are written
+        log : function
+            Line handler for the stage output
+
+        Returns
+        -------
+        dict
+            Result like QCompiler.runTool, with the args the
+            worker ran the tool with
+        =============================================== """
+        with self.connect() as sock:
+            QWorker.send(sock, {
+                "type": "job",
+                "secret": self.secret,
+                "build": build_name,
+                "stage": stage,
+                "args": args,
+                "basename": os.path.splitext(os.path.basename(inputs[0]))[0],
+                "files": QWorker.fileList(inputs)
+            })
+            QWorker.sendFiles(sock, inputs)
+
+            while True:
+                message = QWorker.recv(sock)
+                if message['type'] == 'log':
+                    print(message['line'])
+                    log(message['line'])
+                elif message['type'] == 'error':
+                    raise WorkerException(message['error'])
+                elif message['type'] == 'done':
+                    # An output built with other args would be recorded as ours
+                    if message.get('args') != args:
+                        raise WorkerException("ran " + stage + " with " + repr(message.get('args'))
+                            + " instead of " + repr(args))
+                    QWorker.recvFiles(sock, message['files'], output_dir)
+                    message['result']['args'] = message['args']
+                    return message['result']
+
+
+""" =================================== PORTAL FILE ===========================
+=========================================================================== """
+class QPortalFile:
+    """
+    Streaming reader for the .prt portal files qbsp writes (PRT1, PRT2
+    and PRT1-AM). Portals are read one line at a time and only counts,
+    areas and a coarse grid of where they are kept, so large files
+    do not need much memory.
+    ...
+    Attributes
+    ----------
+    prt_path : str
+        Full path to the .prt file
+
+    Methods
+    -------
+    analyze(top)
+        Count leafs, clusters and portals and find the hotspots
+    printAnalysis(portals, estimate)
+        Print the result of analyze
+    """
+    # Size of the grid cells portals are counted in, in map units
+    cell_size = 512
+
+    def __init__(self, prt_path):
+        """ QPortalFile Init =================== """
+        self.prt_path = prt_path
+
+    @staticmethod
+    def polygon(line):
+        """ ===============================================
+        Area and center of a portal line:
+        <numpoints> <cluster> <cluster> (x y z) (x y z) ...
+        =============================================== """
+        points = [tuple(float(v) for v in point.split())
+            for point in re.findall(r'\(([^)]*)\)', line)]
+        if not points:
+            return 0.0, (0.0, 0.0, 0.0)
+
+        center = tuple(sum(point[axis] for point in points) / len(points) for axis in range(3))
+        x, y, z = 0.0, 0.0, 0.0
+        origin = points[0]
+        for a, b in zip(points[1:], points[2:]):
+            u = [a[i] - origin[i] for i in range(3)]
+            v = [b[i] - origin[i] for i in range(3)]
+            x += u[1] * v[2] - u[2] * v[1]
+            y += u[2] * v[0] - u[0] * v[2]
+            z += u[0] * v[1] - u[1] * v[0]
+        return 0.5 * (x * x + y * y + z * z) ** 0.5, center
+
+    def analyze(self, top=5):
+        """ ===============================================
+        Read the portal file
+
+        Parameters
+        ----------
+        top : int
+            Number of hotspots to report
+
+        Returns
+        -------
+        dict
+            format, leafs, clusters, portals, total area, the
+            number of tiny portals (under 1 unit) and the grid
+            cells with the most portals. None if the file is
+            missing or not a portal file.
+        =============================================== """
+        try:
+            prt_file = open(self.prt_path, errors='replace')
+        except FileNotFoundError:
+            return None
+
+        with prt_file:
+            prt_format = prt_file.readline().strip()
+            try:
+                if prt_format == 'PRT1':
+                    leafs = int(prt_file.readline())
+                    clusters = leafs
+                    count = int(prt_file.readline())
+                elif prt_format == 'PRT2':
+                    leafs = int(prt_file.readline())
+                    clusters = int(prt_file.readline())
+                    count = int(prt_file.readline())
+                elif prt_format == 'PRT1-AM':
+                    clusters = int(prt_file.readline())
+                    count = int(prt_file.readline())
+                    leafs = int(prt_file.readline())
+                else:
+                    print("Unknown portal file format: " + prt_format)
+                    return None
+            except ValueError:
+                print("Malformed portal file header: " + self.prt_path)
+                return None
+
+            area = 0.0
+            tiny = 0
+            read = 0
+            cells = {}
+            for line in prt_file:
+                if read == count:
+                    # Leaf to cluster mapping of PRT2/PRT1-AM is not needed
+                    break
+                if not line.strip():
+                    continue
+                portal_area, center = self.polygon(line)
+                read += 1
+                area += portal_area
+                if portal_area < 1:
+                    tiny += 1
+                cell = tuple(int(c // self.cell_size) for c in center)
+                hits = cells.setdefault(cell, [0, 0.0])
+                hits[0] += 1
+                hits[1] += portal_area
+
+        hotspots = []
+        for cell, hits in sorted(cells.items(), key=lambda item: item[1][0], reverse=True)[:top]:
+            hotspots.append({
+                "center": [(c + 0.5) * self.cell_size for c in cell],
+                "portals": hits[0],
+                "area": round(hits[1], 1)
+            })
+
+        if read != count:
+            print("WARNING: " + self.prt_path + " has " + str(read) + " of " + str(count) + " portals")
+
+        return {
+            "format": prt_format,
+            "leafs": leafs,
+            "clusters": clusters,
+            "portals": read,
+            "area": round(area, 1),
+            "tiny": tiny,
+            "hotspots": hotspots
+        }
+
+    @staticmethod
+    def printAnalysis(portals, estimate):
+        """ ===============================================
+        Print the result of analyze and the vis estimate
+        =============================================== """
+        print("\nQCruncher Portal Report (" + portals['format'] + ")")
+        print("-----------------------------------------------")
+        print("Leafs\tClusters\tPortals\tTiny\tEst. vis")
+        print("-----------------------------------------------")
+        print(str(portals['leafs']) + "\t" + str(portals['clusters']) + "\t\t" + str(portals['portals'])
+            + "\t" + str(portals['tiny']) + "\t" + (format_duration(estimate) if estimate is not None else "unknown"))
+        print("Hotspot (center)\t\tPortals\tArea")
+        for hotspot in portals['hotspots']:
+            print("(" + " ".join(str(int(c)) for c in hotspot['center']) + ")\t\t"
+                + str(hotspot['portals']) + "\t" + str(hotspot['area']))
+        print("")
+
+
+class QVisEstimate:
+    """
+    Estimates vis time from the portal count. Vis compares portals with
+    each other so its work grows with the square of the portals. The
+    seconds per unit of work are learned from earlier vis runs of the
+    map with the same args, or taken from 'vis_rate' in the config.
+    ...
+    Attributes
+    ----------
+    history_file : str
+        Path to the json file with earlier vis runs of the map
+    rate : float
+        Seconds per million units of work when there is no history
+    history : list
+        Earlier vis runs, oldest first
+
+    Methods
+    -------
+    estimate(portals, args)
+        Estimated seconds vis will take
+    learn(portals, args, result)
+        Remember a finished vis run
+    """
+    keep = 20
+
+    def __init__(self, history_file, rate=None):
+        """ QVisEstimate Init ================== """
+        self.history_file = history_file
+        self.rate = float(rate) if rate else None
+        try:
+            with open(self.history_file) as history_json:
+                self.history = json.load(history_json)
+        except (FileNotFoundError, ValueError):
+            self.history = []
+
+    @staticmethod
+    def work(portals):
+        """ ===============================================
+        Units of vis work for a portal analysis (millions
+        of portal pairs)
+        =============================================== """
+        return portals['portals'] ** 2 / 1000000.0
+
+    def estimate(self, portals, args):
+        """ ===============================================
+        Estimate how long vis will take
+
+        Parameters
+        ----------
+        portals : dict
+            Result of QPortalFile.analyze
+        args : list
+            Args of the vis tool
+
+        Returns
+        -------
+        float
+            Seconds. None if there is nothing to base it on.
+        =============================================== """
+        rate = self.rate
+        for run in reversed(self.history):
+            if run['args'] == args and run['work'] > 0:
+                rate = run['seconds'] / run['work']
+                break
+        if rate is None:
+            return None
+        return round(rate * self.work(portals), 1)
+
+    def learn(self, portals, args, result):
+        """ ===============================================
+        Remember a finished vis run. Failed and remote runs
+        are not used, their time says nothing about this
+        machine.
+
+        Parameters
+        ----------
+        portals : dict
+            Result of QPortalFile.analyze
+        args : list
+            Args vis ran with
+        result : dict
+            Result of QCompiler.runTool
+        =============================================== """
+        if result['returncode'] != 0 or 'worker' in result:
+            return
+        self.history.append({
+            "portals": portals['portals'],
+            "work": self.work(portals),
+            "args": args,
+            "seconds": result['seconds']
+        })
+        self.history = self.history[-self.keep:]
+        with open(self.history_file, 'w') as history_json:
+            json.dump(self.history, history_json, indent=2, separators=(',', ': '))
+
+
+""" =================================== BENCHMARK =============================
+=========================================================================== """
+class QBench:
+    """
+    Runtime benchmark of a compiled map in the engine. The engine is
+    launched with the 'bench' args of the ENGINE profile and its output
+    is parsed for frames/sec, frame times and map load time.
+    ...
+    Attributes
+    ----------
+    bench_file : str
+        NDJSON history of benchmarks of the map
+    engine : dict
+        ENGINE profile
+
+    Methods
+    -------
+    run(engine_exe, map_basename, runs)
+        Run the benchmark and parse the results
+    record(result)
+        Add a result to the history
+    printHistory()
+        Print a comparison of the benchmarks of the map
+    recordDeploy(deploy_file, bsp_path, build_name, settings)
+        Remember the build profile and args of a deployed .bsp
+    deployedBuild(deploy_file, bsp_hash)
+        Look up the build that deployed a .bsp
+    """
+    # Deployed .bsp files remembered per map
+    deploy_keep = 50
+    # timerefresh renders 128 frames spinning around, works on any map.
+    # Override with e.g. ["+timedemo", "{map}_demo"] in the engine profile.
+    default_args = ["+map", "{map}", "+wait", "+timerefresh", "+quit"]
+    default_patterns = {
+        # Quake timedemo: "1234 frames 12.3 seconds 100.3 fps"
+        "fps": r'([\d.]+)\s*fps',
+        # Engines that print per frame times
+        "frame_ms": r'frame\s*time[:=\s]+([\d.]+)\s*ms',
+        # Engines that print how long the map took to load
+        "load_seconds": r'(?:map|level)\s+load(?:ed)?(?:\s+in|\s+time)?[:=\s]+([\d.]+)'
+    }
+
+    def __init__(self, bench_file, engine):
+        """ QBench Init ======================== """
+        self.bench_file = bench_file
+        self.engine = engine
+        self.patterns = dict(self.default_patterns)
+        self.patterns.update(engine.get('bench_patterns', {}))
+
+    @staticmethod
+    def readDeploys(deploy_file):
+        """ ===============================================
+        Read the deployed builds of a map, oldest first
+        =============================================== """
+        try:
+            with open(deploy_file) as deploys_json:
+                return json.load(deploys_json)
+        except (FileNotFoundError, ValueError):
+            return []
+
+    @staticmethod
+    def recordDeploy(deploy_file, bsp_path, build_name, settings):
+        """ ===============================================
+        Remember which build profile and tool args made a
+        deployed .bsp, keyed by its hash.
+
+        Parameters
+        ----------
+        deploy_file : str
+            json file with the deployed builds of the map
+        bsp_path : str
+            Path the .bsp was deployed to
+        build_name : str
+            Name of the BUILD profile
+        settings : dict
+            Stage name to the args it ran with
+        =============================================== """
+        bsp_hash = QManifest.hashFile(bsp_path)
+        deploys = [d for d in QBench.readDeploys(deploy_file) if d['bsp_hash'] != bsp_hash]
+        deploys.append({
+            "bsp_hash": bsp_hash,
+            "path": bsp_path,
+            "build": build_name,
+            "settings": settings,
+            "time": datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        })
+        with open(deploy_file, 'w') as deploys_json:
+            json.dump(deploys[-QBench.deploy_keep:], deploys_json, indent=2, separators=(',', ': '))
+
+    @staticmethod
+    def deployedBuild(deploy_file, bsp_hash):
+        """ ===============================================
+        Look up the build that deployed a .bsp
+
+        Returns
+        -------
+        dict
+            build and settings. None if qruncher did not
+            deploy a .bsp with this hash.
+        =============================================== """
+        for deploy in reversed(QBench.readDeploys(deploy_file)):
+            if deploy['bsp_hash'] == bsp_hash:
+                return deploy
+        return None
+
+    @staticmethod
+    def percentile(values, pct):
+        """ ===============================================
+        Nearest rank percentile of a list of numbers
+        =============================================== """
+        ordered = sorted(values)
+        rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))) - 1))
+        return ordered[rank]
+
+    def runOnce(self, engine_exe, map_basename):
+        """ ===============================================
+        Run the engine once and parse its output
+
+        Returns
+        -------
+        dict
+            fps, frame times, load time and wall time
+        =============================================== """
+        args = [arg.replace('{map}', map_basename) for arg in self.engine.get('bench', self.default_args)]
+        started = time.time()
+        proc = subprocess.Popen(engine_exe + args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        fps = []
+        frames = []
+        load_seconds = None
+        for raw in proc.stdout:
+            line = raw.decode(errors='replace').rstrip('\r\n')
+            print(line)
+            match = re.search(self.patterns['fps'], line, re.IGNORECASE)
+            if match:
+                fps.append(float(match.group(1)))
+            match = re.search(self.patterns['frame_ms'], line, re.IGNORECASE)
+            if match:
+                frames.append(float(match.group(1)))
+            match = re.search(self.patterns['load_seconds'], line, re.IGNORECASE)
+            if match and load_seconds is None:
+                load_seconds = float(match.group(1))
+        proc.wait()
+
+        return {"fps": fps[-1] if fps else None, "frames": frames,
+            "load_seconds": load_seconds, "wall_seconds": time.time() - started}
+
+    def run(self, engine_exe, map_basename, runs=1):
+        """ ===============================================
+        Run the benchmark runs times. fps is the median of
+        the runs, frame time percentiles use the frames of
+        all runs.
+
+        Parameters
+        ----------
+        engine_exe : list
+            Command to launch the engine with the mod
+        map_basename : str
+            Name of the map without ext
+        runs : int
+            Number of times to run the benchmark
+
+        Returns
+        -------
+        dict
+            Benchmark result. None if no fps was found.
+        =============================================== """
+        results = []
+        for run in range(runs):
+            print("Benchmark run " + str(run + 1) + "/" + str(runs) + " of " + map_basename)
+            results.append(self.runOnce(engine_exe, map_basename))
+
+        fps = [r['fps'] for r in results if r['fps'] is not None]
+        if not fps:
+            return None
+
+        frames = [ms for r in results for ms in r['frames']]
+        loads = [r['load_seconds'] for r in results if r['load_seconds'] is not None]
+        result = {
+            "map": map_basename,
+            "runs": runs,
+            "fps": round(self.percentile(fps, 50), 2),
+            "frame_ms": None,
+            "load_seconds": round(self.percentile(loads, 50), 3) if loads else None,
+            "wall_seconds": round(self.percentile([r['wall_seconds'] for r in results], 50), 3)
+        }
+        if frames:
+            result['frame_ms'] = {
+                "p50": self.percentile(frames, 50),
+                "p90": self.percentile(frames, 90),
+                "p99": self.percentile(frames, 99),
+                "max": max(frames)
+            }
+        return result
+
+    def record(self, result):
+        """ ===============================================
+        Add a result to the history of the map
+        =============================================== """
+        os.makedirs(os.path.dirname(self.bench_file), exist_ok=True)
+        with open(self.bench_file, 'a') as bench:
+            bench.write(json.dumps(result) + "\n")
+
+    def history(self):
+        """ ===============================================
+        All benchmark results of the map, oldest first
+        =============================================== """
+        results = []
+        try:
+            with open(self.bench_file) as bench:
+                for line in bench:
+                    if line.strip():
+                        results.append(json.loads(line))
+        except FileNotFoundError:
+            pass
+        return results
+
+    def printHistory(self, count=10):
+        """ ===============================================
+        Print the last benchmarks of the map, with the
+        change in fps against the run before.
+        =============================================== """
+        results = self.history()[-count:]
+        print("\nQCruncher Benchmark Report")
+        print("-----------------------------------------------")
+        print("Date/time\t\tBuild\tEngine\tBSP\t\tFPS\tChange\tp50ms\tp99ms\tLoad")
+        print("-----------------------------------------------")
+        previous = None
+        for r in results:
+            change = ''
+            if previous and previous['fps']:
+                change = "%+.1f%%" % ((r['fps'] - previous['fps']) / previous['fps'] * 100)
+            frame = r.get('frame_ms') or {}
+            load = r.get('load_seconds')
+            if load is None:
+                load = "~" + str(r['wall_seconds'])
+            print(r['time']+"\t"+str(r['build'])+"\t"+r['engine']+"\t"+r['bsp_hash'][:8]+"\t"
+                + str(r['fps'])+"\t"+change+"\t"+str(frame.get('p50', '-'))+"\t"
+                + str(frame.get('p99', '-'))+"\t"+str(load))
+            previous = r
+
+
+""" =================================== EXCEPTIONS ============================
+=========================================================================== """
+class ProfileNotFoundException(Exception):
+    def __init__(self, pType, profile_name):
+        print("ERROR: Profile Not Found: Type="+pType+" Name="+profile_name)
+        print("")
+
+class NoDefaultProfileException(Exception):
+    def __init__(self, pType):
+        print("ERROR: No default profile for: "+pType)
+
+class WorkerException(Exception):
+    pass
+
+class PakException(Exception):
+    def __init__(self, pak_path, reason):
+        print("ERROR: Bad pak file: "+pak_path+" ("+reason+")")
+        
+
+
+""" =================================== MAIN ==================================
+=========================================================================== """
+def main():
+    config_file = 'qruncher.json'
+    app = QCompile(config_file)
+
+    # Engine session takes mod:<name> as well, so it is handled
+    # before config mode
+    if app.opts.get('engine') == 'session':
+        app.compiler.runSession(app.opts)
+        sys.exit(0)
+
+    # Same for benchmarks, which take engine: and mod:
+    if 'bench' in app.opts:
+        app.compiler.runBench(app.opts)
+        sys.exit(0)
+
+    if len(app.opts) <= 2: # Config Mode
+        profile_name = None
+        try:
+            profile_name = app.opts['profile_name']
+            del app.opts['profile_name']
+        except KeyError:
+            pass
+        cmd = list(app.opts.keys())[0]
+        opt = list(app.opts.values())[0]
+
+        # Check to see if it is BUILD
+        # and the option IS a profile. This means that we are going 
+        # to use ALL defaults on everything except the build.
+        if cmd == 'build' and (app.isProfile(opt) or ',' in opt):
+            app.compiler.runBuild(app.opts)
+            print("Proceed to building")
+
+        # Handle builds
+        if cmd == 'build':
+            if opt == 'list':
+                app.config.listBuilders()
+                sys.exit(0)
+            if opt == 'show':
+                app.config.showBuilders(profile_name)
+                sys.exit(0)
+            if opt == 'new':
+                app.config.scaffoldNew('builders', profile_name)
+                app.config.saveFiles()
+                sys.exit(0)
+            if opt == 'del':
+                if query_yes_no("Confirm"):
+                    app.config.deleteProfile('builders', profile_name)
+                    app.config.saveFiles()
                 sys.exit(0)
         # Handle Maps
         elif cmd == 'map':
@@ -911,6 +5359,20 @@ def main():
                     app.config.deleteProfile('maps', profile_name)
                     app.config.saveFiles()
                 sys.exit(0)
+            if opt == 'portals':
+                app.compiler.showPortals(profile_name)
+                sys.exit(0)
+            if opt == 'scan':
+                scanner = QScanner(profile_name)
+                map_paths = scanner.scan()
+                counts = app.config.mergeMapProfiles(map_paths)
+                app.config.saveFiles()
+                print("Scanned " + str(scanner.scanned) + " directories ("
+                    + str(scanner.reused) + " unchanged) under " + scanner.root)
+                print("Found " + str(len(map_paths)) + " maps: "
+                    + str(counts['created']) + " created, " + str(counts['updated'])
+                    + " updated, " + str(counts['unchanged']) + " unchanged")
+                sys.exit(0)
 
         # Handle Engine
         elif cmd == 'engine':
@@ -947,6 +5409,18 @@ def main():
                     app.config.deleteProfile('mods', profile_name)
                     app.config.saveFiles()
                 sys.exit(0)
+        elif cmd == 'worker':
+            if opt == 'serve':
+                port = int(profile_name or app.config.config['config'].get('worker_port', 7788))
+                QWorker(app.compiler, port).serve()
+                sys.exit(0)
+            if opt == 'list':
+                app.compiler.listWorkers()
+                sys.exit(0)
+        elif cmd == 'log':
+            if opt == 'diff':
+                app.compiler.logDiff(profile_name)
+                sys.exit(0)
         elif cmd == 'play':
             pass
         else:
@@ -960,6 +5434,59 @@ def main():
 
     sys.exit(0)
 
+def parse_size(size):
+    """ ===============================================
+    Parse a memory size from the config
+
+    Parameters
+    ----------
+    size : str or int
+        Bytes, or a number with K, M or G (8G, 512M)
+
+    Returns
+    -------
+    int
+        Size in bytes
+    =============================================== """
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def parse_duration(duration):
+    """ ===============================================
+    Parse a duration from the config
+
+    Parameters
+    ----------
+    duration : str or int
+        Seconds, or a number with s, m or h (90s, 10m, 2h)
+
+    Returns
+    -------
+    float
+        Duration in seconds
+    =============================================== """
+    units = {'S': 1, 'M': 60, 'H': 3600}
+    duration = str(duration).strip().upper()
+    if duration and duration[-1] in units:
+        return float(duration[:-1]) * units[duration[-1]]
+    return float(duration)
+
+def format_duration(seconds):
+    """ ===============================================
+    Format seconds as 1h 2m 3s
+    =============================================== """
+    seconds = int(round(seconds))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return str(hours) + "h " + str(minutes) + "m " + str(seconds) + "s"
+    if minutes:
+        return str(minutes) + "m " + str(seconds) + "s"
+    return str(seconds) + "s"
+
 def query_yes_no(question):
     valid = {"yes": True, "y": True, "ye": True,
              "no": False, "n": False}
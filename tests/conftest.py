@@ -0,0 +1,67 @@
+import os
+import sys
+import json
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOOLS = os.path.join(ROOT, "tests", "tools")
+sys.path.insert(0, ROOT)
+
+import qruncher
+
+
+def waitFor(check, timeout=10):
+    """ Poll check until it is true. False on timeout """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if check():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def writeConfig(directory, **config):
+    """ ===============================================
+    Write a qruncher.json using the stand-in tools. The
+    map lives in <directory>/maps, quake in
+    <directory>/quake. Extra keyword args go into the
+    config section.
+    =============================================== """
+    maps_dir = os.path.join(directory, "maps")
+    base_path = os.path.join(directory, "quake")
+    os.makedirs(maps_dir, exist_ok=True)
+    os.makedirs(os.path.join(base_path, "id1", "maps"), exist_ok=True)
+    map_path = os.path.join(maps_dir, "test.map")
+    if not os.path.exists(map_path):
+        with open(map_path, 'w') as map_file:
+            map_file.write('{\n"classname" "worldspawn"\n}\n')
+
+    settings = {"base_path": base_path, "tool_path": TOOLS}
+    settings.update(config)
+    with open(os.path.join(directory, "qruncher.json"), 'w') as config_json:
+        json.dump({
+            "config": settings,
+            "builders": [{
+                "name": "default",
+                "default": True,
+                "tools": [
+                    {"name": "qbsp", "path": False, "args": []},
+                    {"name": "light", "path": False, "args": []},
+                    {"name": "vis", "path": False, "args": []}
+                ]
+            }],
+            "maps": [{"name": "test", "default": True, "source": map_path, "dest": False}],
+            "engines": [{"name": "default", "default": True, "path": os.path.join(TOOLS, "engine"), "args": []}],
+            "mods": [{"name": "default", "default": True, "subdir": "id1"}]
+        }, config_json, indent=2)
+    return map_path
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    """ A config with the stand-in tools in the current directory """
+    writeConfig(str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,127 @@
+import os
+import sys
+import json
+import shutil
+
+import pytest
+
+from conftest import TOOLS, qruncher
+
+
+def engine(**profile):
+    engine_profile = {"name": "default", "path": os.path.join(TOOLS, "engine"), "args": []}
+    engine_profile.update(profile)
+    return engine_profile
+
+
+def setBuilderArgs(project, builder, stage, args):
+    """ Change the args of a stage in qruncher.json """
+    with open(str(project / "qruncher.json")) as config_json:
+        config = json.load(config_json)
+    for profile in config['builders']:
+        if profile['name'] == builder:
+            for tool in profile['tools']:
+                if tool['name'] == stage:
+                    tool['args'] = args
+    with open(str(project / "qruncher.json"), 'w') as config_json:
+        json.dump(config, config_json)
+
+
+def addBuilder(project, name, vis_args):
+    with open(str(project / "qruncher.json")) as config_json:
+        config = json.load(config_json)
+    builder = json.loads(json.dumps(config['builders'][0]))
+    builder.update({"name": name, "default": False})
+    for tool in builder['tools']:
+        if tool['name'] == 'vis':
+            tool['args'] = vis_args
+    config['builders'].append(builder)
+    with open(str(project / "qruncher.json"), 'w') as config_json:
+        json.dump(config, config_json)
+
+
+def test_engine_prints_timerefresh_results(tmp_path, monkeypatch):
+    monkeypatch.setenv('STANDIN_ENGINE_LOG', str(tmp_path / "engine.log"))
+    bench = qruncher.QBench(str(tmp_path / "bench.jsonl"), engine())
+
+    result = bench.run([os.path.join(TOOLS, "engine"), "-game", "id1"], "test")
+
+    assert result['fps'] == 80.0
+    assert result['frame_ms'] == {"p50": 50.0, "p90": 90.0, "p99": 99.0, "max": 100.0}
+    assert result['load_seconds'] == 0.25
+    with open(str(tmp_path / "engine.log")) as log:
+        assert log.read().splitlines()[1:] == ["map test", "wait", "timerefresh", "quit"]
+
+
+def test_timedemo_results_over_several_runs(tmp_path):
+    bench = qruncher.QBench(str(tmp_path / "bench.jsonl"),
+        engine(bench=["+map", "{map}", "+timedemo", "{map}_demo", "+quit"]))
+
+    result = bench.run([os.path.join(TOOLS, "engine")], "test", runs=3)
+
+    assert result['runs'] == 3
+    assert result['fps'] == 80.0
+    assert result['frame_ms']['p99'] == 99.0
+    assert result['load_seconds'] == 0.25
+
+
+def test_no_fps_in_output(tmp_path):
+    bench = qruncher.QBench(str(tmp_path / "bench.jsonl"), engine(bench=["+map", "{map}", "+quit"]))
+
+    assert bench.run([os.path.join(TOOLS, "engine")], "test") is None
+
+
+def test_bench_records_settings_the_bsp_was_built_with(project):
+    setBuilderArgs(project, 'default', 'light', ['-extra'])
+    with pytest.raises(SystemExit):
+        qruncher.QCompiler().runBuild({'build': 'default'})
+
+    # Edited after the build. The benchmark is of the old build.
+    os.chdir(str(project))
+    setBuilderArgs(project, 'default', 'light', ['-extra4'])
+    qruncher.QCompiler().runBench({'bench': 'test'})
+
+    bench = qruncher.QBench(str(project / "maps" / ".qruncher" / "bench" / "test.jsonl"), engine())
+    result = bench.history()[-1]
+    assert result['build'] == 'default'
+    assert result['settings'] == {"qbsp": [], "vis": [], "light": ["-extra"]}
+    assert result['fps'] == 80.0
+
+
+def test_bench_matrix_profile(project, monkeypatch):
+    monkeypatch.setenv('STANDIN_ENGINE_LOG', str(project / "engine.log"))
+    addBuilder(project, 'fast', ['-fast'])
+    with pytest.raises(SystemExit):
+        qruncher.QCompiler().runBuild({'build': 'default,fast'})
+
+    os.chdir(str(project))
+    qruncher.QCompiler().runBench({'bench': 'test', 'build': 'fast'})
+
+    bench = qruncher.QBench(str(project / "maps" / ".qruncher" / "bench" / "test.jsonl"), engine())
+    result = bench.history()[-1]
+    assert result['build'] == 'fast'
+    assert result['settings']['vis'] == ['-fast']
+    with open(str(project / "engine.log")) as log:
+        assert "map test_fast" in log.read().splitlines()
+
+
+def test_bench_runs_app_bundle_executable_on_macos(project, monkeypatch):
+    with pytest.raises(SystemExit):
+        qruncher.QCompiler().runBuild({'build': 'default'})
+    os.chdir(str(project))
+
+    # An engine .app with the stand-in engine inside
+    app = project / "Engine.app"
+    (app / "Contents" / "MacOS").mkdir(parents=True)
+    shutil.copy(os.path.join(TOOLS, "engine"), str(app / "Contents" / "MacOS" / "engine"))
+    with open(str(project / "qruncher.json")) as config_json:
+        config = json.load(config_json)
+    config['engines'][0]['path'] = str(app)
+    with open(str(project / "qruncher.json"), 'w') as config_json:
+        json.dump(config, config_json)
+
+    monkeypatch.setattr(sys, 'platform', 'darwin')
+    qruncher.QCompiler().runBench({'bench': 'test'})
+
+    bench = qruncher.QBench(str(project / "maps" / ".qruncher" / "bench" / "test.jsonl"), engine())
+    assert bench.history()[-1]['fps'] == 80.0
@@ -0,0 +1,93 @@
+import os
+import gzip
+
+import pytest
+
+from conftest import qruncher, writeConfig
+
+
+def build(**opts):
+    cwd = os.getcwd()
+    opts.setdefault('build', 'default')
+    with pytest.raises(SystemExit):
+        qruncher.QCompiler().runBuild(opts)
+    os.chdir(cwd)
+
+
+def archive(project):
+    return qruncher.QLogArchive(str(project / "maps" / ".qruncher" / "logs" / "test"))
+
+
+def test_every_build_is_archived_with_its_warnings(project):
+    build()
+    build(force='yes')
+
+    logs = archive(project)
+    assert len(logs.index) == 2
+    assert logs.index[0]['stamp'] != logs.index[1]['stamp']
+    newest = logs.index[-1]
+    assert newest['build'] == "default"
+    assert newest['stages'] == ['qbsp', 'vis', 'light']
+    assert newest['counts'] == {"leak": 1, "light": 1}
+
+    with gzip.open(os.path.join(logs.log_path, newest['archive']), 'rt') as log:
+        text = log.read()
+    assert "==== qbsp: " in text and "==== light: " in text
+    assert "WARNING: entity 7 (light) at (4 5 6) overlaps light" in text
+
+    warnings = logs.readWarnings(newest)
+    leak = [warning for warning in warnings if warning['category'] == 'leak'][0]
+    assert leak == {"stage": "qbsp", "category": "leak", "entity": 2, "classname": "info_null",
+        "coords": [16.0, 32.0, 48.0], "text": "WARNING: entity 2 (info_null) leaked at (16 32 48)"}
+
+
+def test_old_builds_are_dropped(project):
+    writeConfig(str(project), log_keep=2)
+    for _ in range(3):
+        build(force='yes')
+
+    logs = archive(project)
+    assert len(logs.index) == 2
+    kept = set(name for build in logs.index for name in [build['archive'], build['warnings']])
+    assert set(os.listdir(logs.log_path)) == kept | {"index.json"}
+
+
+def test_log_diff_shows_added_and_removed_warnings(project, monkeypatch, capsys):
+    monkeypatch.setenv('STANDIN_QBSP_OUTPUT', "WARNING: texture foo not found;WARNING: brush 3 is degenerate")
+    build()
+    monkeypatch.setenv('STANDIN_QBSP_OUTPUT', "WARNING: brush 3 is degenerate;WARNING: brush 9 is degenerate")
+    build(force='yes')
+    capsys.readouterr()
+
+    qruncher.QCompiler().logDiff(None)
+
+    out = capsys.readouterr().out
+    assert "- [qbsp] WARNING: texture foo not found" in out
+    assert "+ [qbsp] WARNING: brush 9 is degenerate" in out
+    assert "brush 3" not in out
+    assert "1 added, 1 removed" in out
+    assert "Partial build" not in out
+
+
+def test_log_diff_of_partial_build_compares_common_stages(project, monkeypatch, capsys):
+    monkeypatch.setenv('STANDIN_QBSP_OUTPUT', "WARNING: texture foo not found")
+    build()
+    monkeypatch.delenv('STANDIN_QBSP_OUTPUT')
+    build(stages='vis,light')
+    capsys.readouterr()
+
+    qruncher.QCompiler().logDiff(None)
+
+    out = capsys.readouterr().out
+    assert archive(project).index[-1]['stages'] == ['vis', 'light']
+    assert "Partial build, only comparing stages: vis,light" in out
+    assert "0 added, 0 removed" in out
+
+
+def test_log_diff_needs_two_builds(project, capsys):
+    build()
+    capsys.readouterr()
+
+    qruncher.QCompiler().logDiff(None)
+
+    assert "Need two builds of test to diff. Found 1" in capsys.readouterr().out
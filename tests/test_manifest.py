@@ -0,0 +1,96 @@
+import os
+import json
+
+import pytest
+
+from conftest import qruncher
+
+
+def build(**opts):
+    """ Run a build and return to the project directory """
+    cwd = os.getcwd()
+    opts.setdefault('build', 'default')
+    with pytest.raises(SystemExit):
+        qruncher.QCompiler().runBuild(opts)
+    os.chdir(cwd)
+
+
+def qbspRuns(project):
+    return (project / "maps" / "test.bsp").read_text().count("\nqbsp ")
+
+
+def useWad(project):
+    (project / "maps" / "test.wad").write_bytes(b"WAD2" + b"\0" * 64)
+    (project / "maps" / "test.map").write_text('{\n"classname" "worldspawn"\n"wad" "test.wad"\n}\n')
+
+
+def test_unchanged_build_is_skipped(project, capsys):
+    build()
+    build()
+
+    assert "Nothing changed since last build of test" in capsys.readouterr().out
+    assert qbspRuns(project) == 1
+
+
+def test_wad_change_rebuilds(project, capsys):
+    useWad(project)
+    build()
+    (project / "maps" / "test.wad").write_bytes(b"WAD2" + b"\1" * 64)
+    build()
+
+    assert "changed: " + str(project / "maps" / "test.wad") in capsys.readouterr().out
+
+
+def test_touched_but_unchanged_input_is_skipped(project, capsys):
+    build()
+    os.utime(str(project / "maps" / "test.map"), (1, 1))
+    build()
+
+    assert "Nothing changed since last build of test" in capsys.readouterr().out
+
+
+def test_force_and_args_change_rebuild(project, capsys):
+    build()
+    build(force='yes')
+    with open(str(project / "qruncher.json")) as config_json:
+        config = json.load(config_json)
+    config['builders'][0]['tools'][1]['args'] = ['-extra']
+    with open(str(project / "qruncher.json"), 'w') as config_json:
+        json.dump(config, config_json)
+    build()
+
+    out = capsys.readouterr().out
+    assert "Building test (forced)" in out
+    assert "Building test (build settings changed)" in out
+
+
+def test_up_to_date_check_does_not_read_the_map(project, monkeypatch):
+    useWad(project)
+    build()
+
+    reads = []
+    real_read = qruncher.QMapFile.read
+    monkeypatch.setattr(qruncher.QMapFile, 'read', lambda self: reads.append(self.map_path) or real_read(self))
+    build()
+    assert reads == []
+
+    # A changed map is read again for its WADs
+    (project / "maps" / "test.map").write_text('{\n"classname" "worldspawn"\n}\n')
+    build()
+    assert reads == [str(project / "maps" / "test.map")]
+
+
+def test_stale_build_hashes_every_file_once(project, monkeypatch):
+    useWad(project)
+    build()
+    (project / "maps" / "test.map").write_text('{\n"classname" "worldspawn"\n"wad" "test.wad"\n"message" "x"\n}\n')
+    qruncher.QManifest.hashes.clear()
+
+    hashed = []
+    real_hash = qruncher.QManifest.hashFile
+    monkeypatch.setattr(qruncher.QManifest, 'hashFile', staticmethod(lambda path: hashed.append(path) or real_hash(path)))
+    build()
+
+    inputs = [path for path in hashed if not path.endswith('.bsp')]
+    # Tools and WAD are unchanged by stat, only the .map is hashed
+    assert inputs == [str(project / "maps" / "test.map")]
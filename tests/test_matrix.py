@@ -0,0 +1,130 @@
+import os
+import json
+
+import pytest
+
+from conftest import qruncher
+
+
+def addBuilder(project, name, **vis):
+    """ Copy the default build profile with other vis settings """
+    with open(str(project / "qruncher.json")) as config_json:
+        config = json.load(config_json)
+    builder = json.loads(json.dumps(config['builders'][0]))
+    builder.update({"name": name, "default": False})
+    for tool in builder['tools']:
+        if tool['name'] == 'vis':
+            tool.update(vis)
+    config['builders'].append(builder)
+    # Estimated from vis_rate while the capped vis runs first
+    config['config'].update({"vis_rate": 1000000, "matrix_jobs": 1})
+    with open(str(project / "qruncher.json"), 'w') as config_json:
+        json.dump(config, config_json)
+
+
+def deployed(project, name):
+    path = project / "quake" / "id1" / "maps" / (name + ".bsp")
+    if not path.exists():
+        return None
+    return path.read_text().splitlines()
+
+
+def test_vis_budget_fast_only_downgrades_its_profile(project):
+    addBuilder(project, 'capped', budget="1s", over_budget="fast")
+
+    with pytest.raises(SystemExit):
+        qruncher.QCompiler().runBuild({'build': 'capped,default'})
+
+    assert "vis local " in deployed(project, "test_default")
+    assert "vis local -fast" in deployed(project, "test_capped")
+
+
+def test_vis_budget_fail_stops_its_profile(project):
+    addBuilder(project, 'capped', budget="1s", over_budget="fail")
+
+    with pytest.raises(SystemExit):
+        qruncher.QCompiler().runBuild({'build': 'capped,default'})
+
+    assert "light local " in deployed(project, "test_default")
+    assert deployed(project, "test_capped") is None
+
+
+def addProfiles(project):
+    """ debug and test share qbsp and vis, release has its own vis """
+    with open(str(project / "qruncher.json")) as config_json:
+        config = json.load(config_json)
+    base = config['builders'][0]
+    for name, stage, args in [('debug', None, None), ('test', 'light', ['-extra']), ('release', 'vis', ['-level', '4'])]:
+        builder = json.loads(json.dumps(base))
+        builder.update({"name": name, "default": False})
+        for tool in builder['tools']:
+            if tool['name'] == stage:
+                tool['args'] = args
+        config['builders'].append(builder)
+    with open(str(project / "qruncher.json"), 'w') as config_json:
+        json.dump(config, config_json)
+
+
+def matrix(**opts):
+    cwd = os.getcwd()
+    opts.setdefault('build', 'debug,test,release')
+    with pytest.raises(SystemExit) as exit_info:
+        qruncher.QCompiler().runBuild(opts)
+    os.chdir(cwd)
+    return exit_info.value.code
+
+
+def test_identical_stages_run_once(project, capsys):
+    addProfiles(project)
+
+    matrix()
+
+    assert "Matrix build of test: 6 stages for 3 profiles (3 shared)" in capsys.readouterr().out
+    assert deployed(project, "test_debug")[-2:] == ["vis local ", "light local "]
+    assert deployed(project, "test_test")[-2:] == ["vis local ", "light local -extra"]
+    assert deployed(project, "test_release")[-2:] == ["vis local -level 4", "light local "]
+    # One work directory per stage run
+    work_dirs = os.listdir(str(project / "maps" / ".qruncher" / "matrix"))
+    assert sorted(name.split('-')[0] for name in work_dirs) == ['light'] * 3 + ['qbsp'] + ['vis'] * 2
+
+
+def test_unchanged_profiles_are_skipped(project, capsys):
+    addProfiles(project)
+    matrix()
+    capsys.readouterr()
+
+    matrix()
+    out = capsys.readouterr().out
+    for name in ['debug', 'test', 'release']:
+        assert "Nothing changed since last build of test with " + name + ". Skipping" in out
+    assert "Matrix build" not in out
+
+    with open(str(project / "qruncher.json")) as config_json:
+        config = json.load(config_json)
+    config['builders'][2]['tools'][1]['args'] = ['-extra4']
+    with open(str(project / "qruncher.json"), 'w') as config_json:
+        json.dump(config, config_json)
+    matrix()
+    out = capsys.readouterr().out
+    assert "Building test with test (build settings changed)" in out
+    assert "Matrix build of test: 3 stages for 1 profiles (0 shared)" in out
+    assert deployed(project, "test_test")[-1] == "light local -extra4"
+
+
+def test_matrix_log_is_indexed_by_stage(project):
+    addProfiles(project)
+    matrix()
+
+    logs = qruncher.QLogArchive(str(project / "maps" / ".qruncher" / "logs" / "test-matrix"))
+    assert logs.index[-1]['build'] == "debug,test,release"
+    stages = sorted(warning['stage'] for warning in logs.readWarnings(logs.index[-1]))
+    assert stages == ['light'] * 3 + ['qbsp']
+    # Single builds keep their own index
+    assert not (project / "maps" / ".qruncher" / "logs" / "test").exists()
+
+
+def test_stages_can_not_be_used(project, capsys):
+    addProfiles(project)
+
+    assert matrix(stages='light') == 1
+    assert "stages: can not be used with matrix builds" in capsys.readouterr().out
@@ -0,0 +1,113 @@
+import os
+import json
+import threading
+
+import pytest
+
+from conftest import qruncher, waitFor, writeConfig
+
+GB = 1024 ** 3
+
+
+@pytest.fixture
+def ledger_dir(tmp_path, monkeypatch):
+    """ Keep the shared ledger out of the real temp directory """
+    monkeypatch.setattr(qruncher.tempfile, 'tempdir', str(tmp_path))
+    return tmp_path
+
+
+def governor(tmp_path, budget='1G', history=None):
+    history_file = str(tmp_path / "test.memory.json")
+    if history is not None:
+        with open(history_file, 'w') as history_json:
+            json.dump(history, history_json)
+    return qruncher.QMemoryGovernor(budget, '100M', history_file)
+
+
+def learned(memory, stage, settings, peak):
+    memory.learn(stage, {'returncode': 0, 'resources': {'max_rss': peak}}, settings)
+
+
+def test_peaks_are_kept_per_args(ledger_dir):
+    memory = governor(ledger_dir)
+    release = ['light', ['-extra4', '-soft']]
+    debug = ['light', []]
+    learned(memory, 'light', release, 4 * GB)
+    learned(memory, 'light', debug, GB // 4)
+
+    memory = governor(ledger_dir)
+    assert memory.predict('light', release) == int(4 * GB * 1.1)
+    assert memory.predict('light', debug) == int(GB // 4 * 1.1)
+    # Never seen with these args: the biggest peak of the stage
+    assert memory.predict('light', ['light', ['-extra']]) == int(4 * GB * 1.1)
+    assert memory.predict('vis', ['vis', []]) == 100 * 1024 ** 2
+
+
+def test_old_history_by_stage_name_is_used_and_replaced(ledger_dir):
+    memory = governor(ledger_dir, history={"light": GB})
+    assert memory.predict('light', ['light', []]) == int(GB * 1.1)
+
+    learned(memory, 'light', ['light', []], GB // 2)
+
+    with open(str(ledger_dir / "test.memory.json")) as history_json:
+        assert list(json.load(history_json)) == [memory.historyKey('light', ['light', []])]
+
+
+def test_stage_waits_until_it_fits(ledger_dir):
+    settings = ['light', []]
+    first = governor(ledger_dir, history={})
+    learned(first, 'light', settings, 600 * 1024 ** 2)
+    second = governor(ledger_dir)
+
+    first.admit('light', settings)
+    admitted = threading.Event()
+    waiter = threading.Thread(target=lambda: second.admit('light', settings) or admitted.set())
+    waiter.start()
+    assert not admitted.wait(0.5)
+
+    first.release('light')
+    waiter.join(5)
+    assert admitted.is_set()
+    second.release('light')
+
+
+def test_entries_of_dead_processes_are_dropped(ledger_dir):
+    with open(str(ledger_dir / "qruncher-memory.json"), 'w') as ledger_json:
+        json.dump({"1-1-light": {"pid": 2 ** 22 + 1, "predicted": 100 * GB, "rss": 0}}, ledger_json)
+    memory = governor(ledger_dir)
+
+    done = threading.Event()
+    threading.Thread(target=lambda: memory.admit('vis') or done.set(), daemon=True).start()
+    assert waitFor(done.is_set, 3)
+    memory.release('vis')
+
+
+def test_ledger_is_writable_by_everyone(ledger_dir):
+    memory = governor(ledger_dir)
+    memory.admit('vis')
+    memory.release('vis')
+
+    assert os.stat(memory.ledger_file).st_mode & 0o777 == 0o666
+
+
+def test_no_budget_leaves_the_ledger_alone(ledger_dir):
+    memory = governor(ledger_dir, budget=None)
+    memory.admit('vis')
+    memory.update('vis', GB)
+    memory.release('vis')
+
+    assert not os.path.exists(memory.ledger_file)
+
+
+def test_build_learns_every_stage(project, ledger_dir):
+    writeConfig(str(project), memory_budget="8G")
+
+    with pytest.raises(SystemExit):
+        qruncher.QCompiler().runBuild({'build': 'default'})
+
+    with open(str(project / "maps" / ".qruncher" / "test.memory.json")) as history_json:
+        history = json.load(history_json)
+    assert sorted(key.split('-')[0] for key in history) == ['light', 'qbsp', 'vis']
+    assert all(peak > 0 for peak in history.values())
+    with open(str(ledger_dir / "qruncher-memory.json")) as ledger_json:
+        assert json.load(ledger_json) == {}
@@ -0,0 +1,146 @@
+import os
+import json
+import struct
+
+import pytest
+
+from conftest import qruncher
+
+
+def readPak(pak_path):
+    """ Entry name to contents, read without QPak """
+    with open(str(pak_path), 'rb') as pak:
+        ident, dirofs, dirlen = struct.unpack('<4sii', pak.read(12))
+        assert ident == b'PACK'
+        pak.seek(dirofs)
+        directory = pak.read(dirlen)
+        files = {}
+        for idx in range(0, dirlen, 64):
+            name, pos, length = struct.unpack('<56sii', directory[idx:idx + 64])
+            pak.seek(pos)
+            files[name.split(b'\0')[0].decode()] = pak.read(length)
+    return files
+
+
+def writeFile(path, data):
+    with open(str(path), 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def setMod(project, **mod):
+    with open(str(project / "qruncher.json")) as config_json:
+        config = json.load(config_json)
+    config['mods'][0].update(mod)
+    with open(str(project / "qruncher.json"), 'w') as config_json:
+        json.dump(config, config_json)
+
+
+def test_round_trip(tmp_path):
+    bsp = writeFile(tmp_path / "a.bsp", b"bsp" * 1000)
+    lit = writeFile(tmp_path / "a.lit", b"lit" * 10)
+    pak = qruncher.QPak(str(tmp_path / "pak0.pak"))
+
+    assert sorted(pak.update({"maps/a.bsp": bsp, "maps/a.lit": lit})) == ["maps/a.bsp", "maps/a.lit"]
+
+    assert readPak(tmp_path / "pak0.pak") == {"maps/a.bsp": b"bsp" * 1000, "maps/a.lit": b"lit" * 10}
+    assert qruncher.QPak(str(tmp_path / "pak0.pak")).entries == pak.entries
+    # Nothing changed, nothing written
+    assert pak.update({"maps/a.bsp": bsp, "maps/a.lit": lit}) == []
+
+
+def test_update_keeps_other_entries_and_reuses_free_space(tmp_path):
+    a = writeFile(tmp_path / "a.bsp", b"a" * 4000)
+    b = writeFile(tmp_path / "b.bsp", b"b" * 4000)
+    pak = qruncher.QPak(str(tmp_path / "pak0.pak"))
+    pak.update({"maps/a.bsp": a, "maps/b.bsp": b})
+
+    writeFile(tmp_path / "a.bsp", b"A" * 1000)
+    assert pak.update({"maps/a.bsp": a}) == ["maps/a.bsp"]
+    size = os.path.getsize(str(tmp_path / "pak0.pak"))
+    assert pak.wasted() > 0
+
+    # Fits in the space the old a.bsp left
+    writeFile(tmp_path / "a.bsp", b"X" * 1000)
+    pak.update({"maps/a.bsp": a})
+
+    assert os.path.getsize(str(tmp_path / "pak0.pak")) == size
+    assert readPak(tmp_path / "pak0.pak") == {"maps/a.bsp": b"X" * 1000, "maps/b.bsp": b"b" * 4000}
+
+
+def test_removes_entries_of_missing_files(tmp_path):
+    bsp = writeFile(tmp_path / "a.bsp", b"bsp")
+    lit = writeFile(tmp_path / "a.lit", b"lit")
+    pak = qruncher.QPak(str(tmp_path / "pak0.pak"))
+    pak.update({"maps/a.bsp": bsp, "maps/a.lit": lit})
+
+    os.remove(lit)
+    assert pak.update({"maps/a.bsp": bsp, "maps/a.lit": lit}) == ["maps/a.lit"]
+
+    assert readPak(tmp_path / "pak0.pak") == {"maps/a.bsp": b"bsp"}
+
+
+def test_compacts_when_free_space_passes_max_waste(tmp_path):
+    a = writeFile(tmp_path / "a.bsp", b"a" * 5000)
+    b = writeFile(tmp_path / "b.bsp", b"b" * 10)
+    pak = qruncher.QPak(str(tmp_path / "pak0.pak"), max_waste='1k')
+    pak.update({"maps/a.bsp": a, "maps/b.bsp": b})
+
+    writeFile(tmp_path / "a.bsp", b"a" * 6000)
+    pak.update({"maps/a.bsp": a})
+
+    assert pak.wasted() == 0
+    assert os.path.getsize(str(tmp_path / "pak0.pak")) == 12 + 6000 + 10 + 2 * 64
+    assert readPak(tmp_path / "pak0.pak") == {"maps/a.bsp": b"a" * 6000, "maps/b.bsp": b"b" * 10}
+
+
+def test_rejects_files_that_are_not_paks(tmp_path):
+    writeFile(tmp_path / "pak0.pak", b"ZIP!" + b"\0" * 8)
+
+    with pytest.raises(qruncher.PakException):
+        qruncher.QPak(str(tmp_path / "pak0.pak"))
+
+
+def test_build_packages_bsp_and_lit(project):
+    setMod(project, pak="pak1.pak")
+
+    with pytest.raises(SystemExit):
+        qruncher.QCompiler().runBuild({'build': 'default'})
+
+    files = readPak(project / "quake" / "id1" / "pak1.pak")
+    assert sorted(files) == ["maps/test.bsp", "maps/test.lit"]
+    with open(str(project / "maps" / "test.bsp"), 'rb') as bsp:
+        assert files["maps/test.bsp"] == bsp.read()
+
+
+def test_failed_build_is_not_packaged(project):
+    setMod(project, pak="pak1.pak")
+    with open(str(project / "qruncher.json")) as config_json:
+        config = json.load(config_json)
+    config['builders'][0]['tools'][2]['path'] = "/bin/false"
+    with open(str(project / "qruncher.json"), 'w') as config_json:
+        json.dump(config, config_json)
+
+    with pytest.raises(SystemExit):
+        qruncher.QCompiler().runBuild({'build': 'default'})
+
+    assert not (project / "quake" / "id1" / "pak1.pak").exists()
+
+
+def test_matrix_packages_only_pak_build(project):
+    setMod(project, pak="pak1.pak", pak_build="release")
+    with open(str(project / "qruncher.json")) as config_json:
+        config = json.load(config_json)
+    release = json.loads(json.dumps(config['builders'][0]))
+    release.update({"name": "release", "default": False})
+    release['tools'][1]['args'] = ['-extra']
+    config['builders'].append(release)
+    with open(str(project / "qruncher.json"), 'w') as config_json:
+        json.dump(config, config_json)
+
+    with pytest.raises(SystemExit):
+        qruncher.QCompiler().runBuild({'build': 'default,release'})
+
+    files = readPak(project / "quake" / "id1" / "pak1.pak")
+    assert sorted(files) == ["maps/test.bsp", "maps/test.lit"]
+    assert b"light local -extra" in files["maps/test.bsp"]
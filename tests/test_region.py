@@ -0,0 +1,128 @@
+import pytest
+
+from conftest import qruncher
+
+QMapFile = qruncher.QMapFile
+
+
+def writeMap(path, world, entities=()):
+    """ Write a .map with world brushes given as (mins, maxs, texture) """
+    with open(str(path), 'w') as map_file:
+        map_file.write('{\n"classname" "worldspawn"\n"wad" "test.wad"\n')
+        for mins, maxs, texture in world:
+            map_file.write("{\n" + "\n".join(QMapFile.boxBrush(mins, maxs, texture)) + "\n}\n")
+        map_file.write("}\n")
+        for keys, brushes in entities:
+            map_file.write("{\n")
+            for key, value in keys:
+                map_file.write('"' + key + '" "' + value + '"\n')
+            for mins, maxs, texture in brushes:
+                map_file.write("{\n" + "\n".join(QMapFile.boxBrush(mins, maxs, texture)) + "\n}\n")
+            map_file.write("}\n")
+
+
+def entityClasses(map_file):
+    return [map_file.getValue(entity, 'classname') for entity in map_file.entities]
+
+
+def test_brush_bounds_of_a_box():
+    brush = QMapFile.boxBrush([-64, 0, 16], [32, 128, 48], "wall")
+
+    assert QMapFile.brushBounds(brush) == ([-64, 0, 16], [32, 128, 48])
+
+
+def test_brush_bounds_of_a_wedge():
+    # Box with the top cut off at 45 degrees
+    brush = QMapFile.boxBrush([0, 0, 0], [64, 64, 64], "wall")
+    brush.append("( 0 0 64 ) ( 0 64 64 ) ( 64 0 0 ) wall 0 0 0 1 1")
+
+    assert QMapFile.brushBounds(brush) == ([0, 0, 0], [64, 64, 64])
+    assert QMapFile.brushBounds(brush[:2]) is None
+
+
+def test_region_keeps_what_touches_the_box_and_seals_it(tmp_path):
+    writeMap(tmp_path / "big.map", [
+        ([-1024, -1024, -16], [1024, 1024, 0], "sky1"),
+        ([-256, -256, 0], [256, 256, 16], "ground1"),
+        ([2000, 2000, 0], [2100, 2100, 100], "far")
+    ], [
+        ([("classname", "light"), ("origin", "0 0 64")], []),
+        ([("classname", "light"), ("origin", "3000 0 64")], []),
+        ([("classname", "func_door")], [([100, 100, 16], [140, 140, 2000], "door")]),
+        ([("classname", "func_wall")], [([5000, 5000, 0], [5100, 5100, 100], "wall")])
+    ])
+
+    mins, maxs = [-512, -512, -64], [512, 512, 256]
+    assert QMapFile(str(tmp_path / "big.map")).writeRegion(str(tmp_path / "big_rgn.map"), mins, maxs)
+
+    region = QMapFile(str(tmp_path / "big_rgn.map"))
+    assert entityClasses(region) == ['worldspawn', 'light', 'func_door', 'info_player_start']
+    assert region.getValue(region.entities[0], 'wad') == "test.wad"
+    # The door is kept whole even where it leaves the box
+    assert QMapFile.brushBounds(region.entities[2]['brushes'][0]) == ([100, 100, 16], [140, 140, 2000])
+
+    world = region.entities[0]['brushes']
+    assert len(world) == 2 + 6
+    hull = [QMapFile.brushBounds(brush) for brush in world[2:]]
+    # One 16 unit slab on every side of the box, covering it completely
+    for axis in range(3):
+        for side, edge in ((0, mins[axis]), (1, maxs[axis])):
+            slab = [bounds for bounds in hull if bounds[1 - side][axis] == edge]
+            assert len(slab) == 1
+            assert slab[0][side][axis] == edge - 16 if side == 0 else edge + 16
+            assert all(slab[0][0][n] <= mins[n] - 16 and slab[0][1][n] >= maxs[n] + 16
+                for n in range(3) if n != axis)
+    # Sky was the first texture, the hull uses a wall
+    assert all(QMapFile.faceTexture(line) == "ground1" for brush in world[2:] for line in brush)
+
+
+def test_player_start_is_moved_out_of_brushes(tmp_path):
+    # A pillar in the middle of the box
+    writeMap(tmp_path / "pillar.map", [([-64, -64, -64], [64, 64, 64], "stone")])
+
+    QMapFile(str(tmp_path / "pillar.map")).writeRegion(str(tmp_path / "pillar_rgn.map"),
+        [-256, -256, -128], [256, 256, 128])
+
+    region = QMapFile(str(tmp_path / "pillar_rgn.map"))
+    origin = [float(c) for c in region.getValue(region.entities[-1], 'origin').split()]
+    player = ([origin[0] - 16, origin[1] - 16, origin[2] - 24], [origin[0] + 16, origin[1] + 16, origin[2] + 32])
+    assert not all(player[0][n] < 64 and player[1][n] > -64 for n in range(3))
+    assert all(-256 <= player[0][n] and player[1][n] <= 256 for n in range(2))
+
+
+def test_existing_player_start_is_kept(tmp_path):
+    writeMap(tmp_path / "start.map", [([-64, -64, -64], [64, 64, 64], "stone")],
+        [([("classname", "info_player_start"), ("origin", "128 0 0")], [])])
+
+    QMapFile(str(tmp_path / "start.map")).writeRegion(str(tmp_path / "start_rgn.map"),
+        [-256, -256, -128], [256, 256, 128])
+
+    region = QMapFile(str(tmp_path / "start_rgn.map"))
+    starts = [entity for entity in region.entities if region.getValue(entity, 'classname') == 'info_player_start']
+    assert [region.getValue(entity, 'origin') for entity in starts] == ["128 0 0"]
+
+
+def test_region_build_without_room_for_the_player_stops(project):
+    writeMap(project / "maps" / "test.map", [([-1024, -1024, -1024], [1024, 1024, 1024], "stone")])
+
+    with pytest.raises(SystemExit) as exit_info:
+        qruncher.QCompiler().runBuild({'build': 'default', 'region': '-64,-64,-64,64,64,64'})
+
+    assert exit_info.value.code == 1
+    assert not (project / "maps" / "test_rgn.map").exists()
+
+
+def test_region_build_is_deployed_beside_the_full_build(project):
+    writeMap(project / "maps" / "test.map", [([-256, -256, -16], [256, 256, 0], "ground1")],
+        [([("classname", "light"), ("origin", "0 0 64")], []),
+            ([("classname", "light"), ("origin", "4000 0 64")], [])])
+
+    with pytest.raises(SystemExit):
+        qruncher.QCompiler().runBuild({'build': 'default', 'region': '-128,-128,-32,128,128,128'})
+
+    maps = project / "quake" / "id1" / "maps"
+    assert not (maps / "test.bsp").exists()
+    # The stand-in qbsp copies the .map into the .bsp
+    bsp = (maps / "test_rgn.bsp").read_text()
+    assert bsp.count('"classname" "light"') == 1
+    assert '"classname" "info_player_start"' in bsp
@@ -0,0 +1,79 @@
+import os
+import json
+
+import pytest
+
+from conftest import qruncher, writeConfig
+
+
+def build(**opts):
+    cwd = os.getcwd()
+    opts.setdefault('build', 'default')
+    with pytest.raises(SystemExit):
+        qruncher.QCompiler().runBuild(opts)
+    os.chdir(cwd)
+
+
+def addBuilder(project, name):
+    with open(str(project / "qruncher.json")) as config_json:
+        config = json.load(config_json)
+    builder = json.loads(json.dumps(config['builders'][0]))
+    builder.update({"name": name, "default": False})
+    config['builders'].append(builder)
+    with open(str(project / "qruncher.json"), 'w') as config_json:
+        json.dump(config, config_json)
+
+
+def readMetrics(path):
+    samples = {}
+    with open(str(path)) as textfile:
+        for line in textfile:
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+    return samples
+
+
+def test_json_reports_of_each_build_are_kept(project):
+    addBuilder(project, 'release')
+    build(report='json')
+    build(build='release', report='json')
+    build(report='json', force='yes')
+
+    reports = sorted(os.listdir(str(project / "maps" / ".qruncher" / "reports")))
+    assert len(reports) == 3
+    default = [name for name in reports if name.startswith("test-default-")]
+    assert len(default) == 2
+    assert len([name for name in reports if name.startswith("test-release-")]) == 1
+
+    with open(str(project / "maps" / ".qruncher" / "reports" / default[-1])) as report_json:
+        report = json.load(report_json)
+    assert report['success'] and not report['skipped']
+    assert [stage['name'] for stage in report['stages']] == ['qbsp', 'vis', 'light']
+    assert all(stage['status'] == 'ok' and stage['worker'] == 'local' for stage in report['stages'])
+    assert report['artifacts']['.lit']['exists']
+    assert report['deploy']['path'] == str(project / "quake" / "id1" / "maps" / "test.bsp")
+
+
+def test_ndjson_streams_stage_events(project):
+    build(report='ndjson')
+
+    with open(str(project / "maps" / ".qruncher" / "reports" / "test.ndjson")) as events:
+        lines = [json.loads(line) for line in events]
+    assert [line['event'] for line in lines] == ['stage_start', 'stage_stop'] * 3 + ['build']
+    assert lines[-1]['report']['map'] == "test"
+
+
+def test_prometheus_keeps_the_last_real_build(project):
+    prom = project / "qruncher.prom"
+    writeConfig(str(project), prometheus_textfile=str(prom))
+    build()
+    labels = '{map="test",build="default"}'
+    duration = readMetrics(prom)["qruncher_build_duration_seconds" + labels]
+
+    build()
+
+    samples = readMetrics(prom)
+    assert samples["qruncher_build_duration_seconds" + labels] == duration
+    assert samples["qruncher_build_success" + labels] == 1
+    assert 'qruncher_stage_duration_seconds{map="test",build="default",stage="vis"}' in samples
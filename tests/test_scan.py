@@ -0,0 +1,75 @@
+import os
+import sys
+import json
+import subprocess
+
+from conftest import ROOT, qruncher
+
+
+def touch(path):
+    os.makedirs(os.path.dirname(str(path)), exist_ok=True)
+    with open(str(path), 'w') as f:
+        f.write('{\n"classname" "worldspawn"\n}\n')
+
+
+def scan(project, directory):
+    out = subprocess.run([sys.executable, os.path.join(ROOT, "qruncher.py"), "map:scan", str(directory)],
+        cwd=str(project), stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    with open(str(project / "qruncher.json")) as config_json:
+        return {mmap['name']: mmap['source'] for mmap in json.load(config_json)['maps']}, out
+
+
+def test_scanner_skips_region_maps_and_junk_dirs(tmp_path):
+    for name in ["a.map", "sub/b.MAP", "sub/b_rgn.map", "autosave/c.map", ".git/d.map", "sub/deep/e.map", "f.bsp"]:
+        touch(tmp_path / "src" / name)
+
+    maps = qruncher.QScanner(str(tmp_path / "src")).scan()
+
+    assert sorted(os.path.relpath(path, str(tmp_path / "src")) for path in maps) == \
+        ["a.map", os.path.join("sub", "b.MAP"), os.path.join("sub", "deep", "e.map")]
+
+
+def test_rescan_reuses_unchanged_directories(tmp_path):
+    touch(tmp_path / "src" / "a" / "one.map")
+    touch(tmp_path / "src" / "b" / "two.map")
+    # The first scan adds .qruncher to the root
+    qruncher.QScanner(str(tmp_path / "src")).scan()
+    qruncher.QScanner(str(tmp_path / "src")).scan()
+
+    touch(tmp_path / "src" / "b" / "three.map")
+    scanner = qruncher.QScanner(str(tmp_path / "src"))
+    maps = scanner.scan()
+
+    assert len(maps) == 3
+    assert scanner.scanned == 3
+    # Only b changed
+    assert scanner.reused == 2
+
+
+def test_scan_creates_profiles_named_after_maps(project, tmp_path):
+    touch(tmp_path / "src" / "e1" / "start.map")
+    touch(tmp_path / "src" / "e2" / "start.map")
+    touch(tmp_path / "src" / "e2" / "arena.map")
+
+    maps, out = scan(project, tmp_path / "src")
+
+    assert maps["arena"] == str(tmp_path / "src" / "e2" / "arena.map")
+    assert maps["start"] == str(tmp_path / "src" / "e1" / "start.map")
+    # Name taken, the directory is added
+    assert maps["e2_start"] == str(tmp_path / "src" / "e2" / "start.map")
+    assert "Found 3 maps: 3 created, 0 updated, 0 unchanged" in out
+
+    maps_again, out = scan(project, tmp_path / "src")
+    assert maps_again == maps
+    assert "Found 3 maps: 0 created, 0 updated, 3 unchanged" in out
+
+
+def test_scan_follows_moved_maps(project, tmp_path):
+    touch(tmp_path / "src" / "old" / "arena.map")
+    scan(project, tmp_path / "src")
+
+    os.rename(str(tmp_path / "src" / "old"), str(tmp_path / "src" / "new"))
+    maps, out = scan(project, tmp_path / "src")
+
+    assert maps["arena"] == str(tmp_path / "src" / "new" / "arena.map")
+    assert "1 updated" in out
@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+import subprocess
+
+import pytest
+
+from conftest import ROOT, qruncher, waitFor
+
+
+def readLog(path):
+    try:
+        with open(path) as log_file:
+            return log_file.read().splitlines()
+    except FileNotFoundError:
+        return []
+
+
+@pytest.fixture
+def session(project, monkeypatch):
+    """ A running engine:session with the stand-in engine """
+    engine_log = str(project / "engine.log")
+    monkeypatch.setenv('STANDIN_ENGINE_LOG', engine_log)
+    monkeypatch.setenv('STANDIN_ENGINE_STDIN', '1')
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "qruncher.py"), "engine:session"],
+        cwd=str(project), stdout=subprocess.DEVNULL)
+    session_file = str(project / "quake" / ".qruncher" / "session.json")
+    assert waitFor(lambda: os.path.exists(session_file))
+    yield session_file, engine_log
+    proc.terminate()
+    proc.wait(timeout=10)
+
+
+def test_engine_reads_commands_from_stdin(project, monkeypatch):
+    engine_log = str(project / "engine.log")
+    monkeypatch.setenv('STANDIN_ENGINE_LOG', engine_log)
+    monkeypatch.setenv('STANDIN_ENGINE_STDIN', '1')
+    engine = subprocess.Popen([os.path.join(ROOT, "tests", "tools", "engine"), "-game", "id1"],
+        stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    engine.communicate(b"game ad\nmap test\nquit\n", timeout=10)
+
+    assert readLog(engine_log) == ["start -game id1", "game ad", "map test", "quit"]
+
+
+def test_session_loads_map_into_running_engine(session):
+    session_file, engine_log = session
+    engine_session = qruncher.QEngineSession(session_file)
+
+    assert engine_session.isRunning('default')
+    assert engine_session.loadMap('test', 'ad')
+    assert waitFor(lambda: readLog(engine_log)[-2:] == ["game ad", "map test"])
+
+
+def test_build_returns_without_blocking_when_session_is_live(session):
+    session_file, engine_log = session
+    compiler = qruncher.QCompiler()
+
+    started = time.time()
+    with pytest.raises(SystemExit) as exit_info:
+        compiler.runBuild({'build': 'default'})
+
+    assert exit_info.value.code == 0
+    assert time.time() - started < 10
+    assert waitFor(lambda: "map test" in readLog(engine_log))
+    # Loaded into the session, not a second engine
+    assert len([line for line in readLog(engine_log) if line.startswith("start")]) == 1
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+from conftest import qruncher
+
+
+def build(**opts):
+    cwd = os.getcwd()
+    opts.setdefault('build', 'default')
+    with pytest.raises(SystemExit) as exit_info:
+        qruncher.QCompiler().runBuild(opts)
+    os.chdir(cwd)
+    return exit_info.value.code
+
+
+def bspLines(project):
+    return (project / "maps" / "test.bsp").read_text().splitlines()
+
+
+def test_later_stages_run_on_current_intermediates(project):
+    build()
+
+    assert build(stages='light') == 0
+
+    stages = [line.split()[0] for line in bspLines(project)[3:]]
+    assert stages == ['qbsp', 'vis', 'light', 'light']
+
+
+def test_stale_intermediates_are_refused(project, capsys):
+    build()
+    (project / "maps" / "test.map").write_text('{\n"classname" "worldspawn"\n"message" "new"\n}\n')
+
+    assert build(stages='vis,light') == 1
+
+    assert "qbsp output does not match the current map" in capsys.readouterr().out
+    assert bspLines(project)[-1] == "light local "
+    assert len([line for line in bspLines(project) if line.startswith("light")]) == 1
+
+
+def test_force_runs_on_stale_intermediates_but_does_not_record(project, capsys):
+    build()
+    (project / "maps" / "test.map").write_text('{\n"classname" "worldspawn"\n"message" "new"\n}\n')
+
+    assert build(stages='vis,light', force='yes') == 0
+    assert "WARNING: running stages on stale intermediates (force:yes)" in capsys.readouterr().out
+
+    # The full build is still needed
+    build()
+    assert "Building test (changed: " in capsys.readouterr().out
+
+
+def test_stages_must_be_in_order(project, capsys):
+    build()
+
+    assert build(stages='light,vis') == 1
+    assert "stages must be in order" in capsys.readouterr().out
@@ -0,0 +1,55 @@
+import os
+import json
+
+import pytest
+
+from conftest import qruncher
+
+
+def readTrace(project):
+    reports = str(project / "maps" / ".qruncher" / "reports")
+    traces = [name for name in os.listdir(reports) if name.endswith(".trace.json")]
+    assert len(traces) == 1
+    with open(os.path.join(reports, traces[0])) as trace_json:
+        return json.load(trace_json)['traceEvents']
+
+
+def tracks(events):
+    return {event['tid']: event['args']['name'] for event in events if event['ph'] == 'M'}
+
+
+def test_build_trace_has_every_phase(project):
+    with pytest.raises(SystemExit):
+        qruncher.QCompiler().runBuild({'build': 'default', 'trace': 'yes'})
+
+    events = readTrace(project)
+    spans = [event for event in events if event['ph'] == 'X']
+    names = [span['name'] for span in spans]
+    for name in ["config load", "resolve paths", "dependency check", "qbsp", "vis", "light", "deploy", "engine"]:
+        assert name in names
+    assert all(span['args']['map'] == "test" and span['args']['build'] == "default" for span in spans)
+    vis = spans[names.index("vis")]
+    assert vis['cat'] == "tool" and vis['args']['worker'] == "local" and vis['dur'] > 0
+    assert list(tracks(events).values()) == ["MainThread"]
+
+
+def test_matrix_stages_are_on_their_thread_tracks(project):
+    with open(str(project / "qruncher.json")) as config_json:
+        config = json.load(config_json)
+    release = json.loads(json.dumps(config['builders'][0]))
+    release.update({"name": "release", "default": False})
+    release['tools'][2]['args'] = ['-level', '4']
+    config['builders'].append(release)
+    with open(str(project / "qruncher.json"), 'w') as config_json:
+        json.dump(config, config_json)
+
+    with pytest.raises(SystemExit):
+        qruncher.QCompiler().runBuild({'build': 'default,release', 'trace': 'yes'})
+
+    events = readTrace(project)
+    names = tracks(events)
+    tools = [event for event in events if event['ph'] == 'X' and event['cat'] == 'tool']
+    assert sorted((tool['name'], tool['args']['profiles']) for tool in tools) == [
+        ('light', 'default'), ('light', 'release'), ('qbsp', 'default,release'),
+        ('vis', 'default'), ('vis', 'release')]
+    assert all(names[tool['tid']].startswith("matrix") for tool in tools)
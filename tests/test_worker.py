@@ -0,0 +1,187 @@
+import os
+import json
+import sys
+import socket
+import tempfile
+import threading
+import subprocess
+
+import pytest
+
+from conftest import ROOT, qruncher, waitFor, writeConfig
+
+SECRET = "test secret"
+
+
+def freePort():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def workers(tmp_path):
+    """ Start build workers on localhost, each in its own directory """
+    procs = []
+
+    def start(name, cores, **env):
+        directory = tmp_path / name
+        writeConfig(str(directory), worker_cores=cores, worker_secret=SECRET)
+        port = freePort()
+        proc_env = dict(os.environ, STANDIN_NAME=name, **env)
+        proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "qruncher.py"), "worker:serve", str(port)],
+            cwd=str(directory), env=proc_env, stdout=subprocess.DEVNULL)
+        procs.append(proc)
+        address = "127.0.0.1:" + str(port)
+        assert waitFor(lambda: qruncher.QWorkerClient(address).info() is not None)
+        return proc, address
+
+    yield start
+    for proc in procs:
+        proc.kill()
+        proc.wait()
+
+
+def coordinator(project, addresses):
+    """ Compiler using the workers, with a .bsp and .prt from qbsp """
+    writeConfig(str(project), workers=addresses, worker_secret=SECRET)
+    compiler = qruncher.QCompiler()
+    map_directory = str(project / "maps") + os.sep
+    compiler.runTool([os.path.join(ROOT, "tests", "tools", "qbsp"), map_directory + "test.map"])
+    return compiler, map_directory
+
+
+def test_choose_picks_worker_with_most_idle_cores(workers):
+    _, small = workers("small", 1)
+    _, big = workers("big", 256)
+
+    assert qruncher.QWorkerClient.choose([small, big], SECRET).address == big
+    assert qruncher.QWorkerClient.choose([big, small], SECRET).address == big
+
+
+def test_outputs_come_back_into_map_directory(project, workers):
+    _, small = workers("small", 1)
+    _, big = workers("big", 256)
+    compiler, map_directory = coordinator(project, [small, big])
+
+    lines = []
+    vis = compiler.runRemote('vis', 'default', [], map_directory, 'test', lines.append)
+    light = compiler.runRemote('light', 'default', [], map_directory, 'test', lines.append)
+
+    assert vis['worker'] == big and vis['returncode'] == 0
+    assert light['worker'] == big and light['returncode'] == 0
+    with open(map_directory + "test.bsp") as bsp:
+        assert bsp.read().splitlines()[-2:] == ["vis big ", "light big "]
+    with open(map_directory + "test.lit") as lit:
+        assert lit.read() == "QLIT big\n"
+    assert lines[0].startswith("vis on big: ")
+    assert not [name for name in os.listdir(map_directory) if name.endswith(".part")]
+
+
+def test_killed_worker_falls_back_to_local_run(project, workers):
+    proc, slow = workers("slow", 256, STANDIN_SLEEP="30")
+    compiler, map_directory = coordinator(project, [slow])
+
+    def killWhenRunning():
+        if waitFor(lambda: (qruncher.QWorkerClient(slow).info() or {}).get('running')):
+            proc.kill()
+    killer = threading.Thread(target=killWhenRunning)
+    killer.start()
+
+    with pytest.raises(SystemExit):
+        compiler.runBuild({'build': 'default', 'remote': 'vis', 'force': 'yes'})
+    killer.join()
+
+    assert proc.poll() is not None
+    with open(map_directory + "test.bsp") as bsp:
+        stages = bsp.read().splitlines()
+    assert "vis local " in stages
+    assert "vis slow " not in stages
+
+
+def test_worker_refuses_paths_outside_its_work_dir(project, workers):
+    _, address = workers("w", 4)
+    victim = project / "victim.bsp"
+    victim.write_text("victim")
+
+    client = qruncher.QWorkerClient(address, SECRET)
+    with client.connect() as sock:
+        qruncher.QWorker.send(sock, {"type": "job", "secret": SECRET, "build": "default", "stage": "vis",
+            "basename": "../" + os.path.relpath(str(project / "victim"), tempfile.gettempdir()), "files": []})
+        reply = qruncher.QWorker.recv(sock)
+
+    assert reply['type'] == 'error'
+    assert victim.read_text() == "victim"
+
+
+def test_worker_runs_the_coordinators_args(project, workers, tmp_path):
+    _, big = workers("big", 256)
+    # The worker's copy of the profile has drifted
+    with open(str(tmp_path / "big" / "qruncher.json")) as config_json:
+        config = json.load(config_json)
+    for tool in config['builders'][0]['tools']:
+        tool['args'] = ['-level', '0']
+    with open(str(tmp_path / "big" / "qruncher.json"), 'w') as config_json:
+        json.dump(config, config_json)
+    compiler, map_directory = coordinator(project, [big])
+
+    vis = compiler.runRemote('vis', 'default', ['-level', '4'], map_directory, 'test', lambda line: None)
+
+    assert vis['args'] == ['-level', '4']
+    with open(map_directory + "test.bsp") as bsp:
+        assert bsp.read().splitlines()[-1] == "vis big -level 4"
+
+
+def test_worker_refuses_args_with_paths(project, workers):
+    _, big = workers("big", 256)
+    compiler, map_directory = coordinator(project, [big])
+
+    with pytest.raises(qruncher.WorkerException):
+        qruncher.QWorkerClient(big, SECRET).runStage('default', 'light', ['-litfile', '/tmp/x.lit'],
+            [map_directory + "test.bsp"], map_directory, lambda line: None)
+
+
+def test_worker_refuses_bad_secret(workers, tmp_path):
+    _, address = workers("w", 4)
+    map_directory = str(tmp_path / "w" / "maps") + os.sep
+
+    with pytest.raises(qruncher.WorkerException):
+        qruncher.QWorkerClient(address, "wrong").runStage('default', 'vis', [], [map_directory + "test.map"],
+            map_directory, lambda line: None)
+
+
+def test_downgraded_vis_runs_fast_on_worker(project, workers):
+    _, big = workers("big", 256)
+    compiler, map_directory = coordinator(project, [big])
+    with open(str(project / "qruncher.json")) as config_json:
+        config = json.load(config_json)
+    config['config']['vis_rate'] = 1000000
+    for tool in config['builders'][0]['tools']:
+        if tool['name'] == 'vis':
+            tool.update({"budget": "1s", "over_budget": "fast"})
+    with open(str(project / "qruncher.json"), 'w') as config_json:
+        json.dump(config, config_json)
+
+    with pytest.raises(SystemExit):
+        qruncher.QCompiler().runBuild({'build': 'default', 'remote': 'vis'})
+
+    with open(map_directory + "test.bsp") as bsp:
+        assert "vis big -fast" in bsp.read().splitlines()
+
+
+def test_remote_stages_get_a_track_per_worker(project, workers):
+    _, big = workers("big", 256)
+    coordinator(project, [big])
+
+    with pytest.raises(SystemExit):
+        qruncher.QCompiler().runBuild({'build': 'default', 'remote': 'vis,light', 'trace': 'yes'})
+
+    reports = str(project / "maps" / ".qruncher" / "reports")
+    trace_file = [name for name in os.listdir(reports) if name.endswith(".trace.json")][0]
+    with open(os.path.join(reports, trace_file)) as trace_json:
+        events = json.load(trace_json)['traceEvents']
+    tracks = {event['tid']: event['args']['name'] for event in events if event['ph'] == 'M'}
+    spans = {event['name']: event for event in events if event['ph'] == 'X'}
+    assert tracks[spans['vis']['tid']] == "worker " + big
+    assert tracks[spans['light']['tid']] == "worker " + big
+    assert tracks[spans['qbsp']['tid']] == "MainThread"